@@ -0,0 +1,309 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Iterator, Optional, Tuple
+
+from endpoints.serialization import dumps
+from reader.ReaderFactory import get_reader
+from utils.deadline import Deadline
+from utils.util import get_request_payload
+from workflow.loader import compile_plan
+
+logger = logging.getLogger(__name__)
+
+# workflow instance of the process, compiled once per (worker) process
+_wfi = None
+
+
+def init_worker(config: str, config_type: str):
+    global _wfi
+    _wfi = compile_plan(get_reader(config_type)(config))
+
+
+def _result(
+    variables: Optional[dict], error: Optional[Exception], start: float = None
+) -> dict:
+    start = time.perf_counter() if start is None else start
+    result = {"latency_ms": round((time.perf_counter() - start) * 1000, 3)}
+    if error is not None:
+        result["error"] = f"{type(error).__name__}: {error}"
+    else:
+        result["output"] = variables.get("final_output")
+        result["session_id"] = variables.get("session_id")
+    return result
+
+
+def run_record(payload: dict, timeout_ms: float = 0) -> dict:
+    """run the workflow of the process on one payload, errors are reported
+    in the result instead of raised so one bad record does not stop a batch
+    """
+    start = time.perf_counter()
+    try:
+        variables = _wfi.execute(payload, Deadline.after(timeout_ms / 1000))
+    except Exception as e:
+        return _result(None, e, start)
+    return _result(variables, None, start)
+
+
+async def arun_record(payload: dict, timeout_ms: float = 0) -> dict:
+    start = time.perf_counter()
+    deadline = Deadline.after(timeout_ms / 1000)
+    try:
+        variables = await asyncio.wait_for(
+            _wfi.aexecute(payload, deadline), deadline.remaining()
+        )
+    except Exception as e:
+        return _result(None, e, start)
+    return _result(variables, None, start)
+
+
+class BatchRunner:
+    """Streams a jsonl file of requests through a workflow
+
+    records are read lazily and at most `concurrency` of them run at once,
+    by a thread pool, a process pool (each process compiles the workflow
+    itself) or asyncio tasks. results are written to `output` as jsonl in
+    input order, `{"line": ..., "request_id": ..., "output": ...}` or
+    `{"line": ..., "error": ...}` for failed records.
+
+    every `checkpoint_every` results `<output>.ckpt` records the next input
+    line and the byte offsets reached in input and output, `resume` continues
+    from there, truncating results written after the checkpoint.
+    results wait for the slowest record before them, at most
+    `4 * concurrency` records are in flight or waiting to be written.
+    """
+
+    modes = ("thread", "process", "async")
+
+    def __init__(
+        self,
+        config: str,
+        input: str,
+        output: str,
+        config_type: str = "yaml",
+        mode: str = "thread",
+        concurrency: int = 8,
+        resume: bool = False,
+        start_line: int = 0,
+        limit: int = 0,
+        timeout_ms: float = 0,
+        checkpoint_every: int = 100,
+        progress_interval: float = 10,
+    ) -> None:
+        assert mode in self.modes, f"mode should be one of {self.modes}"
+        assert concurrency > 0, "concurrency should > 0"
+        self.config = config
+        self.config_type = config_type
+        self.input = input
+        self.output = output
+        self.checkpoint_path = output + ".ckpt"
+        self.mode = mode
+        self.concurrency = concurrency
+        self.window = 4 * concurrency
+        self.resume = resume
+        self.start_line = start_line
+        self.limit = limit
+        self.timeout_ms = timeout_ms
+        self.checkpoint_every = checkpoint_every
+        self.progress_interval = progress_interval
+
+        # line -> (end offset in input, request_id, result), waiting for
+        # the lines before it
+        self.buffer = {}
+        self.next_line = 0
+        self.input_offset = 0
+        self.done = 0
+        self.errors = 0
+        self.since_checkpoint = 0
+
+    def load_checkpoint(self) -> Tuple[int, int, int]:
+        """(next line, input offset, output offset) to resume from"""
+        if not self.resume or not os.path.exists(self.checkpoint_path):
+            return self.start_line, 0, 0
+        with open(self.checkpoint_path, "r") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("input") != self.input:
+            raise ValueError(
+                f"checkpoint {self.checkpoint_path} is for {checkpoint.get('input')}"
+            )
+        return checkpoint["line"], checkpoint["input_offset"], checkpoint["output_offset"]
+
+    def save_checkpoint(self):
+        self.out.flush()
+        checkpoint = {
+            "input": self.input,
+            "line": self.next_line,
+            "input_offset": self.input_offset,
+            "output_offset": self.out.tell(),
+        }
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+        self.since_checkpoint = 0
+
+    def read_records(self, line: int, offset: int) -> Iterator[tuple]:
+        """(line, end offset, request_id, payload or error) of each record from
+        `line`, which starts at byte `offset` of the input
+        """
+        with open(self.input, "rb") as f:
+            f.seek(offset)
+            if not offset:
+                # no offset to seek to, skip to the line
+                for _ in range(line):
+                    offset += len(f.readline())
+            n_records = 0
+            for raw in f:
+                offset += len(raw)
+                if raw.strip():
+                    try:
+                        record = json.loads(raw)
+                        payload = get_request_payload(record, line)
+                        yield line, offset, record.get("request_id"), payload
+                    except (ValueError, AttributeError) as e:
+                        yield line, offset, None, e
+                    n_records += 1
+                    if self.limit and n_records >= self.limit:
+                        return
+                line += 1
+
+    def add_result(self, line: int, end_offset: int, request_id, result: dict):
+        self.buffer[line] = (end_offset, request_id, result)
+        while self.buffer:
+            first = min(self.buffer)
+            if self.in_flight_lines and min(self.in_flight_lines) < first:
+                break
+            end_offset, request_id, result = self.buffer.pop(first)
+            self.out.write(
+                dumps({"line": first, "request_id": request_id, **result}) + b"\n"
+            )
+            self.next_line = first + 1
+            self.input_offset = end_offset
+            self.done += 1
+            self.errors += "error" in result
+            self.since_checkpoint += 1
+            if self.since_checkpoint >= self.checkpoint_every:
+                self.save_checkpoint()
+        self.report_progress()
+
+    def report_progress(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_report < self.progress_interval:
+            return
+        elapsed = now - self.started_at
+        logger.info(
+            "batch %s: %s records (%s errors) in %.1fs, %.2f records/s, next line %s",
+            self.input,
+            self.done,
+            self.errors,
+            elapsed,
+            self.done / elapsed if elapsed else 0.0,
+            self.next_line,
+        )
+        self.last_report = now
+
+    def run_pool(self, executor, records: Iterator[tuple]):
+        pending = {}
+
+        def collect(return_when):
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                line, end_offset, request_id = pending.pop(future)
+                self.in_flight_lines.discard(line)
+                self.add_result(line, end_offset, request_id, future.result())
+
+        for line, end_offset, request_id, payload in records:
+            while len(pending) + len(self.buffer) >= self.window:
+                collect(FIRST_COMPLETED)
+            if isinstance(payload, Exception):
+                self.add_result(line, end_offset, request_id, _result(None, payload))
+                continue
+            self.in_flight_lines.add(line)
+            future = executor.submit(run_record, payload, self.timeout_ms)
+            pending[future] = (line, end_offset, request_id)
+        if pending:
+            collect(ALL_COMPLETED)
+
+    async def run_async(self, records: Iterator[tuple]):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = {}
+
+        async def run(payload):
+            async with semaphore:
+                return await arun_record(payload, self.timeout_ms)
+
+        async def collect(return_when):
+            done, _ = await asyncio.wait(pending, return_when=return_when)
+            for task in done:
+                line, end_offset, request_id = pending.pop(task)
+                self.in_flight_lines.discard(line)
+                self.add_result(line, end_offset, request_id, task.result())
+
+        for line, end_offset, request_id, payload in records:
+            while len(pending) + len(self.buffer) >= self.window:
+                await collect(asyncio.FIRST_COMPLETED)
+            if isinstance(payload, Exception):
+                self.add_result(line, end_offset, request_id, _result(None, payload))
+                continue
+            self.in_flight_lines.add(line)
+            pending[asyncio.ensure_future(run(payload))] = (line, end_offset, request_id)
+        if pending:
+            await collect(asyncio.ALL_COMPLETED)
+
+    def run(self) -> dict:
+        line, input_offset, output_offset = self.load_checkpoint()
+        self.next_line, self.input_offset = line, input_offset
+        self.in_flight_lines = set()
+        mode = "r+b" if self.resume and os.path.exists(self.output) else "wb"
+        self.out = open(self.output, mode)
+        self.out.seek(output_offset)
+        self.out.truncate()
+        logger.info(
+            "batch %s -> %s from line %s, %s mode, concurrency %s",
+            self.input,
+            self.output,
+            line,
+            self.mode,
+            self.concurrency,
+        )
+
+        self.started_at = self.last_report = time.monotonic()
+        records = self.read_records(line, input_offset)
+        try:
+            if self.mode == "async":
+                init_worker(self.config, self.config_type)
+                asyncio.run(self.run_async(records))
+            elif self.mode == "thread":
+                init_worker(self.config, self.config_type)
+                with ThreadPoolExecutor(self.concurrency) as executor:
+                    self.run_pool(executor, records)
+            else:
+                with ProcessPoolExecutor(
+                    self.concurrency,
+                    initializer=init_worker,
+                    initargs=(self.config, self.config_type),
+                ) as executor:
+                    self.run_pool(executor, records)
+        finally:
+            # results written so far are kept, `resume` continues after them
+            self.save_checkpoint()
+            self.out.close()
+            self.report_progress(force=True)
+
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "records": self.done,
+            "errors": self.errors,
+            "elapsed_s": elapsed,
+            "throughput_rps": self.done / elapsed if elapsed else 0.0,
+            "next_line": self.next_line,
+        }
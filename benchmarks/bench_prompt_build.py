@@ -0,0 +1,75 @@
+"""Benchmark prompt building time against the length of `Memory` history
+
+compares rebuilding the `ChatPromptTemplate` per request (the former
+`LLM.get_prompts`) with the template precompiled at load time by the LLM node.
+
+usage: python -m benchmarks.bench_prompt_build --sizes 0 2 8 32 128 512
+"""
+import argparse
+import logging
+import timeit
+
+from langchain_core.prompts import ChatPromptTemplate
+
+from nodes.node.llm import LLM
+
+PROMPTS = [
+    {"prompt": "you are a help assistant, your name is 1234", "role": "system"},
+    {"prompt": "{input}", "role": "user"},
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="*", type=int, default=[0, 2, 8, 32, 128, 512])
+    parser.add_argument("--repeat", type=int, default=200)
+    return parser.parse_args()
+
+
+def rebuild_per_request(prompts, history):
+    prompt_messages = [(p.get("role"), p.get("prompt")) for p in prompts]
+    for message in history:
+        prompt_messages.insert(-1, (message.get("role"), message.get("content")))
+    return ChatPromptTemplate.from_messages(prompt_messages)
+
+
+def make_history(n: int) -> list:
+    return [
+        {"role": "user" if i % 2 == 0 else "ai", "content": f"message number {i}"}
+        for i in range(n)
+    ]
+
+
+def main(args):
+    node = LLM(
+        None,
+        {
+            "model_id": "meta.llama2-70b-chat-v1",
+            "prompts": PROMPTS,
+            "use_history": True,
+            "output_mappings": ["llm_output"],
+        },
+    )
+    print(f"{'n':>6} {'rebuild (us)':>14} {'compiled (us)':>14} {'speedup':>8}")
+    for n in args.sizes:
+        history = make_history(n)
+        global_variables = {"input": "hello", "_history": history}
+
+        rebuild = timeit.timeit(
+            lambda: rebuild_per_request(PROMPTS, history).invoke(global_variables),
+            number=args.repeat,
+        )
+        compiled = timeit.timeit(
+            lambda: node.render_prompt(global_variables),
+            number=args.repeat,
+        )
+        rebuild_us = rebuild / args.repeat * 1e6
+        compiled_us = compiled / args.repeat * 1e6
+        print(
+            f"{n:>6} {rebuild_us:>14.1f} {compiled_us:>14.1f} {rebuild_us / compiled_us:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    main(parse_args())
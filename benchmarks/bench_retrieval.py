@@ -0,0 +1,92 @@
+"""Benchmark query latency of the Retrieval index against the corpus size
+
+builds indexes of random unit vectors in a temporary directory, then times
+top-k searches of single queries, of batches of queries (per query) and of
+single queries filtered to a tenth of the corpus. the embedding call of the
+Retrieval node is not included.
+
+usage: python -m benchmarks.bench_retrieval --sizes 1000 10000 100000 1000000
+"""
+import argparse
+import logging
+import tempfile
+import time
+
+import numpy as np
+
+from retrieval import IndexWriter, VectorIndex
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="*", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--top_k", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=50)
+    return parser.parse_args()
+
+
+def build(path: str, size: int, dim: int, rng) -> float:
+    start = time.perf_counter()
+    writer = IndexWriter(path, dim=dim)
+    for offset in range(0, size, 50000):
+        n = min(50000, size - offset)
+        documents = [
+            {"id": str(i), "text": f"document {i}", "metadata": {"group": i % 10}}
+            for i in range(offset, offset + n)
+        ]
+        writer.append(documents, rng.standard_normal((n, dim), dtype=np.float32))
+    return time.perf_counter() - start
+
+
+def percentiles(timings: list) -> tuple:
+    timings_ms = np.array(timings) * 1000
+    return np.percentile(timings_ms, 50), np.percentile(timings_ms, 99)
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    print(
+        f"{'size':>9} {'build (s)':>10} {'p50 (ms)':>9} {'p99 (ms)':>9} "
+        f"{'batched (ms/q)':>15} {'filtered p50 (ms)':>18}"
+    )
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as path:
+            build_s = build(path, size, args.dim, rng)
+            index = VectorIndex(path)
+            queries = rng.standard_normal((args.repeat, args.dim), dtype=np.float32)
+
+            # first pass pages the matrix in
+            index.search(queries[:1], args.top_k)
+            single = []
+            for query in queries:
+                start = time.perf_counter()
+                index.search(query, args.top_k)
+                single.append(time.perf_counter() - start)
+
+            batches = max(args.repeat // args.batch, 1)
+            start = time.perf_counter()
+            for i in range(batches):
+                index.search(rng.standard_normal((args.batch, args.dim)), args.top_k)
+            batched = (time.perf_counter() - start) / (batches * args.batch)
+
+            filtered = []
+            for i, query in enumerate(queries):
+                start = time.perf_counter()
+                rows = index.filter_rows({"group": i % 10})
+                index.search(query, args.top_k, rows)
+                filtered.append(time.perf_counter() - start)
+
+            p50, p99 = percentiles(single)
+            filtered_p50, _ = percentiles(filtered)
+            print(
+                f"{size:>9} {build_s:>10.2f} {p50:>9.2f} {p99:>9.2f} "
+                f"{batched * 1000:>15.3f} {filtered_p50:>18.2f}"
+            )
+            index.close()
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    main(parse_args())
@@ -0,0 +1,124 @@
+"""Deterministic stand-ins for external services used by the benchmarks"""
+import asyncio
+import hashlib
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class FakeChatModel(BaseChatModel):
+    """chat model answering after `latency_ms` with `n_tokens` tokens
+    generated at `tokens_per_sec`, the answer only depends on the prompt
+    """
+
+    model_id: str = "fake"
+    latency_ms: float = 200
+    tokens_per_sec: float = 50
+    n_tokens: int = 64
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        seed = sum(len(str(message.content)) for message in messages)
+        return [f"tok{(seed + i) % 997} " for i in range(self.n_tokens)]
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(self.latency_ms / 1000 + len(tokens) / self.tokens_per_sec)
+        message = AIMessage(content="".join(tokens))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self.latency_ms / 1000 + len(tokens) / self.tokens_per_sec)
+        message = AIMessage(content="".join(tokens))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency_ms / 1000)
+        for token in self._tokens(messages):
+            time.sleep(1 / self.tokens_per_sec)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency_ms / 1000)
+        for token in self._tokens(messages):
+            await asyncio.sleep(1 / self.tokens_per_sec)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+def install_fake_models(latency_ms: float, tokens_per_sec: float, n_tokens: int):
+    """make the model registry hand out fake models instead of Bedrock ones"""
+    from nodes.model_registry import model_registry
+
+    def create_model(model_id: str, model_kwargs: dict = None):
+        return FakeChatModel(
+            model_id=model_id,
+            latency_ms=latency_ms,
+            tokens_per_sec=tokens_per_sec,
+            n_tokens=n_tokens,
+        )
+
+    model_registry.create_model = create_model
+
+
+class FakeEmbeddings(Embeddings):
+    """embeddings after `latency_ms`, random unit vectors seeded by the text"""
+
+    def __init__(self, dim: int = 256, latency_ms: float = 0) -> None:
+        self.dim = dim
+        self.latency_ms = latency_ms
+
+    def _embed(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency_ms / 1000)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency_ms / 1000)
+        return self._embed(text)
+
+
+def install_fake_embeddings(dim: int = 256, latency_ms: float = 0):
+    """make the model registry hand out fake embedding models"""
+    from nodes.model_registry import model_registry
+
+    def create_embeddings(model_id: str, model_kwargs: dict = None):
+        return FakeEmbeddings(dim, latency_ms)
+
+    model_registry.create_embeddings = create_embeddings
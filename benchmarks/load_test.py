@@ -0,0 +1,180 @@
+"""Hermetic load test of the Vulcan app
+
+boots the app built by `vulcan.create_app` with fake models (fixed latency
+and tokens/sec) and the in-memory session store on a loopback port, replays a
+jsonl file of requests against the given endpoints at a fixed concurrency and
+reports latency percentiles, time to first byte and throughput.
+
+usage:
+    python -m benchmarks.load_test --configs workflows/poc_memory.yml \
+        --paths /poc/invoke /poc/stream --concurrency 32 --output bench.json
+"""
+import os
+
+# must be set before the session store is created
+os.environ.setdefault("VULCAN_SESSION_STORE", "memory")
+
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import time
+from typing import Iterator, List
+
+import httpx
+import uvicorn
+
+from benchmarks.fakes import install_fake_models
+from utils.util import get_request_payload
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=str, default="requests.jsonl")
+    parser.add_argument("--configs", nargs="*", type=str, default="")
+    parser.add_argument("--config_type", type=str, choices=["yaml"], default="yaml")
+    parser.add_argument("--paths", nargs="+", default=["/poc/invoke", "/poc/stream"])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--latency_ms", type=float, default=200)
+    parser.add_argument("--tokens_per_sec", type=float, default=50)
+    parser.add_argument("--n_tokens", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", type=str, default="bench_output.json")
+    return parser.parse_args()
+
+
+def load_payloads(path: str, repeat: int, limit: int) -> List[dict]:
+    payloads = []
+    with open(path, "r") as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                payloads.append(get_request_payload(json.loads(line), i))
+            if limit and len(payloads) >= limit:
+                break
+    return payloads * repeat
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def summarize(samples: List[dict], elapsed: float) -> dict:
+    ok = [sample for sample in samples if sample["status"] == 200]
+    latency = [sample["latency"] for sample in ok]
+    ttfb = [sample["ttfb"] for sample in ok]
+    summary = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "bytes": sum(sample["bytes"] for sample in ok),
+    }
+    for name, values in (("latency", latency), ("ttfb", ttfb)):
+        for q in (50, 95, 99):
+            summary[f"{name}_p{q}_ms"] = percentile(values, q) * 1000
+    return summary
+
+
+async def send(client: httpx.AsyncClient, path: str, payload: dict) -> dict:
+    start = time.perf_counter()
+    ttfb = None
+    n_bytes = 0
+    try:
+        async with client.stream("POST", path, json=payload) as response:
+            async for chunk in response.aiter_raw():
+                if ttfb is None and chunk:
+                    ttfb = time.perf_counter() - start
+                n_bytes += len(chunk)
+            status = response.status_code
+    except httpx.HTTPError as e:
+        logging.warning(f"request to {path} failed: {e}")
+        status = -1
+    latency = time.perf_counter() - start
+    return {
+        "status": status,
+        "latency": latency,
+        "ttfb": ttfb if ttfb is not None else latency,
+        "bytes": n_bytes,
+    }
+
+
+async def replay(
+    base_url: str, path: str, payloads: List[dict], concurrency: int, timeout: float
+) -> dict:
+    samples = []
+    iterator: Iterator[dict] = iter(payloads)
+
+    async def worker(client: httpx.AsyncClient):
+        for payload in iterator:
+            samples.append(await send(client, path, payload))
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=timeout, limits=limits
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    return summarize(samples, elapsed)
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(args) -> dict:
+    import vulcan
+
+    install_fake_models(args.latency_ms, args.tokens_per_sec, args.n_tokens)
+    app = vulcan.create_app(args.configs, args.config_type)
+    port = get_free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    payloads = load_payloads(args.requests, args.repeat, args.limit)
+    results = {
+        "config": {
+            key: value for key, value in vars(args).items() if key != "output"
+        },
+        "endpoints": {},
+    }
+    try:
+        for path in args.paths:
+            summary = await replay(
+                f"http://127.0.0.1:{port}",
+                path,
+                payloads,
+                args.concurrency,
+                args.timeout,
+            )
+            results["endpoints"][path] = summary
+            print(f"{path}: {json.dumps(summary)}")
+    finally:
+        server.should_exit = True
+        await serve_task
+    return results
+
+
+def main(args):
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main(parse_args())
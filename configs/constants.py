@@ -1,3 +1,61 @@
+import os
+
 cosmos_url = "https://localhost:8081"
 cosmos_credential = "C2y6yDjf5/R+ob0N8A7Cgv30VRDJIWEHLM+4QDU5DE2nQ9nDuVTqobD4b8mGGyPMbIZnqyMsEcaGQy67XIw/Jw=="
-cosmos_db = "vulcan"
\ No newline at end of file
+cosmos_db = "vulcan"
+
+# backend of session messages: cosmos | memory | sqlite
+session_store = os.environ.get("VULCAN_SESSION_STORE", "cosmos")
+session_store_path = os.environ.get("VULCAN_SESSION_STORE_PATH", "vulcan_sessions.db")
+
+# write-behind persistence of session messages
+session_write_behind = True
+session_write_batch_size = 100
+session_write_queue_size = 10000
+session_write_flush_interval = 0.05
+
+# in-process cache of the latest messages per session, each process has its
+# own, so it is off with prefork workers. disable it too when serving with
+# several processes otherwise, unless sessions are sticky to a process
+session_cache_enabled = os.environ.get("VULCAN_SESSION_CACHE", "true").lower() == "true"
+session_cache_max_sessions = 10000
+session_cache_window = 32
+session_cache_idle_ttl = 600
+
+# history summaries of the Memory node (`mode: summary`), folded by a pool
+# of background threads
+summary_fold_workers = 2
+
+# token counts of distinct message texts kept by `utils.tokens`
+token_count_cache_size = 65536
+
+model_registry_max_size = 32
+model_max_pool_connections = 64
+
+# embedding indexes of the Retrieval node, rows scored per block of a search
+# and seconds between checks of an index for appended rows
+retrieval_chunk_rows = 65536
+retrieval_reload_interval = 5
+
+# OpenTelemetry spans per workflow run, needs `opentelemetry-api` and an SDK
+tracing_enabled = os.environ.get("VULCAN_TRACING", "false").lower() == "true"
+
+# logging, per subsystem levels as `<logger>=<level>,...`, e.g. `dao=WARNING`
+log_level = os.environ.get("VULCAN_LOG_LEVEL", "INFO")
+log_levels = os.environ.get("VULCAN_LOG_LEVELS", "")
+# write records from a background thread
+log_async = True
+# payloads (inputs, prompts, responses) are logged at DEBUG
+log_payload_sample_rate = float(os.environ.get("VULCAN_LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+log_payload_max_chars = 2000
+
+# threads running the nodes of tree workflows, shared by every workflow
+tree_workflow_workers = 64
+
+# seconds between checks of workflow configs for changes, 0 disables
+workflow_watch_interval = float(os.environ.get("VULCAN_WATCH_INTERVAL", "2"))
+
+# default deadline of a request in ms, 0 for none. endpoints (`timeout_ms`),
+# requests (`config.timeout_ms`) and the `X-Request-Timeout-Ms` header can only
+# shorten it
+request_timeout_ms = float(os.environ.get("VULCAN_REQUEST_TIMEOUT_MS", "0"))
@@ -1,22 +1,370 @@
+import atexit
 import logging
+import queue
+import threading
 import time
 import uuid
-from typing import List
-from azure.cosmos import CosmosClient
-from configs.constants import cosmos_url, cosmos_credential
+from collections import OrderedDict, deque
+from typing import List, Optional
+from configs.constants import (
+    session_write_behind,
+    session_write_batch_size,
+    session_write_queue_size,
+    session_write_flush_interval,
+    session_cache_enabled,
+    session_cache_max_sessions,
+    session_cache_window,
+    session_cache_idle_ttl,
+)
+from dao.store import SessionStore, get_session_store
 from utils.util import get_message_id
+from utils import metrics
+from utils.log import log_payload
+
+logger = logging.getLogger(__name__)
+
+
+class SessionWriter:
+    """Write-behind queue persisting session messages in the background
+
+    messages are queued and written by a single background thread, grouped
+    per session and handed to the store as one batch (a transactional batch
+    per partition on cosmos).
+    the queue is bounded, a full queue falls back to writing through on the
+    caller thread. messages not yet persisted are kept per session so readers
+    of the same process still see their own writes.
+    """
+
+    def __init__(
+        self,
+        store: SessionStore,
+        batch_size: int = session_write_batch_size,
+        queue_size: int = session_write_queue_size,
+        flush_interval: float = session_write_flush_interval,
+    ) -> None:
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="session-writer", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def put_nowait(self, item: dict) -> bool:
+        """enqueue without blocking, False when the queue is full or closed"""
+        if self._closed:
+            return False
+        session_id = item["session_id"]
+        with self._pending_lock:
+            self._pending.setdefault(session_id, []).append(item)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._pending_lock:
+                pending = [x for x in self._pending.get(session_id, []) if x is not item]
+                if pending:
+                    self._pending[session_id] = pending
+                else:
+                    self._pending.pop(session_id, None)
+            return False
+        return True
+
+    def put(self, item: dict) -> None:
+        """enqueue, blocks for `flush_interval` then writes through on the
+        caller thread when the queue is full, never call it on an event loop
+        """
+        session_id = item["session_id"]
+        with self._pending_lock:
+            self._pending.setdefault(session_id, []).append(item)
+        if self._closed:
+            self._write(session_id, [item])
+            return
+        try:
+            self._queue.put(item, timeout=self.flush_interval)
+        except queue.Full:
+            logger.warning(
+                "session write queue is full (%s), write through", self.queue_depth
+            )
+            self._write(session_id, [item])
+
+    def pending_messages(self, session_id: str) -> List[dict]:
+        with self._pending_lock:
+            return list(self._pending.get(session_id, []))
+
+    def _take_batch(self) -> List[dict]:
+        try:
+            items = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(items) < self.batch_size:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while not (self._closed and self._queue.empty()):
+            items = self._take_batch()
+            if not items:
+                continue
+            batches = {}
+            for item in items:
+                batches.setdefault(item["session_id"], []).append(item)
+            for session_id, batch in batches.items():
+                self._write(session_id, batch)
+            for _ in items:
+                self._queue.task_done()
+
+    def _write(self, session_id: str, items: List[dict]):
+        try:
+            with metrics.session_store_seconds.time(self.store.store_type, "write"):
+                self.store.add_messages(session_id, items)
+        except Exception:
+            logger.exception("failed to persist messages of session `%s`", session_id)
+        finally:
+            with self._pending_lock:
+                pending = self._pending.get(session_id, [])
+                written = {id(item) for item in items}
+                pending = [item for item in pending if id(item) not in written]
+                if pending:
+                    self._pending[session_id] = pending
+                else:
+                    self._pending.pop(session_id, None)
+
+    def flush(self) -> None:
+        """block until every queued message is persisted"""
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._thread.join()
+        # messages queued while shutting down
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            self._write(item["session_id"], [item])
+            self._queue.task_done()
+        logger.info("session writer closed")
+
+
+_session_writer = None
+_session_writer_lock = threading.Lock()
+
+
+def get_session_writer() -> SessionWriter:
+    global _session_writer
+    if _session_writer is None:
+        with _session_writer_lock:
+            if _session_writer is None:
+                _session_writer = SessionWriter(get_session_store())
+                atexit.register(_session_writer.close)
+    return _session_writer
+
+
+metrics.session_write_queue_depth.set_function(
+    lambda: {(): _session_writer.queue_depth} if _session_writer is not None else {}
+)
+
+
+def close_session_writer() -> None:
+    """flush pending session messages, called on shutdown"""
+    if _session_writer is not None:
+        _session_writer.close()
+
+
+class SessionHistoryCache:
+    """Bounded LRU of the latest messages of recently active sessions
+
+    each session keeps a window of its latest `window` messages (more when a
+    reader asks for more), loaded from the store on a miss and then appended
+    to as this process saves new messages, so follow-up turns of a hot
+    session skip the database. a load racing with an append is dropped.
+    sessions are evicted by LRU once over `max_sessions` and after being idle
+    for `idle_ttl` seconds, which also bounds how stale a session written by
+    another process can get.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = session_cache_max_sessions,
+        window: int = session_cache_window,
+        idle_ttl: float = session_cache_idle_ttl,
+    ) -> None:
+        self.max_sessions = max_sessions
+        self.window = window
+        self.idle_ttl = idle_ttl
+        # session_id -> [last access, deque of messages, whole session cached]
+        self._sessions = OrderedDict()
+        # session_id -> [# of loads in flight, # of appends since they started]
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self, now: float):
+        while self._sessions:
+            session_id, (last_access, _, _) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and (
+                now - last_access <= self.idle_ttl
+            ):
+                break
+            del self._sessions[session_id]
+
+    def get(self, session_id: str, n: int) -> Optional[List[dict]]:
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            entry = self._sessions.get(session_id)
+            if entry is None or (n > len(entry[1]) and not entry[2]):
+                self.misses += 1
+                metrics.session_cache_requests_total.inc("miss")
+                return None
+            entry[0] = now
+            self._sessions.move_to_end(session_id)
+            self.hits += 1
+            messages = entry[1]
+            messages = list(messages)[-n:] if n < len(messages) else list(messages)
+        metrics.session_cache_requests_total.inc("hit")
+        return messages
+
+    def start_load(self, session_id: str) -> int:
+        """start loading a session from the store, return the version to hand
+        back to `load`
+        """
+        with self._lock:
+            loading = self._loading.setdefault(session_id, [0, 0])
+            loading[0] += 1
+            return loading[1]
+
+    def load(
+        self, session_id: str, messages: Optional[List[dict]], n: int, version: int
+    ):
+        """cache the latest `n` messages of a session read from the store,
+        dropped when a message was appended since `start_load` (it may be
+        missing from them), None only ends the load
+        """
+        now = time.time()
+        with self._lock:
+            loading = self._loading[session_id]
+            loading[0] -= 1
+            if not loading[0]:
+                del self._loading[session_id]
+            if messages is None or loading[1] != version:
+                return
+            # fewer messages than asked for means we got the whole session,
+            # the window grows to the largest `n` asked for
+            window = max(n, self.window)
+            complete = len(messages) < n
+            self._sessions[session_id] = [
+                now,
+                deque(messages[-window:], maxlen=window),
+                complete,
+            ]
+            self._sessions.move_to_end(session_id)
+            self._evict(now)
+
+    def append(self, session_id: str, message: dict):
+        """append a saved message, only sessions already cached are updated"""
+        with self._lock:
+            loading = self._loading.get(session_id)
+            if loading is not None:
+                loading[1] += 1
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return
+            messages = entry[1]
+            if len(messages) == messages.maxlen:
+                entry[2] = False
+            messages.append(message)
+            entry[0] = time.time()
+            self._sessions.move_to_end(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "sessions": len(self._sessions),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+
+_session_history_cache = None
+_session_history_cache_lock = threading.Lock()
+# turned off process wide when sessions are served by several processes
+_session_history_cache_disabled = False
+
+
+def disable_session_history_cache() -> None:
+    """stop caching session messages in process, a cache is only consistent
+    when a session is always served by the same process
+    """
+    global _session_history_cache_disabled
+    _session_history_cache_disabled = True
+
+
+metrics.session_cache_sessions.set_function(
+    lambda: {(): _session_history_cache.stats()["sessions"]}
+    if _session_history_cache is not None
+    else {}
+)
+
+
+def get_session_history_cache() -> SessionHistoryCache:
+    global _session_history_cache
+    if _session_history_cache is None:
+        with _session_history_cache_lock:
+            if _session_history_cache is None:
+                _session_history_cache = SessionHistoryCache()
+    return _session_history_cache
 
 
 class SessionDAO:
-    def __init__(self) -> None:
-        self.client = CosmosClient(url=cosmos_url, credential=cosmos_credential)
-        self.database = self.client.get_database_client("vulcan")
-        self.session_container = self.database.get_container_client("SessionMessages")
+    """Session messages, persisted by the process wide `SessionStore`
+    selected through `configs.constants.session_store`
 
-    def save_session_message(
-        self, session_id: str, msg: str, role: str, source: str
+    the store, writer and cache are only resolved on first use, so loading
+    workflows opens no connection and starts no thread (workers forked after
+    loading create their own)
+    """
+
+    def __init__(
+        self,
+        write_behind: bool = session_write_behind,
+        use_cache: bool = session_cache_enabled,
     ) -> None:
-        data = {
+        self.write_behind = write_behind
+        self.use_cache = use_cache
+
+    @property
+    def store(self) -> SessionStore:
+        return get_session_store()
+
+    @property
+    def writer(self) -> Optional[SessionWriter]:
+        return get_session_writer() if self.write_behind else None
+
+    @property
+    def history_cache(self) -> Optional[SessionHistoryCache]:
+        if not self.use_cache or _session_history_cache_disabled:
+            return None
+        return get_session_history_cache()
+
+    @staticmethod
+    def new_message(session_id: str, msg: str, role: str, source: str) -> dict:
+        return {
+            "id": str(uuid.uuid4()),
             "session_id": session_id,
             "timestamp": time.time(),
             "message_id": get_message_id(session_id, msg),
@@ -25,25 +373,112 @@ class SessionDAO:
             "type": "text",
             "source": source,
         }
-        logging.info(f"Saving session message: {data}")
-        self.session_container.create_item(data, enable_automatic_id_generation=True)
+
+    def save_session_message(
+        self, session_id: str, msg: str, role: str, source: str
+    ) -> None:
+        self.save_messages(session_id, [self.new_message(session_id, msg, role, source)])
+
+    def save_messages(self, session_id: str, messages: List[dict]) -> None:
+        """save messages made by `new_message`, may block on the store"""
+        log_payload(logger, "Saving session messages: %s", messages)
+        if self.writer is not None:
+            for message in messages:
+                self.writer.put(message)
+        else:
+            with metrics.session_store_seconds.time(self.store.store_type, "write"):
+                self.store.add_messages(session_id, messages)
+        self._cache_messages(session_id, messages)
+
+    def enqueue_messages(self, session_id: str, messages: List[dict]) -> List[dict]:
+        """queue messages to the write-behind writer without blocking, return
+        the ones left to `save_messages` (no writer, or the queue is full)
+        """
+        if self.writer is None:
+            return messages
+        for i, message in enumerate(messages):
+            if not self.writer.put_nowait(message):
+                self._cache_messages(session_id, messages[:i])
+                return messages[i:]
+        log_payload(logger, "Queued session messages: %s", messages)
+        self._cache_messages(session_id, messages)
+        return []
+
+    def _cache_messages(self, session_id: str, messages: List[dict]):
+        if self.history_cache is not None:
+            for message in messages:
+                self.history_cache.append(session_id, self.history_record(message))
 
     def get_session(self, session_id: str) -> List[dict]:
-        iterative_rst = self.session_container.query_items(
-            f"SELECT * FROM c WHERE c.session_id = '{session_id}'"
-        )
-        rst = list(iterative_rst)
-        rst.sort(key=lambda x: x["timestamp"])
-        logging.info(f"Got session messages: {rst} id: {session_id}")
-        return list(rst)
+        with metrics.session_store_seconds.time(self.store.store_type, "read"):
+            rst = self.store.get_session(session_id)
+        log_payload(logger, "Got session messages: %s id: %s", rst, session_id)
+        return rst
+
+    @staticmethod
+    def history_record(message: dict) -> dict:
+        return {
+            "content": message["content"],
+            "role": message["role"],
+            "timestamp": message["timestamp"],
+        }
 
     def get_latest_n_messages(self, session_id: str, n: int) -> List[str]:
-        dialog_history = self.get_session(session_id)
-        last_n_messages = list(
-            map(
-                lambda x: {"content": x["content"], "role": x["role"]},
-                dialog_history[-n:],
-            )
-        )
-        logging.info(f"Got last n messages: {last_n_messages}")
+        last_n_messages = [
+            {"content": record["content"], "role": record["role"]}
+            for record in self.get_latest_n_records(session_id, n)
+        ]
+        log_payload(logger, "Got last n messages: %s", last_n_messages)
         return last_n_messages
+
+    def get_latest_n_records(self, session_id: str, n: int) -> List[dict]:
+        """the latest `n` messages, with their timestamps, through the cache"""
+        if n <= 0:
+            return []
+
+        if self.history_cache is not None:
+            records = self.history_cache.get(session_id, n)
+            if records is not None:
+                return records
+            # fill the whole cache window with a single query
+            window = max(n, self.history_cache.window)
+            version = self.history_cache.start_load(session_id)
+            records = None
+            try:
+                records = self.query_latest_n_messages(session_id, window)
+            finally:
+                self.history_cache.load(session_id, records, window, version)
+            return records[-n:]
+        return self.query_latest_n_messages(session_id, n)
+
+    def query_latest_n_messages(self, session_id: str, n: int) -> List[dict]:
+        return [
+            self.history_record(message)
+            for message in self.query_latest_records(session_id, n)
+        ]
+
+    def query_latest_records(self, session_id: str, n: int) -> List[dict]:
+        """the latest `n` stored messages, with their timestamps"""
+        with metrics.session_store_seconds.time(self.store.store_type, "read"):
+            messages = self.store.get_latest_messages(session_id, n)
+        if self.writer is not None:
+            # read your writes: merge messages still waiting in the write queue
+            persisted = {message["id"] for message in messages}
+            pending = [
+                message
+                for message in self.writer.pending_messages(session_id)
+                if message["id"] not in persisted
+            ]
+            if pending:
+                messages = sorted(messages + pending, key=lambda x: x["timestamp"])
+        return messages[-n:]
+
+    def get_summary(self, session_id: str) -> Optional[dict]:
+        with metrics.session_store_seconds.time(self.store.store_type, "read_summary"):
+            return self.store.get_summary(session_id)
+
+    def save_summary(self, session_id: str, content: str, until: float) -> dict:
+        summary = {"content": content, "until": until, "updated": time.time()}
+        with metrics.session_store_seconds.time(self.store.store_type, "write_summary"):
+            self.store.save_summary(session_id, summary)
+        return summary
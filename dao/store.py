@@ -0,0 +1,284 @@
+import logging
+import sqlite3
+import threading
+from typing import List, Optional
+
+from configs.constants import (
+    cosmos_url,
+    cosmos_credential,
+    cosmos_db,
+    session_store,
+    session_store_path,
+)
+from utils.sqlite import SQLiteConnections
+
+logger = logging.getLogger(__name__)
+
+_cosmos_client = None
+_cosmos_client_lock = threading.Lock()
+
+
+def get_cosmos_client():
+    """return the process wide cosmos client
+    the client is thread safe and owns the connection pool, so it is created
+    once and shared by every DAO instead of once per workflow/node
+    """
+    global _cosmos_client
+    if _cosmos_client is None:
+        with _cosmos_client_lock:
+            if _cosmos_client is None:
+                from azure.cosmos import CosmosClient
+
+                _cosmos_client = CosmosClient(
+                    url=cosmos_url, credential=cosmos_credential
+                )
+    return _cosmos_client
+
+
+class SessionStore:
+    """Storage backend of session messages
+
+    messages are dicts with at least `id`, `session_id`, `timestamp`,
+    `content` and `role`, all reads return them oldest first.
+    each session may also have one summary, `{"content": ..., "until": ...}`
+    condensing its messages up to the timestamp `until`.
+    """
+
+    store_type = "undefined"
+
+    def add_messages(self, session_id: str, messages: List[dict]) -> None:
+        raise NotImplementedError()
+
+    def get_session(self, session_id: str) -> List[dict]:
+        raise NotImplementedError()
+
+    def get_latest_messages(self, session_id: str, n: int) -> List[dict]:
+        raise NotImplementedError()
+
+    def get_summary(self, session_id: str) -> Optional[dict]:
+        raise NotImplementedError()
+
+    def save_summary(self, session_id: str, summary: dict) -> None:
+        raise NotImplementedError()
+
+    @staticmethod
+    def create(store_type: str = session_store, path: str = session_store_path):
+        if store_type == "cosmos":
+            return CosmosSessionStore()
+        elif store_type == "memory":
+            return InMemorySessionStore()
+        elif store_type == "sqlite":
+            return SQLiteSessionStore(path)
+        else:
+            raise ValueError(f"Invalid session store: {store_type}")
+
+
+class CosmosSessionStore(SessionStore):
+    """messages stored in the `SessionMessages` container, summaries in the
+    `SessionSummaries` container (one item per session, `id` is the session id)
+    both containers are partitioned by `/session_id`, so all queries below are
+    single partition reads
+    """
+
+    store_type = "cosmos"
+    # transactional batch is limited to 100 operations
+    max_batch_size = 100
+
+    def __init__(self) -> None:
+        self.client = get_cosmos_client()
+        self.database = self.client.get_database_client(cosmos_db)
+        self.session_container = self.database.get_container_client("SessionMessages")
+        self.summary_container = self.database.get_container_client("SessionSummaries")
+
+    def add_messages(self, session_id: str, messages: List[dict]) -> None:
+        for i in range(0, len(messages), self.max_batch_size):
+            batch = messages[i : i + self.max_batch_size]
+            if len(batch) == 1:
+                self.session_container.create_item(batch[0])
+                continue
+            try:
+                self.session_container.execute_item_batch(
+                    [("create", (message,)) for message in batch],
+                    partition_key=session_id,
+                )
+            except Exception:
+                logger.exception(
+                    "batch write of session `%s` failed, retry one by one", session_id
+                )
+                for message in batch:
+                    self.session_container.create_item(message)
+
+    def get_session(self, session_id: str) -> List[dict]:
+        iterative_rst = self.session_container.query_items(
+            "SELECT * FROM c WHERE c.session_id = @session_id ORDER BY c.timestamp",
+            parameters=[{"name": "@session_id", "value": session_id}],
+            partition_key=session_id,
+        )
+        return list(iterative_rst)
+
+    def get_latest_messages(self, session_id: str, n: int) -> List[dict]:
+        # newest first so `TOP` keeps the latest messages, reversed below
+        iterative_rst = self.session_container.query_items(
+            "SELECT TOP @n c.id, c.timestamp, c.content, c.role FROM c "
+            "WHERE c.session_id = @session_id ORDER BY c.timestamp DESC",
+            parameters=[
+                {"name": "@n", "value": n},
+                {"name": "@session_id", "value": session_id},
+            ],
+            partition_key=session_id,
+        )
+        messages = list(iterative_rst)
+        messages.reverse()
+        return messages
+
+    def get_summary(self, session_id: str) -> Optional[dict]:
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+        try:
+            return self.summary_container.read_item(session_id, partition_key=session_id)
+        except CosmosResourceNotFoundError:
+            return None
+
+    def save_summary(self, session_id: str, summary: dict) -> None:
+        self.summary_container.upsert_item(
+            {**summary, "id": session_id, "session_id": session_id}
+        )
+
+
+class InMemorySessionStore(SessionStore):
+    """process local store, for tests, benchmarks and throwaway deployments"""
+
+    store_type = "memory"
+
+    def __init__(self) -> None:
+        self._sessions = {}
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    def add_messages(self, session_id: str, messages: List[dict]) -> None:
+        with self._lock:
+            session = self._sessions.setdefault(session_id, [])
+            session.extend(dict(message) for message in messages)
+            session.sort(key=lambda x: x["timestamp"])
+
+    def get_session(self, session_id: str) -> List[dict]:
+        with self._lock:
+            return [dict(message) for message in self._sessions.get(session_id, [])]
+
+    def get_latest_messages(self, session_id: str, n: int) -> List[dict]:
+        with self._lock:
+            session = self._sessions.get(session_id, [])
+            return [dict(message) for message in session[-n:]] if n > 0 else []
+
+    def get_summary(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            summary = self._summaries.get(session_id)
+            return dict(summary) if summary is not None else None
+
+    def save_summary(self, session_id: str, summary: dict) -> None:
+        with self._lock:
+            self._summaries[session_id] = dict(summary, session_id=session_id)
+
+
+class SQLiteSessionStore(SessionStore):
+    """local SQLite store for single node deployments
+
+    the database runs in WAL mode so readers never block on the writer, and
+    messages are indexed on `(session_id, timestamp)` so reading the latest
+    messages of a session is an index range scan.
+    """
+
+    store_type = "sqlite"
+    columns = (
+        "id",
+        "session_id",
+        "timestamp",
+        "message_id",
+        "content",
+        "role",
+        "type",
+        "source",
+    )
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._connections = SQLiteConnections(path, row_factory=sqlite3.Row)
+        conn = self._get_connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_messages ("
+            "id TEXT PRIMARY KEY, session_id TEXT NOT NULL, timestamp REAL NOT NULL, "
+            "message_id TEXT, content TEXT, role TEXT, type TEXT, source TEXT)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS session_messages_session_timestamp "
+            "ON session_messages (session_id, timestamp)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_summaries ("
+            "session_id TEXT PRIMARY KEY, content TEXT, until REAL, updated REAL)"
+        )
+        logger.info("sqlite session store at: %s", path)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def add_messages(self, session_id: str, messages: List[dict]) -> None:
+        conn = self._get_connection()
+        rows = [
+            tuple(message.get(column) for column in self.columns)
+            for message in messages
+        ]
+        sql = "INSERT INTO session_messages ({}) VALUES ({})".format(
+            ", ".join(self.columns), ", ".join("?" for _ in self.columns)
+        )
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(sql, rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_session(self, session_id: str) -> List[dict]:
+        rows = self._get_connection().execute(
+            "SELECT * FROM session_messages WHERE session_id = ? ORDER BY timestamp",
+            (session_id,),
+        )
+        return [dict(row) for row in rows]
+
+    def get_latest_messages(self, session_id: str, n: int) -> List[dict]:
+        rows = self._get_connection().execute(
+            "SELECT id, timestamp, content, role FROM session_messages "
+            "WHERE session_id = ? ORDER BY timestamp DESC LIMIT ?",
+            (session_id, n),
+        ).fetchall()
+        rows.reverse()
+        return [dict(row) for row in rows]
+
+    def get_summary(self, session_id: str) -> Optional[dict]:
+        row = self._get_connection().execute(
+            "SELECT * FROM session_summaries WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def save_summary(self, session_id: str, summary: dict) -> None:
+        self._get_connection().execute(
+            "INSERT OR REPLACE INTO session_summaries (session_id, content, until, updated) "
+            "VALUES (?, ?, ?, ?)",
+            (session_id, summary["content"], summary["until"], summary.get("updated")),
+        )
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """return the process wide session store selected by `session_store`"""
+    global _session_store
+    if _session_store is None:
+        with _session_store_lock:
+            if _session_store is None:
+                _session_store = SessionStore.create()
+                logger.info("session store: %s", type(_session_store).__name__)
+    return _session_store
@@ -1 +1,2 @@
-from .endpoint import Endpoint
\ No newline at end of file
+from .endpoint import Endpoint
+from .metrics import bind_metrics
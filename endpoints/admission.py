@@ -0,0 +1,244 @@
+"""Admission control, bounded concurrency with load shedding
+
+limits are declared per endpoint (`limits` of an endpoint) and per model
+(`model_limits` of a workflow, keyed by model_id)::
+
+    endpoints:
+      - path: /poc/invoke
+        type: sync
+        limits:
+          max_concurrency: 32
+          max_queue: 64
+          queue_timeout_ms: 2000
+          retry_after: 1
+    model_limits:
+      meta.llama2-70b-chat-v1:
+        max_concurrency: 16
+
+a request runs once it holds a slot of its endpoint and of every model its
+workflow calls. when all slots are taken it waits in a bounded queue, a full
+queue sheds it at once with 429, waiting longer than `queue_timeout_ms` sheds
+it with 503, both carry a Retry-After header.
+
+limiters live in a process wide registry keyed by name, so reloading a
+workflow reconfigures them in place and requests in flight stay counted.
+model limiters are shared by every workflow calling the model.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Iterable, List, Optional
+
+from fastapi import HTTPException
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+default_max_queue = 0
+default_queue_timeout_ms = 5000
+default_retry_after = 1
+
+
+class Rejected(Exception):
+    def __init__(self, limiter: str, status_code: int, reason: str, retry_after: int):
+        super().__init__(f"{limiter}: {reason}")
+        self.limiter = limiter
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_http(self) -> HTTPException:
+        return HTTPException(
+            self.status_code,
+            detail=str(self),
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+
+class ConcurrencyLimiter:
+    """At most `max_concurrency` holders, at most `max_queue` waiters
+
+    waiters are served first come first served, a released slot is handed
+    to the oldest waiter directly. slots belong to the event loop of the
+    process, they are not shared between workers. `try_acquire` and
+    `release` may be called from other threads too, e.g. by the hedged
+    attempts of sync workflows.
+    """
+
+    def __init__(self, name: str, **config) -> None:
+        self.name = name
+        self.active = 0
+        self._waiters = deque()
+        # loop of the waiters, slots are handed to them on it
+        self._loop = None
+        self._lock = threading.Lock()
+        self.configure(**config)
+
+    def configure(
+        self,
+        max_concurrency: int,
+        max_queue: int = default_max_queue,
+        queue_timeout_ms: float = default_queue_timeout_ms,
+        retry_after: int = default_retry_after,
+    ) -> None:
+        assert max_concurrency > 0, "max_concurrency should > 0"
+        assert max_queue >= 0, "max_queue should >= 0"
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout_ms / 1000 if queue_timeout_ms else None
+        self.retry_after = retry_after
+        # a raised limit admits waiters right away
+        self._admit_waiters()
+
+    def _admit_waiters(self) -> None:
+        loop = self._loop
+        if loop is not None and not _runs_on(loop):
+            try:
+                loop.call_soon_threadsafe(self._admit_waiters)
+                return
+            except RuntimeError:
+                pass
+        with self._lock:
+            while self._waiters and self.active < self.max_concurrency:
+                if self._grant():
+                    self.active += 1
+
+    def _grant(self) -> bool:
+        """hand a slot to the oldest waiter still waiting"""
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return True
+        return False
+
+    def _reject(self, status_code: int, reason: str) -> Rejected:
+        metrics.admission_rejected_total.inc(self.name, reason)
+        return Rejected(self.name, status_code, reason, self.retry_after)
+
+    def try_acquire(self) -> bool:
+        """take a slot only when one is free right away, never waits"""
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiters:
+                self.active += 1
+                return True
+        return False
+
+    async def acquire(self) -> None:
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiters:
+                self.active += 1
+                return
+            if len(self._waiters) >= self.max_queue:
+                raise self._reject(429, "queue full")
+            self._loop = asyncio.get_running_loop()
+            future = self._loop.create_future()
+            self._waiters.append(future)
+
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # the slot was handed over while timing out, pass it on
+                self.release()
+            else:
+                future.cancel()
+                with self._lock:
+                    try:
+                        self._waiters.remove(future)
+                    except ValueError:
+                        pass
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject(503, "queue timeout") from None
+            raise
+        finally:
+            metrics.admission_wait_seconds.observe(time.perf_counter() - start, self.name)
+
+    def release(self) -> None:
+        loop = self._loop
+        if loop is not None and not _runs_on(loop):
+            try:
+                # waiters may only be woken up on their loop
+                loop.call_soon_threadsafe(self.release)
+                return
+            except RuntimeError:
+                # the loop is closed, nobody waits anymore
+                pass
+        with self._lock:
+            if self.active > self.max_concurrency or not self._grant():
+                self.active -= 1
+
+
+def _runs_on(loop: asyncio.AbstractEventLoop) -> bool:
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class Permit:
+    """Slots held by one request, released once"""
+
+    __slots__ = ("limiters",)
+
+    def __init__(self, limiters: List[ConcurrencyLimiter]) -> None:
+        self.limiters = limiters
+
+    def release(self) -> None:
+        limiters, self.limiters = self.limiters, []
+        for limiter in reversed(limiters):
+            limiter.release()
+
+
+async def admit(limiters: Iterable[ConcurrencyLimiter]) -> Permit:
+    """acquire a slot of every limiter, in order, or none of them
+
+    callers pass limiters in a fixed global order (endpoint first, then
+    models by id), so requests never wait on each other in a cycle
+    """
+    permit = Permit([])
+    try:
+        for limiter in limiters:
+            await limiter.acquire()
+            permit.limiters.append(limiter)
+    except BaseException:
+        permit.release()
+        raise
+    return permit
+
+
+_limiters = {}
+
+
+def configure_limiter(name: str, config: Optional[dict]) -> Optional[ConcurrencyLimiter]:
+    """create or reconfigure the limiter `name`, None without config"""
+    if not config:
+        return None
+    limiter = _limiters.get(name)
+    if limiter is None:
+        limiter = _limiters[name] = ConcurrencyLimiter(name, **config)
+        logger.info("limit %s: %s", name, config)
+    else:
+        limiter.configure(**config)
+    return limiter
+
+
+def get_limiter(name: str) -> Optional[ConcurrencyLimiter]:
+    return _limiters.get(name)
+
+
+def model_limiter_name(model_id: str) -> str:
+    return f"model:{model_id}"
+
+
+def endpoint_limiter_name(path: str) -> str:
+    return f"endpoint:{path}"
+
+
+def configure_model_limits(model_limits: dict) -> None:
+    for model_id, config in (model_limits or {}).items():
+        configure_limiter(model_limiter_name(model_id), config)
@@ -0,0 +1,50 @@
+"""Stop workflow runs nobody waits for anymore
+
+a request carries a deadline (see `Endpoint.get_deadline`), its run is
+cancelled once the deadline passes or the client disconnects, whatever comes
+first. cancelling the task of an async run cancels the model call or stream
+and the session store calls it is awaiting.
+"""
+import asyncio
+from typing import Awaitable
+
+from fastapi import Request
+
+from utils.deadline import Cancelled, Deadline
+
+
+async def wait_for_disconnect(request: Request) -> None:
+    """return once the client is gone, the request body is already read"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_cancellable(run: Awaitable, request: Request, deadline: Deadline):
+    """await `run` unless the client disconnects or the deadline passes first,
+    in which case it is cancelled and `Cancelled` is raised
+    """
+    task = asyncio.ensure_future(run)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait(
+            (task, disconnected),
+            timeout=deadline.remaining(),
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+    except BaseException:
+        task.cancel()
+        raise
+    finally:
+        disconnected.cancel()
+
+    if task not in done:
+        deadline.cancel("disconnect" if disconnected in done else "deadline")
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+        raise Cancelled(deadline.reason)
+    return task.result()
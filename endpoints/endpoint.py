@@ -1,11 +1,33 @@
+import asyncio
 import json
 import logging
-from typing import Generator
+import time
+import weakref
+from typing import AsyncGenerator
 from enum import Enum, unique, auto
 from workflow import WorkflowInstance
-from fastapi import Request, FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import HTTPException, Request, FastAPI
+from fastapi.responses import Response, StreamingResponse
+from fastapi.routing import APIRoute
+from endpoints.admission import (
+    Permit,
+    Rejected,
+    admit,
+    configure_limiter,
+    endpoint_limiter_name,
+    get_limiter,
+    model_limiter_name,
+)
 from endpoints.models import TextRequest
+from endpoints.serialization import dumps
+from endpoints.metrics import get_queue_time
+from endpoints.cancellation import run_cancellable
+from configs.constants import request_timeout_ms
+from utils import metrics
+from utils.deadline import Cancelled, Deadline
+from utils.log import log_payload
+
+logger = logging.getLogger(__name__)
 
 
 @unique
@@ -15,34 +37,118 @@ class EndpointType(Enum):
 
 
 class Endpoint:
+    """Binds a workflow instance to a path
+
+    limits: optional admission control of the endpoint, see
+        `endpoints.admission`. requests also wait for the `model_limits` of
+        the models the workflow calls
+    timeout_ms: deadline of requests, from the time they are received. a
+        request can shorten it by its `config.timeout_ms` or an
+        `X-Request-Timeout-Ms` header. runs are cancelled at the deadline
+        or when the client disconnects
+    """
+
+    timeout_header = "x-request-timeout-ms"
+
     def __init__(self, endpoint_config: dict, wfi: WorkflowInstance = None) -> None:
         self.load_config(endpoint_config, wfi)
 
     def load_config(self, endpoint_config: dict, wfi: WorkflowInstance = None) -> None:
         self.path = endpoint_config.get("path")
         self.wfi = wfi
+        self.limiter = configure_limiter(
+            endpoint_limiter_name(self.path), endpoint_config.get("limits")
+        )
+        self.timeout_ms = endpoint_config.get("timeout_ms", request_timeout_ms)
 
     def set_runnable(self):
         raise NotImplementedError()
 
-    def run_workflow(self, request: Request) -> dict:
+    async def run_workflow(self, request: Request, deadline: Deadline) -> dict:
         raise NotImplementedError()
 
     def wrap_response(self, response: dict) -> dict:
         final_output = response.get("final_output")
-        data = {"content": final_output, "additional_kwargs": response, "type": "ai"}
-        logging.info(f"endpoint response: {json.dumps(data)}")
+        data = {
+            "content": final_output,
+            "additional_kwargs": dict(response),
+            "type": "ai",
+        }
+        log_payload(logger, "endpoint response: %s", data)
         return data
 
-    def handle(self, input: TextRequest, request: Request) -> dict:
-        self.set_runnable()
-        vars = self.run_workflow(input)
-        response = self.wrap_response(vars)
-        return response
+    def observe_queue_time(self, request: Request):
+        queue_time = get_queue_time(request)
+        if queue_time is not None:
+            metrics.request_queue_seconds.observe(queue_time, self.path)
+
+    def get_limiters(self) -> list:
+        limiters = [self.limiter] if self.limiter is not None else []
+        model_ids = self.wfi.model_ids if self.wfi is not None else []
+        for model_id in model_ids:
+            limiter = get_limiter(model_limiter_name(model_id))
+            if limiter is not None:
+                limiters.append(limiter)
+        return limiters
+
+    async def admit(self) -> Permit:
+        """wait for a slot of every limit of the request, shed it when full"""
+        try:
+            return await admit(self.get_limiters())
+        except Rejected as e:
+            logger.warning("shed request to %s, %s", self.path, e)
+            raise e.to_http() from None
+
+    def get_deadline(self, input: TextRequest, request: Request) -> Deadline:
+        timeouts = [self.timeout_ms]
+        try:
+            timeouts.append(float(input.config.get("timeout_ms") or 0))
+            timeouts.append(float(request.headers.get(self.timeout_header) or 0))
+        except (TypeError, ValueError):
+            raise HTTPException(400, detail="invalid request timeout") from None
+        timeouts = [timeout for timeout in timeouts if timeout and timeout > 0]
+        if not timeouts:
+            return Deadline()
+        # time spent queued before reaching the endpoint counts as well
+        received_at = time.monotonic() - (get_queue_time(request) or 0)
+        return Deadline.after(min(timeouts) / 1000, received_at)
+
+    def on_cancelled(self, reason: str) -> None:
+        metrics.requests_cancelled_total.inc(self.path, reason)
+        logger.info("request to %s cancelled, %s", self.path, reason)
+
+    def cancelled_response(self, reason: str) -> Response:
+        self.on_cancelled(reason)
+        if reason == "disconnect":
+            # nobody reads it, 499 as logged by nginx
+            return Response(status_code=499)
+        raise HTTPException(504, detail="deadline exceeded")
+
+    async def run(self, input: TextRequest, deadline: Deadline) -> dict:
+        permit = await self.admit()
+        try:
+            with metrics.request_duration_seconds.time(self.path):
+                self.set_runnable()
+                vars = await self.run_workflow(input, deadline)
+                return self.wrap_response(vars)
+        finally:
+            permit.release()
+
+    async def handle(self, input: TextRequest, request: Request) -> dict:
+        self.observe_queue_time(request)
+        deadline = self.get_deadline(input, request)
+        try:
+            return await run_cancellable(self.run(input, deadline), request, deadline)
+        except Cancelled as e:
+            return self.cancelled_response(e.reason)
 
     def bind(self, app: FastAPI):
         app.add_api_route(self.path, self.handle, methods=["POST"])
 
+    def route(self) -> APIRoute:
+        """a route to `handle`, for swapping into a running app"""
+        return APIRoute(self.path, self.handle, methods=["POST"])
+
     @staticmethod
     def create(endpoint_config: dict, wfi: WorkflowInstance = None):
         endpoint_type = endpoint_config.get("type")
@@ -60,34 +166,178 @@ class SyncEndpoint(Endpoint):
         self.endpoint_type = EndpointType.SYNC
 
     def set_runnable(self):
-        self.runnable = self.wfi.execute
+        self.runnable = self.wfi.aexecute
 
-    def run_workflow(self, request: Request) -> dict:
+    async def run_workflow(self, request: Request, deadline: Deadline) -> dict:
         input_json = json.loads(request.json())
-        global_variables = self.runnable(input_json)
+        global_variables = await self.runnable(input_json, deadline)
         return global_variables
 
 
 class StreamEndpoint(Endpoint):
+    """Streaming endpoint, configured by
+
+    format: ndjson (default) | sse | json
+        ndjson writes one json document per line, sse writes `data: ` events,
+        json writes the documents back to back (legacy, not splittable)
+    coalesce_ms / coalesce_bytes: merge model chunks until this much time has
+        passed or this many bytes are pending, 0 (default) sends every chunk
+    payload: full (default) | delta
+        full sends the whole response with every frame, its content being the
+        new segment, delta only sends the new segment and a sequence number
+        per frame. both end with one final frame (`done: true`) whose content
+        is the complete final output, the only frame when it is not streamed
+    """
+
+    segment_key = "final_output#seg"
+
+    media_types = {
+        "ndjson": "application/x-ndjson",
+        "sse": "text/event-stream",
+        "json": "application/json",
+    }
+
     def __init__(self, endpoint_config: dict, wfi: WorkflowInstance = None) -> None:
         super().__init__(endpoint_config, wfi)
         self.endpoint_type = EndpointType.STREAM
 
+    def load_config(self, endpoint_config: dict, wfi: WorkflowInstance = None) -> None:
+        super().load_config(endpoint_config, wfi)
+        self.stream_format = endpoint_config.get("format", "ndjson")
+        if self.stream_format not in self.media_types:
+            raise ValueError(f"Invalid stream format: {self.stream_format}")
+        self.coalesce_ms = endpoint_config.get("coalesce_ms", 0)
+        self.coalesce_bytes = endpoint_config.get("coalesce_bytes", 0)
+        self.payload_mode = endpoint_config.get("payload", "full")
+        if self.payload_mode not in ("full", "delta"):
+            raise ValueError(f"Invalid stream payload: {self.payload_mode}")
+        self.frame_prefix, self.frame_suffix = {
+            "ndjson": (b"", b"\n"),
+            "sse": (b"data: ", b"\n\n"),
+            "json": (b"", b""),
+        }[self.stream_format]
+
     def set_runnable(self):
-        self.runnable = self.wfi.execute_as_stream
+        self.runnable = self.wfi.aexecute_as_stream
 
-    def run_workflow(self, request: Request) -> Generator:
+    async def run_workflow(self, request: Request, deadline: Deadline) -> AsyncGenerator:
         input_json = json.loads(request.json())
-        for global_variables in self.runnable(input_json):
-            yield self.wrap_response(global_variables)
+        stream = self.runnable(
+            input_json,
+            coalesce_ms=self.coalesce_ms,
+            coalesce_bytes=self.coalesce_bytes,
+            deadline=deadline,
+        )
+        if self.payload_mode == "delta":
+            async for frame in self.delta_frames(stream):
+                yield frame
+            return
+
+        async for global_variables in stream:
+            # frames with neither a new segment nor the final output (chunks of
+            # a variable other than final output) carry nothing new
+            if (
+                self.segment_key in global_variables
+                or "final_output" in global_variables
+            ):
+                yield self.frame(self.wrap_response(global_variables))
+
+    async def delta_frames(self, stream: AsyncGenerator) -> AsyncGenerator:
+        envelope = None
+        seq = 0
+        async for global_variables in stream:
+            segment = global_variables.get(self.segment_key)
+            if segment is None:
+                data = {
+                    "seq": seq,
+                    "done": True,
+                    "content": global_variables.get("final_output"),
+                    "additional_kwargs": dict(global_variables),
+                    "type": "ai",
+                    "is_stream": True,
+                }
+                yield self.frame(dumps(data))
+                continue
+
+            if envelope is None:
+                envelope = self.encode_envelope(global_variables)
+            yield b"".join(
+                [
+                    envelope,
+                    str(seq).encode(),
+                    b',"delta":',
+                    dumps(segment),
+                    b"}",
+                    self.frame_suffix,
+                ]
+            )
+            seq += 1
+
+    def encode_envelope(self, response: dict) -> bytes:
+        """encode the part of delta frames constant over a stream, once"""
+        envelope = dumps(
+            {"type": "ai", "is_stream": True, "session_id": response.get("session_id")}
+        )
+        return self.frame_prefix + envelope[:-1] + b',"seq":'
 
     def wrap_response(self, response: dict):
         data = super().wrap_response(response)
+        # while streaming, frames carry the new segment of final output
+        if self.segment_key in response:
+            data["content"] = response[self.segment_key]
+        else:
+            data["done"] = True
         data["is_stream"] = True
-        return json.dumps(data)
+        return dumps(data)
+
+    def frame(self, payload: bytes) -> bytes:
+        return self.frame_prefix + payload + self.frame_suffix
 
-    def handle(self, input: TextRequest, request: Request):
+    def error_frame(self, error: str) -> bytes:
+        return self.frame(dumps({"type": "error", "error": error, "is_stream": True}))
+
+    async def timed(
+        self, stream: AsyncGenerator, permit: Permit, deadline: Deadline
+    ) -> AsyncGenerator:
+        """frames of `stream` until its end or the deadline, the stream is
+        cancelled by the server when the client disconnects
+        """
+        try:
+            with metrics.request_duration_seconds.time(self.path):
+                while True:
+                    try:
+                        if deadline.expires_at is None:
+                            frame = await stream.__anext__()
+                        else:
+                            frame = await asyncio.wait_for(
+                                stream.__anext__(), deadline.remaining()
+                            )
+                    except StopAsyncIteration:
+                        break
+                    yield frame
+        except (asyncio.TimeoutError, Cancelled):
+            if not deadline.expired():
+                raise
+            # the response already started, end it with an error frame
+            self.on_cancelled("deadline")
+            yield self.error_frame("deadline exceeded")
+        except (asyncio.CancelledError, GeneratorExit):
+            self.on_cancelled("disconnect")
+            raise
+        finally:
+            await stream.aclose()
+            permit.release()
+
+    async def handle(self, input: TextRequest, request: Request):
+        self.observe_queue_time(request)
+        deadline = self.get_deadline(input, request)
+        # admitted before the response starts, so shedding can still be a 429
+        try:
+            permit = await run_cancellable(self.admit(), request, deadline)
+        except Cancelled as e:
+            return self.cancelled_response(e.reason)
         self.set_runnable()
-        return StreamingResponse(
-            self.run_workflow(input), media_type="application/json"
-        )
+        body = self.timed(self.run_workflow(input, deadline), permit, deadline)
+        # a stream dropped before its first frame never runs `timed`
+        weakref.finalize(body, permit.release)
+        return StreamingResponse(body, media_type=self.media_types[self.stream_format])
@@ -0,0 +1,53 @@
+import time
+from typing import Optional
+
+from fastapi import FastAPI, Request, Response
+
+from utils import metrics
+
+
+class RequestTimingMiddleware:
+    """stamp each request with the time it was received, as
+    `request.state.received_at`, to measure how long it waits before its
+    workflow starts. a plain ASGI middleware so streams are not buffered
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+
+def get_queue_time(request: Request) -> Optional[float]:
+    """seconds since the request was received
+    `X-Request-Start` (`t=<epoch in s, ms or us>`) set by a proxy in front of
+    the app takes precedence, so time queued in the proxy is included
+    """
+    header = request.headers.get("x-request-start")
+    if header:
+        try:
+            start = float(header.strip().lstrip("t="))
+        except ValueError:
+            start = None
+        if start is not None:
+            if start > 1e14:
+                start /= 1e6
+            elif start > 1e11:
+                start /= 1e3
+            return max(0.0, time.time() - start)
+    received_at = getattr(request.state, "received_at", None)
+    if received_at is None:
+        return None
+    return time.perf_counter() - received_at
+
+
+async def metrics_handler() -> Response:
+    return Response(metrics.render(), media_type=metrics.content_type)
+
+
+def bind_metrics(app: FastAPI, path: str = "/metrics"):
+    app.add_middleware(RequestTimingMiddleware)
+    app.add_api_route(path, metrics_handler, methods=["GET"], include_in_schema=False)
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from nodes.model_registry import model_registry, ModelRegistry
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ModelBatcher:
+    """Cross-request micro-batching of the invocations of one model
+
+    callers submit their prompt and wait on a future, a collector thread
+    gathers the prompts submitted within `max_wait_ms` of the first one (or
+    until `max_batch_size` are pending) and dispatches them together through
+    the model's `batch`, a bounded concurrent fan-out, then routes each result
+    back to its caller. up to `max_inflight` batches are dispatched at once.
+
+    configured per LLM node through the `batching` field of the node config:
+
+        batching:
+          max_batch_size: 8
+          max_wait_ms: 10
+          max_concurrency: 8   # concurrent calls within a batch
+          max_inflight: 4      # batches dispatched at the same time
+    """
+
+    def __init__(
+        self,
+        llm,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10,
+        max_concurrency: int = 8,
+        max_inflight: int = 4,
+        model_id: str = "",
+    ) -> None:
+        assert max_batch_size > 0, "max batch size should > 0"
+        self.llm = llm
+        self.model_id = model_id
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrency = max_concurrency
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_inflight, thread_name_prefix="model-batch"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="model-batcher", daemon=True
+        )
+        self._thread.start()
+        self.batches = 0
+        self.requests = 0
+
+    def submit(self, prompt) -> Future:
+        future = Future()
+        self._queue.put((prompt, future))
+        return future
+
+    def invoke(self, prompt):
+        return self.submit(prompt).result()
+
+    async def ainvoke(self, prompt):
+        return await asyncio.wrap_future(self.submit(prompt))
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: list):
+        # callers cancelled while waiting (deadline, losing hedge) are dropped
+        batch = [
+            (prompt, future)
+            for prompt, future in batch
+            if future.set_running_or_notify_cancel()
+        ]
+        if not batch:
+            return
+        self.batches += 1
+        self.requests += len(batch)
+        metrics.llm_batch_size.observe(len(batch), self.model_id)
+        prompts = [prompt for prompt, _ in batch]
+        try:
+            results = self.llm.batch(
+                prompts,
+                config={"max_concurrency": self.max_concurrency},
+                return_exceptions=True,
+            )
+        except Exception as e:
+            logger.exception("batch of %s prompts failed", len(batch))
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            try:
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            except Exception:
+                # one caller gone must not leave the others of the batch waiting
+                logger.exception("failed to route the result of a batched call")
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "avg_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "queue_depth": self._queue.qsize(),
+        }
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(model_id: str, model_kwargs: dict, batching_config: dict):
+    """return the process wide batcher of a model and batching config"""
+    key = ModelRegistry.get_key(model_id, model_kwargs) + tuple(
+        sorted(batching_config.items())
+    )
+    batcher = _batchers.get(key)
+    if batcher is None:
+        llm = model_registry.get(model_id, model_kwargs)
+        with _batchers_lock:
+            batcher = _batchers.get(key)
+            if batcher is None:
+                batcher = ModelBatcher(llm, model_id=model_id, **batching_config)
+                _batchers[key] = batcher
+    return batcher
+
+
+def _batch_queue_depths() -> dict:
+    depths = {}
+    for batcher in list(_batchers.values()):
+        key = (batcher.model_id,)
+        depths[key] = depths.get(key, 0) + batcher.stats()["queue_depth"]
+    return depths
+
+
+metrics.llm_batch_queue_depth.set_function(_batch_queue_depths)
@@ -0,0 +1,520 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# error codes of Bedrock meaning "try another model", not "the request is bad"
+failover_error_codes = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+}
+
+
+def is_failover_error(error: BaseException) -> bool:
+    """whether `error` is a throttling or availability error of the model
+    langchain re-raises Bedrock errors as `ValueError`, their chain and
+    message are checked as well
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        response = getattr(error, "response", None)
+        code = response.get("Error", {}).get("Code") if isinstance(response, dict) else None
+        if code in failover_error_codes or type(error).__name__ in failover_error_codes:
+            return True
+        message = str(error)
+        if any(code in message for code in failover_error_codes):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class ModelLatencyStats:
+    """Latencies of the last `window` successful calls of a model
+
+    kept per kind, `ttft` (time to first chunk of streams) and `latency`
+    (whole non streamed invocations)
+    """
+
+    def __init__(self, window: int = 256) -> None:
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(kind)
+            if samples is None:
+                samples = self._samples[kind] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def count(self, kind: str) -> int:
+        return len(self._samples.get(kind, ()))
+
+    def percentile(self, kind: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(kind, ()))
+        if not samples:
+            return None
+        idx = min(len(samples) - 1, max(0, round(q / 100 * (len(samples) - 1))))
+        return samples[idx]
+
+
+_model_stats = {}
+_model_stats_lock = threading.Lock()
+
+
+def get_model_stats(model_id: str) -> ModelLatencyStats:
+    """process wide latency stats of `model_id`"""
+    stats = _model_stats.get(model_id)
+    if stats is None:
+        with _model_stats_lock:
+            stats = _model_stats.get(model_id)
+            if stats is None:
+                stats = _model_stats[model_id] = ModelLatencyStats()
+    return stats
+
+
+class _Slot:
+    """A slot of the `model_limits` of a model held by one attempt, released
+    once
+    """
+
+    __slots__ = ("limiter",)
+
+    def __init__(self, limiter) -> None:
+        self.limiter = limiter
+
+    def release(self) -> None:
+        limiter, self.limiter = self.limiter, None
+        if limiter is not None:
+            limiter.release()
+
+
+def reserve_slot(model_id: str):
+    """a slot of the `model_limits` of `model_id`, None when the model has no
+    limit, False when no slot is free
+    requests are only admitted for the first model of their LLM nodes, hedged
+    and fallback attempts take their own slot, or are not made
+    """
+    from endpoints.admission import get_limiter, model_limiter_name
+
+    limiter = get_limiter(model_limiter_name(model_id))
+    if limiter is None:
+        return None
+    return _Slot(limiter) if limiter.try_acquire() else False
+
+
+class HedgePolicy:
+    """When to fire a backup request at the next model of the list
+
+    configured per LLM node through the `hedging` field of the node config:
+
+        hedging:
+          percentile: 95        # of the latency of the model being waited on
+          min_samples: 20       # below, `default_delay_ms` is used
+          default_delay_ms: 2000
+          min_delay_ms: 100
+          max_delay_ms: 10000
+          max_attempts: 2       # requests in flight at once
+
+    without it, the next model is only tried when one fails over.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        min_samples: int = 20,
+        default_delay_ms: float = 2000,
+        min_delay_ms: float = 100,
+        max_delay_ms: float = 10000,
+        max_attempts: int = 2,
+    ) -> None:
+        assert 0 < percentile <= 100, "percentile should be in (0, 100]"
+        assert max_attempts > 0, "max attempts should > 0"
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay_ms / 1000
+        self.min_delay = min_delay_ms / 1000
+        self.max_delay = max_delay_ms / 1000
+        self.max_attempts = max_attempts
+
+    @staticmethod
+    def create(config: Optional[dict]) -> Optional["HedgePolicy"]:
+        return HedgePolicy(**config) if config else None
+
+    def delay(self, model_id: str, kind: str) -> float:
+        """seconds to wait on `model_id` before hedging"""
+        stats = get_model_stats(model_id)
+        delay = None
+        if stats.count(kind) >= self.min_samples:
+            delay = stats.percentile(kind, self.percentile)
+        if delay is None:
+            delay = self.default_delay
+        return min(self.max_delay, max(self.min_delay, delay))
+
+
+class _Attempts:
+    """Bookkeeping of the attempts of one hedged call, shared by the sync
+    and async runners
+
+    hedged and fallback attempts hold a slot of their model (see
+    `reserve_slot`), released once the attempt is done, or, for streams, once
+    a stream that produced a chunk is closed. a hedge at a model without a
+    free slot is skipped, a fallback goes on to the next model.
+    """
+
+    def __init__(
+        self, model_ids: List[str], policy: Optional[HedgePolicy], kind: str
+    ) -> None:
+        self.model_ids = model_ids
+        self.policy = policy
+        self.kind = kind
+        self.next_idx = 0
+        self.in_flight = {}
+        # handle -> slot held by a hedged or fallback attempt
+        self.slots = {}
+        self.hedging = policy is not None
+        self.last_error = None
+
+    def can_launch(self) -> bool:
+        return self.next_idx < len(self.model_ids)
+
+    def hedge_delay(self) -> Optional[float]:
+        """seconds until the next hedge, None when no hedge can be fired"""
+        if (
+            not self.hedging
+            or not self.can_launch()
+            or len(self.in_flight) >= self.policy.max_attempts
+        ):
+            return None
+        # the oldest attempt still running sets the delay
+        model_id, started = min(self.in_flight.values(), key=lambda item: item[1])
+        elapsed = time.perf_counter() - started
+        return max(0.0, self.policy.delay(model_id, self.kind) - elapsed)
+
+    def _start(self, model_id: str, handle_of: Callable[[str], object], slot):
+        self.next_idx += 1
+        try:
+            handle = handle_of(model_id)
+        except BaseException:
+            if slot is not None:
+                slot.release()
+            raise
+        self.in_flight[handle] = (model_id, time.perf_counter())
+        if slot is not None:
+            self.slots[handle] = slot
+            handle.add_done_callback(self._release_when_done)
+        return handle
+
+    def _release_when_done(self, handle):
+        # the stream of a successful first chunk holds its slot until closed
+        if self.kind != "ttft" or handle.cancelled() or handle.exception() is not None:
+            self.slots[handle].release()
+
+    def launch(self, handle_of: Callable[[str], object]) -> Optional[str]:
+        """launch the first model, it was admitted with the request"""
+        model_id = self.model_ids[self.next_idx]
+        self._start(model_id, handle_of, None)
+        return model_id
+
+    def fail_over(self, handle_of: Callable[[str], object]) -> Optional[str]:
+        """launch the next model with a free slot, None when none is left"""
+        while self.can_launch():
+            model_id = self.model_ids[self.next_idx]
+            slot = reserve_slot(model_id)
+            if slot is False:
+                logger.warning("model %s is at its limit, no fallback to it", model_id)
+                metrics.llm_attempts_skipped_total.inc(model_id)
+                self.next_idx += 1
+                continue
+            self._start(model_id, handle_of, slot)
+            return model_id
+        return None
+
+    def hedge(self, handle_of):
+        waited_on = [model_id for model_id, _ in self.in_flight.values()]
+        model_id = self.model_ids[self.next_idx]
+        slot = reserve_slot(model_id)
+        if slot is False:
+            # never pile extra traffic on a model at its limit
+            logger.info("model %s is at its limit, no hedge of %s", model_id, waited_on)
+            metrics.llm_attempts_skipped_total.inc(model_id)
+            self.hedging = False
+            return
+        self._start(model_id, handle_of, slot)
+        logger.info("no answer of %s yet, hedge with %s", waited_on, model_id)
+        metrics.llm_hedged_total.inc(waited_on[0])
+
+    def finish(self, handle, launch_of) -> Optional[str]:
+        """record the end of an attempt, return its model_id if it succeeded.
+        a failover error launches the next model right away, other errors
+        are raised once no other attempt is left
+        """
+        model_id, started = self.in_flight.pop(handle)
+        error = handle.exception()
+        if error is None:
+            get_model_stats(model_id).observe(self.kind, time.perf_counter() - started)
+            if model_id != self.model_ids[0]:
+                metrics.llm_fallback_won_total.inc(model_id)
+            return model_id
+
+        self.last_error = error
+        if is_failover_error(error):
+            metrics.llm_failover_total.inc(model_id)
+            if self.can_launch():
+                logger.warning("model %s failed over: %s", model_id, error)
+                self.fail_over(launch_of)
+            return None
+        if not self.in_flight:
+            raise error
+        logger.warning("model %s failed, wait for the other attempts: %s", model_id, error)
+        return None
+
+    def exhausted(self) -> BaseException:
+        return self.last_error
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """threads running the attempts of sync hedged calls"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+    return _executor
+
+
+def call(
+    model_ids: List[str], invoke: Callable[[str], object], policy: HedgePolicy = None
+):
+    """`invoke(model_id)` on the first model of `model_ids` answering, return
+    (model_id, result). losers keep running in their thread, their result is
+    dropped
+    """
+    if len(model_ids) == 1:
+        start = time.perf_counter()
+        result = invoke(model_ids[0])
+        get_model_stats(model_ids[0]).observe("latency", time.perf_counter() - start)
+        return model_ids[0], result
+
+    attempts = _Attempts(model_ids, policy, "latency")
+    executor = get_hedge_executor()
+    submit = lambda model_id: executor.submit(invoke, model_id)
+    attempts.launch(submit)
+    while attempts.in_flight:
+        done, _ = wait(
+            attempts.in_flight, timeout=attempts.hedge_delay(), return_when=FIRST_COMPLETED
+        )
+        if not done:
+            attempts.hedge(submit)
+            continue
+        for future in done:
+            model_id = attempts.finish(future, submit)
+            if model_id is not None:
+                for other in attempts.in_flight:
+                    other.cancel()
+                return model_id, future.result()
+    raise attempts.exhausted()
+
+
+async def acall(model_ids: List[str], ainvoke, policy: HedgePolicy = None):
+    """async version of `call`, losers are cancelled"""
+    if len(model_ids) == 1:
+        start = time.perf_counter()
+        result = await ainvoke(model_ids[0])
+        get_model_stats(model_ids[0]).observe("latency", time.perf_counter() - start)
+        return model_ids[0], result
+
+    attempts = _Attempts(model_ids, policy, "latency")
+    create = lambda model_id: asyncio.ensure_future(ainvoke(model_id))
+    attempts.launch(create)
+    try:
+        while attempts.in_flight:
+            done, _ = await asyncio.wait(
+                attempts.in_flight,
+                timeout=attempts.hedge_delay(),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                attempts.hedge(create)
+                continue
+            for task in done:
+                model_id = attempts.finish(task, create)
+                if model_id is not None:
+                    return model_id, task.result()
+        raise attempts.exhausted()
+    finally:
+        for task in attempts.in_flight:
+            task.cancel()
+
+
+def _first_chunk(stream: Iterator):
+    """open `stream` and wait for its first chunk, None if it is empty"""
+    stream = iter(stream)
+    try:
+        return stream, next(stream)
+    except StopIteration:
+        return stream, None
+
+
+def _observe_first(model_id: str, stream: Iterator) -> Iterator:
+    start = time.perf_counter()
+    try:
+        for chunk in stream:
+            if start is not None:
+                get_model_stats(model_id).observe("ttft", time.perf_counter() - start)
+                start = None
+            yield chunk
+    finally:
+        stream.close()
+
+
+def _chain(first, stream: Iterator, slot: Optional[_Slot] = None) -> Iterator:
+    try:
+        if first is not None:
+            yield first
+        yield from stream
+    finally:
+        stream.close()
+        if slot is not None:
+            slot.release()
+
+
+def _close_when_done(slot: Optional[_Slot], future):
+    if not future.cancelled() and future.exception() is None:
+        future.result()[0].close()
+    if slot is not None:
+        slot.release()
+
+
+def open_stream(
+    model_ids: List[str], open: Callable[[str], Iterator], policy: HedgePolicy = None
+) -> Tuple[str, Iterator]:
+    """open the streams of `open(model_id)`, return (model_id, chunks) of the
+    first stream producing a chunk. once a stream produced a chunk it is
+    never switched, later errors are raised as is
+    """
+    if len(model_ids) == 1:
+        return model_ids[0], _observe_first(model_ids[0], open(model_ids[0]))
+
+    attempts = _Attempts(model_ids, policy, "ttft")
+    executor = get_hedge_executor()
+    submit = lambda model_id: executor.submit(_first_chunk, open(model_id))
+    attempts.launch(submit)
+    while attempts.in_flight:
+        done, _ = wait(
+            attempts.in_flight, timeout=attempts.hedge_delay(), return_when=FIRST_COMPLETED
+        )
+        if not done:
+            attempts.hedge(submit)
+            continue
+        for future in done:
+            model_id = attempts.finish(future, submit)
+            if model_id is not None:
+                # losers still waiting for their first chunk are closed after it
+                for other in attempts.in_flight:
+                    other.add_done_callback(
+                        functools.partial(_close_when_done, attempts.slots.get(other))
+                    )
+                stream, first = future.result()
+                return model_id, _chain(first, stream, attempts.slots.get(future))
+    raise attempts.exhausted()
+
+
+async def _afirst_chunk(stream: AsyncIterator):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def _aobserve_first(model_id: str, stream: AsyncIterator) -> AsyncIterator:
+    start = time.perf_counter()
+    try:
+        async for chunk in stream:
+            if start is not None:
+                get_model_stats(model_id).observe("ttft", time.perf_counter() - start)
+                start = None
+            yield chunk
+    finally:
+        await stream.aclose()
+
+
+async def _achain(
+    first, stream: AsyncIterator, slot: Optional[_Slot] = None
+) -> AsyncIterator:
+    try:
+        if first is not None:
+            yield first
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.aclose()
+        if slot is not None:
+            slot.release()
+
+
+async def aopen_stream(
+    model_ids: List[str], open: Callable[[str], AsyncIterator], policy: HedgePolicy = None
+) -> Tuple[str, AsyncIterator]:
+    """async version of `open_stream`, losers are cancelled"""
+    if len(model_ids) == 1:
+        return model_ids[0], _aobserve_first(model_ids[0], open(model_ids[0]))
+
+    attempts = _Attempts(model_ids, policy, "ttft")
+    streams = {}
+
+    def create(model_id):
+        stream = open(model_id)
+        task = asyncio.ensure_future(_afirst_chunk(stream))
+        streams[task] = stream
+        return task
+
+    attempts.launch(create)
+    try:
+        while attempts.in_flight:
+            done, _ = await asyncio.wait(
+                attempts.in_flight,
+                timeout=attempts.hedge_delay(),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                attempts.hedge(create)
+                continue
+            for task in done:
+                stream = streams.pop(task)
+                model_id = attempts.finish(task, create)
+                if model_id is not None:
+                    return model_id, _achain(
+                        task.result(), stream, attempts.slots.get(task)
+                    )
+                await stream.aclose()
+        raise attempts.exhausted()
+    finally:
+        for task in attempts.in_flight:
+            task.cancel()
+        for task in attempts.in_flight:
+            try:
+                await task
+            except BaseException:
+                pass
+            await streams.pop(task).aclose()
+            slot = attempts.slots.get(task)
+            if slot is not None:
+                slot.release()
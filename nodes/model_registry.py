@@ -0,0 +1,140 @@
+import asyncio
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import boto3
+from botocore.config import Config
+from langchain_community.chat_models import BedrockChat
+from langchain_community.embeddings import BedrockEmbeddings
+
+from configs.constants import model_registry_max_size, model_max_pool_connections
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """Process wide pool of reusable model clients
+
+    clients are keyed by model_id and their model parameters and kept in a
+    bounded LRU, all of them share one `bedrock-runtime` boto3 client whose
+    connection pool keeps its connections alive between requests, so the
+    session setup, credential resolution and TLS handshake are paid once per
+    process instead of once per request.
+    """
+
+    def __init__(
+        self,
+        max_size: int = model_registry_max_size,
+        max_pool_connections: int = model_max_pool_connections,
+    ) -> None:
+        assert max_size > 0, "size of model registry should > 0"
+        self.max_size = max_size
+        self.max_pool_connections = max_pool_connections
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._bedrock_client = None
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    @staticmethod
+    def get_key(model_id: str, model_kwargs: dict = None) -> tuple:
+        return model_id, json.dumps(model_kwargs or {}, sort_keys=True)
+
+    def get_bedrock_client(self):
+        with self._lock:
+            if self._bedrock_client is None:
+                config = Config(
+                    max_pool_connections=self.max_pool_connections,
+                    tcp_keepalive=True,
+                    retries={"mode": "adaptive"},
+                )
+                self._bedrock_client = boto3.Session().client(
+                    "bedrock-runtime", config=config
+                )
+            return self._bedrock_client
+
+    def create_model(self, model_id: str, model_kwargs: dict = None):
+        return BedrockChat(
+            model_id=model_id,
+            model_kwargs=model_kwargs,
+            client=self.get_bedrock_client(),
+        )
+
+    def create_embeddings(self, model_id: str, model_kwargs: dict = None):
+        return BedrockEmbeddings(
+            model_id=model_id,
+            model_kwargs=model_kwargs,
+            client=self.get_bedrock_client(),
+        )
+
+    def _lookup(self, key: tuple):
+        with self._lock:
+            llm = self._clients.get(key)
+            if llm is not None:
+                self._clients.move_to_end(key)
+                self.reused += 1
+                metrics.model_clients_total.inc("reused")
+            return llm
+
+    def _register(self, key: tuple, llm):
+        with self._lock:
+            existing = self._clients.get(key)
+            if existing is not None:
+                # another caller created the same client concurrently
+                self._clients.move_to_end(key)
+                self.reused += 1
+                metrics.model_clients_total.inc("reused")
+                return existing
+
+            self._clients[key] = llm
+            self.created += 1
+            metrics.model_clients_total.inc("created")
+            while len(self._clients) > self.max_size:
+                evicted_key, _ = self._clients.popitem(last=False)
+                self.evicted += 1
+                metrics.model_clients_total.inc("evicted")
+                logger.info("evict model client: %s", evicted_key)
+            return llm
+
+    def get(self, model_id: str, model_kwargs: dict = None):
+        key = self.get_key(model_id, model_kwargs)
+        llm = self._lookup(key)
+        if llm is not None:
+            return llm
+
+        # build outside of the lock, creating a client may be slow
+        logger.info("create model client: %s", key)
+        return self._register(key, self.create_model(model_id, model_kwargs))
+
+    def get_embeddings(self, model_id: str, model_kwargs: dict = None):
+        """embedding model client, pooled with the chat models"""
+        key = ("embeddings",) + self.get_key(model_id, model_kwargs)
+        embeddings = self._lookup(key)
+        if embeddings is not None:
+            return embeddings
+        logger.info("create embeddings client: %s", key)
+        return self._register(key, self.create_embeddings(model_id, model_kwargs))
+
+    async def aget(self, model_id: str, model_kwargs: dict = None):
+        llm = self._lookup(self.get_key(model_id, model_kwargs))
+        if llm is not None:
+            return llm
+        return await asyncio.to_thread(self.get, model_id, model_kwargs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.created + self.reused
+            return {
+                "size": len(self._clients),
+                "created": self.created,
+                "reused": self.reused,
+                "evicted": self.evicted,
+                "reuse_ratio": self.reused / total if total else 0.0,
+            }
+
+
+model_registry = ModelRegistry()
@@ -4,7 +4,8 @@ from nodes.node.node_base import NodeBase
 class End(NodeBase):
     """End Node will always be the last node of a Vulcan workflow
     it takes a mandatory parameter `final_output` as input
-
+    when `final_output` references a streamed variable, End passes its
+    deltas through while streaming
     """
 
     node_name = "End"
@@ -16,13 +17,15 @@ class End(NodeBase):
         final_output = config.get("final_output")
         assert final_output
         self.final_output = final_output
+        self.stream_passthrough = bool(self._get_var_name(final_output))
+
+    def parse_node_input(self, config) -> list:
+        var_name = self._get_var_name(self.final_output)
+        return [var_name] if var_name else []
 
     def parse_node_output(self, config):
         return ["final_output"]
 
-    def execute(self, global_variables: dict, streaming_input=False) -> list:
-        if streaming_input:
-            final_output = "#".join([final_output, "seg"])
-
+    def execute(self, global_variables: dict) -> list:
         final_output_val = self._get_input(self.final_output, global_variables)
         return [final_output_val]
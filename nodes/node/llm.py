@@ -1,16 +1,34 @@
-from typing import Generator
+from typing import AsyncGenerator, Generator
 import logging
+import re
+import time
 
 from nodes.node.node_base import NodeBase
-from langchain_community.chat_models import BedrockChat
-from langchain_core.prompts import ChatPromptTemplate
+from nodes.model_registry import model_registry
+from nodes import hedging
+from nodes.hedging import HedgePolicy
+from nodes.batcher import get_batcher
+from nodes.response_cache import ResponseCache
+from utils import metrics
+from utils.log import log_payload
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+logger = logging.getLogger(__name__)
 
 
 class LLM(NodeBase):
     """LLM node
     it takes 2 inputs
-    1. model_id
+    1. model_id: a model, or an ordered list of models falling back to the
+       next one when throttled or unavailable
     2. prompts: list of prompt that injected to model before feed into user input
+    and optional `model_kwargs` passed to the model, clients are shared per
+    (model_id, model_kwargs) through the process wide model registry
+    and optional `cache` config enabling a response cache, see `ResponseCache`
+    and optional `batching` config batching invocations across requests, see
+    `ModelBatcher`
+    and optional `hedging` config firing a backup request at the next model
+    when the first one is slow to answer, see `HedgePolicy`
 
     Args:
         NodeBase (_type_): _description_
@@ -18,6 +36,9 @@ class LLM(NodeBase):
 
     node_name = "LLM"
     as_streamer = True
+    history_variable = "_history"
+    # cached responses are replayed to streams as chunks of words
+    replay_pattern = re.compile(r"\S+\s*|\s+")
 
     def __init__(self, next, config) -> None:
         super().__init__(next, config)
@@ -25,52 +46,228 @@ class LLM(NodeBase):
     def parse_node_config(self, config):
         model_id = config.get("model_id")
         prompts = config.get("prompts")
-        assert model_id and prompts
-        self.model_id = model_id
+        model_ids = list(model_id) if isinstance(model_id, list) else [model_id]
+        assert all(model_ids) and prompts
+        self.model_id = model_ids[0]
+        self.fallback_model_ids = model_ids[1:]
         self.prompts = prompts
         self.use_history = config.get("use_history")
+        self.model_kwargs = config.get("model_kwargs")
+        self.prompt_template = self.compile_prompts(self.prompts, self.use_history)
+        cache_config = config.get("cache")
+        self.cache = ResponseCache.create(cache_config) if cache_config else None
+        self.batching = config.get("batching")
+        self.hedging = HedgePolicy.create(config.get("hedging"))
+
+    def parse_node_input(self, config) -> list:
+        input_variables = list(self.prompt_template.input_variables)
+        for model_id in [self.model_id] + self.fallback_model_ids:
+            model_var = self._get_var_name(model_id)
+            if model_var:
+                input_variables.append(model_var)
+        if self.use_history:
+            input_variables.append(self.history_variable)
+        return input_variables
+
+    def optional_inputs(self) -> list:
+        # history is an optional placeholder, a workflow may have no memory
+        return [self.history_variable]
+
+    def model_ids(self) -> list:
+        # a model picked by a variable is only known at run time, fallbacks
+        # are only called now and then, they take a slot of their model when
+        # called, see `hedging.reserve_slot`
+        return [] if self._get_var_name(self.model_id) else [self.model_id]
+
+    def resolve_model_ids(self, global_variables: dict) -> list:
+        """the models of this run, in fallback order"""
+        return [
+            self._get_input(model_id, global_variables)
+            for model_id in [self.model_id] + self.fallback_model_ids
+        ]
 
     def get_model(self, model_id):
-        llm = BedrockChat(model_id=model_id)
-        return llm
+        return model_registry.get(model_id, self.model_kwargs)
+
+    async def aget_model(self, model_id):
+        return await model_registry.aget(model_id, self.model_kwargs)
 
-    def get_prompts(self, prompts, history=None):
+    def compile_prompts(self, prompts, use_history=False) -> ChatPromptTemplate:
+        """compile the static part of the prompts once at load time
+        history messages are filled into a placeholder right before the last
+        prompt, and are never parsed as templates themselves
+        """
         prompt_messages = []
         for prompt_config in prompts:
             role = prompt_config.get("role")
             prompt = prompt_config.get("prompt")
             prompt_messages.append((role, prompt))
 
-        if history:
-            for message in history:
-                role = message.get("role")
-                content = message.get("content")
-                prompt_messages.insert(-1, (role, content))
+        if use_history:
+            prompt_messages.insert(
+                len(prompt_messages) - 1,
+                MessagesPlaceholder(self.history_variable, optional=True),
+            )
 
         return ChatPromptTemplate.from_messages(prompt_messages)
 
-    def execute(self, global_variables: dict, streaming_input: bool = False) -> list:
-        if streaming_input:
-            return super().execute(global_variables, streaming_input)
+    def render_prompt(self, global_variables: dict):
+        """render the prompt of current request
+        `format_prompt` skips the runnable/callback machinery of `invoke`
+        """
+        prompt_str = self.prompt_template.format_prompt(**global_variables)
+        log_payload(logger, "prompt: %s", prompt_str)
+        return prompt_str
 
-        model_id = self._get_input(self.model_id, global_variables)
-        llm = self.get_model(model_id)
-        if self.use_history:
-            prompt = self.get_prompts(self.prompts, global_variables.get("_history"))
-        else:
-            prompt = self.get_prompts(self.prompts)
-        prompt_str = prompt.invoke(global_variables)
-        logging.info(f"prompt: {prompt_str}")
-        return [llm.invoke(prompt_str).content.strip()]
+    def invoke_model(self, model_id: str, prompt_str):
+        with metrics.llm_duration_seconds.time(model_id):
+            if self.batching:
+                batcher = get_batcher(model_id, self.model_kwargs, self.batching)
+                return batcher.invoke(prompt_str)
+            return self.get_model(model_id).invoke(prompt_str)
+
+    async def ainvoke_model(self, model_id: str, prompt_str):
+        with metrics.llm_duration_seconds.time(model_id):
+            if self.batching:
+                batcher = get_batcher(model_id, self.model_kwargs, self.batching)
+                return await batcher.ainvoke(prompt_str)
+            llm = await self.aget_model(model_id)
+            return await llm.ainvoke(prompt_str)
+
+    @staticmethod
+    def observe_first_chunk(model_id: str, start: float) -> float:
+        first_chunk_at = time.perf_counter()
+        metrics.llm_time_to_first_token_seconds.observe(first_chunk_at - start, model_id)
+        return first_chunk_at
+
+    @staticmethod
+    def observe_stream_rate(model_id: str, first_chunk_at: float, n_chunks: int):
+        elapsed = time.perf_counter() - first_chunk_at if first_chunk_at else 0
+        if n_chunks > 1 and elapsed > 0:
+            metrics.llm_tokens_per_second.observe((n_chunks - 1) / elapsed, model_id)
+
+    def get_cache_key(self, model_id: str, prompt_str):
+        if self.cache is None:
+            return None
+        return ResponseCache.get_key(
+            model_id, prompt_str.to_string(), self.model_kwargs
+        )
+
+    def get_cached(self, cache_key):
+        if cache_key is None:
+            return None
+        return self.cache.get(cache_key)
+
+    def set_cached(self, cache_key, output: str):
+        if cache_key is not None:
+            self.cache.set(cache_key, output)
+
+    async def aget_cached(self, cache_key):
+        if cache_key is None:
+            return None
+        return await self.cache.aget(cache_key)
+
+    async def aset_cached(self, cache_key, output: str):
+        if cache_key is not None:
+            await self.cache.aset(cache_key, output)
+
+    def replay_chunks(self, output: str) -> list:
+        """split a cached response into synthetic stream chunks"""
+        return self.replay_pattern.findall(output)
+
+    async def astream_model(self, model_id: str, prompt_str) -> AsyncGenerator:
+        llm = await self.aget_model(model_id)
+        stream = llm.astream(prompt_str)
+        try:
+            async for message in stream:
+                yield message
+        finally:
+            await stream.aclose()
+
+    def execute(self, global_variables: dict) -> list:
+        model_ids = self.resolve_model_ids(global_variables)
+        prompt_str = self.render_prompt(global_variables)
+        # cached per first model, whichever model answered
+        cache_key = self.get_cache_key(model_ids[0], prompt_str)
+        cached = self.get_cached(cache_key)
+        if cached is not None:
+            return [cached]
+
+        _, message = hedging.call(
+            model_ids, lambda model_id: self.invoke_model(model_id, prompt_str), self.hedging
+        )
+        output = message.content.strip()
+        self.set_cached(cache_key, output)
+        return [output]
 
     def execute_as_stream(self, global_variables: dict) -> Generator:
-        model_id = self._get_input(self.model_id, global_variables)
-        llm = self.get_model(model_id)
-        if self.use_history:
-            prompt = self.get_prompts(self.prompts, global_variables.get("_history"))
-        else:
-            prompt = self.get_prompts(self.prompts)
-        prompt_str = prompt.invoke(global_variables)
-        logging.info(f"prompt: {prompt_str}")
-        for message in llm.stream(prompt_str):
-            yield [message.content]
+        model_ids = self.resolve_model_ids(global_variables)
+        prompt_str = self.render_prompt(global_variables)
+        cache_key = self.get_cache_key(model_ids[0], prompt_str)
+        cached = self.get_cached(cache_key)
+        if cached is not None:
+            for chunk in self.replay_chunks(cached):
+                yield [chunk]
+            return
+
+        chunks = []
+        start, first_chunk_at = time.perf_counter(), None
+        model_id, stream = hedging.open_stream(
+            model_ids,
+            lambda model_id: self.get_model(model_id).stream(prompt_str),
+            self.hedging,
+        )
+        try:
+            for message in stream:
+                if first_chunk_at is None:
+                    first_chunk_at = self.observe_first_chunk(model_id, start)
+                chunks.append(message.content)
+                yield [message.content]
+        finally:
+            # a cancelled run closes the model stream, no more tokens are read
+            stream.close()
+        self.observe_stream_rate(model_id, first_chunk_at, len(chunks))
+        self.set_cached(cache_key, "".join(chunks).strip())
+
+    async def aexecute(self, global_variables: dict) -> list:
+        model_ids = self.resolve_model_ids(global_variables)
+        prompt_str = self.render_prompt(global_variables)
+        cache_key = self.get_cache_key(model_ids[0], prompt_str)
+        cached = await self.aget_cached(cache_key)
+        if cached is not None:
+            return [cached]
+
+        _, message = await hedging.acall(
+            model_ids, lambda model_id: self.ainvoke_model(model_id, prompt_str), self.hedging
+        )
+        output = message.content.strip()
+        await self.aset_cached(cache_key, output)
+        return [output]
+
+    async def aexecute_as_stream(self, global_variables: dict) -> AsyncGenerator:
+        model_ids = self.resolve_model_ids(global_variables)
+        prompt_str = self.render_prompt(global_variables)
+        cache_key = self.get_cache_key(model_ids[0], prompt_str)
+        cached = await self.aget_cached(cache_key)
+        if cached is not None:
+            for chunk in self.replay_chunks(cached):
+                yield [chunk]
+            return
+
+        chunks = []
+        start, first_chunk_at = time.perf_counter(), None
+        model_id, stream = await hedging.aopen_stream(
+            model_ids,
+            lambda model_id: self.astream_model(model_id, prompt_str),
+            self.hedging,
+        )
+        try:
+            async for message in stream:
+                if first_chunk_at is None:
+                    first_chunk_at = self.observe_first_chunk(model_id, start)
+                chunks.append(message.content)
+                yield [message.content]
+        finally:
+            await stream.aclose()
+        self.observe_stream_rate(model_id, first_chunk_at, len(chunks))
+        await self.aset_cached(cache_key, "".join(chunks).strip())
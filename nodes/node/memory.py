@@ -1,26 +1,126 @@
+import asyncio
+from typing import List, Optional
+
 from nodes.node.node_base import NodeBase
+from nodes.summarizer import HistorySummarizer
 from dao.session import SessionDAO
+from utils.tokens import count_message_tokens
 
 
 class Memory(NodeBase):
+    """Memory node, the history of the session for LLM nodes with `use_history`
+
+    modes:
+    1. `last_n` (or empty): the latest `n` messages
+    2. `token_budget`: as many of the latest `n` messages as fit in `budget`
+       tokens
+    3. `summary`: the latest `n` messages, fit in `budget` tokens when set,
+       after a rolling summary of the older ones, see `HistorySummarizer`
+       for the `summary` config. older messages not summarized yet are kept
+       before the window until they are folded
+
+    with `budget` set the history never starts with a reply whose question
+    did not fit.
+    """
+
     node_name = "memory"
+    modes = ("", "last_n", "token_budget", "summary")
 
     def __init__(self, next_node, config) -> None:
         super().__init__(next_node, config)
         self.session_dao = SessionDAO()
 
     def parse_node_config(self, config):
-        self.mode = config["mode"]
+        self.mode = config.get("mode") or ""
+        if self.mode not in self.modes:
+            raise ValueError(f"mode of memory should be one of {self.modes}")
         self.n = config["n"]
         assert self.n >= 0, "# of historical message should >= 0"
+        self.budget = config.get("budget", 0)
+        if self.mode == "token_budget":
+            assert self.budget > 0, "budget of memory should > 0"
+        self.summarizer = None
+        if self.mode == "summary":
+            assert config.get("summary"), "summary of memory should be set"
+            self.summarizer = HistorySummarizer.create(config["summary"])
+
+    def parse_node_input(self, config) -> list:
+        return ["session_id"]
 
     def parse_node_output(self, config) -> list:
         return ["_history"]
 
-    def execute(self, global_variables: dict, streaming_input: bool = False) -> list:
-        if streaming_input:
-            return super().execute(global_variables, streaming_input)
+    @staticmethod
+    def fit_budget(messages: List[dict], budget: int) -> List[dict]:
+        """the latest messages within `budget` tokens"""
+        start = len(messages)
+        used = 0
+        while start > 0:
+            used += count_message_tokens(messages[start - 1])
+            if used > budget:
+                break
+            start -= 1
+        if 0 < start < len(messages) and messages[start]["role"] != "user":
+            start += 1
+        return messages[start:]
+
+    def load_history(self, session_id: str) -> List[dict]:
+        if self.summarizer is not None:
+            return self.load_summarized_history(session_id)
+        history = self.session_dao.get_latest_n_messages(session_id, self.n)
+        if self.budget:
+            history = self.fit_budget(history, self.budget)
+        return history
+
+    @staticmethod
+    def summary_message(summary: Optional[dict]) -> Optional[dict]:
+        if not summary or not summary["content"]:
+            return None
+        return {
+            "content": f"Summary of the earlier conversation:\n{summary['content']}",
+            "role": "system",
+        }
+
+    def load_summarized_history(self, session_id: str) -> List[dict]:
+        """the window, after the summary and the messages that left the window
+        and are not summarized yet (the backlog), handed to the summarizer
+        """
+        records = self.session_dao.get_latest_n_records(
+            session_id, self.n + self.summarizer.max_fold
+        )
+        summary = self.summarizer.get(session_id)
+        until = summary["until"] if summary else 0
+        unsummarized = [record for record in records if record["timestamp"] > until]
+
+        summary_message = self.summary_message(summary)
+        window = unsummarized[-self.n :] if self.n else []
+        if self.budget:
+            budget = self.budget
+            if summary_message is not None:
+                budget -= count_message_tokens(summary_message)
+            window = self.fit_budget(window, max(budget, 0))
+        backlog = unsummarized[: len(unsummarized) - len(window)]
+
+        folded = self.summarizer.update(session_id, backlog)
+        if folded is not None:
+            summary_message = self.summary_message(folded)
+            backlog = [
+                record for record in backlog if record["timestamp"] > folded["until"]
+            ]
+        history = [
+            {"content": record["content"], "role": record["role"]}
+            for record in backlog + window
+        ]
+        if summary_message is not None:
+            history = [summary_message] + history
+        return history
+
+    def execute(self, global_variables: dict) -> list:
+        session_id = global_variables.get("session_id")
+        return [self.load_history(session_id)]
 
+    async def aexecute(self, global_variables: dict) -> list:
         session_id = global_variables.get("session_id")
-        chat_history = self.session_dao.get_latest_n_messages(session_id, self.n)
+        # cosmos sdk is blocking, keep it off the event loop
+        chat_history = await asyncio.to_thread(self.load_history, session_id)
         return [chat_history]
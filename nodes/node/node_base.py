@@ -1,5 +1,6 @@
 import json
-from typing import Generator
+from typing import AsyncGenerator, Generator, Optional
+
 
 
 class INode:
@@ -14,14 +15,33 @@ class INode:
 
 
 class NodeBase(INode):
+    """Base of all nodes
+
+    nodes placed after the streamer of a workflow take part in streaming in
+    one of three ways:
+    1. pass-through (`stream_passthrough`): each output forwards the deltas of
+       the matching variable in `passthrough_inputs` unchanged, the node
+       itself is never called while streaming
+    2. delta (`accepts_deltas`): `execute_delta` is called with the new
+       segments of its inputs and decides when and what to emit
+    3. default: the node runs once, by `execute`, after the stream finished
+    """
+
     node_name = "undefined"
+    # id of the node within its workflow, set when the workflow is loaded
+    node_id = None
     as_streamer = False
+    stream_passthrough = False
+    accepts_deltas = False
 
     def __init__(self, next_node, config) -> None:
         self.next_node = next_node
         self.config = json.dumps(config)
         self.parse_node_config(config)
         self.output_mappings = self.parse_node_output(config)
+        self.input_variables = self.parse_node_input(config)
+        # `$var` references of the inputs resolved to their names once
+        self.input_refs = {"$" + var_name: var_name for var_name in self.input_variables}
 
     def parse_node_config(self, config: dict) -> None:
         """read node configurations into attribute of node"""
@@ -34,21 +54,65 @@ class NodeBase(INode):
             assert output_mappings
         return output_mappings
 
+    def parse_node_input(self, config) -> list:
+        """names of the global variables read by this node
+        used by tree workflows to infer the dependencies between nodes
+        """
+        return []
+
+    def optional_inputs(self) -> list:
+        """input variables the node can do without, they do not need to be
+        produced by any node
+        """
+        return []
+
+    def model_ids(self) -> list:
+        """ids of the models the node calls, as far as known before running"""
+        return []
+
+    @staticmethod
+    def _get_var_name(var):
+        """return the variable name of a `$var` reference, None for literals"""
+        if isinstance(var, str) and var.startswith("$"):
+            return var.lstrip("$")
+        return None
+
     def _get_input(self, var: str, global_variables: dict):
-        if var.startswith("$"):
-            var_name = var.lstrip("$")
-            if var_name not in global_variables:
-                raise RuntimeError(
-                    f"variable `{var_name}` not found in global variables"
-                )
-            return global_variables.get(var_name)
-        return var
+        var_name = self.input_refs.get(var) or self._get_var_name(var)
+        if var_name is None:
+            return var
+        try:
+            return global_variables[var_name]
+        except KeyError:
+            raise RuntimeError(
+                f"variable `{var_name}` not found in global variables"
+            ) from None
 
-    def execute(self, global_variables: dict, streaming_input: bool = False) -> list:
+    def passthrough_inputs(self) -> list:
+        """input variable forwarded to each output of a pass-through node"""
+        return self.input_variables
+
+    def execute(self, global_variables: dict) -> list:
+        raise NotImplementedError()
+
+    def execute_delta(self, global_variables: dict, deltas: dict) -> Optional[list]:
+        """handle new segments `{var_name: segment}` of streamed inputs
+        return the output deltas to emit now, or None to emit nothing yet
+        """
         raise NotImplementedError()
 
     def execute_as_stream(self, global_variables: dict) -> Generator:
         raise NotImplementedError()
 
+    async def aexecute(self, global_variables: dict) -> list:
+        """async version of `execute`
+        defaults to the sync implementation, nodes doing I/O should override it
+        so the event loop is never blocked
+        """
+        return self.execute(global_variables)
+
+    def aexecute_as_stream(self, global_variables: dict) -> AsyncGenerator:
+        raise NotImplementedError()
+
     def next(self, global_variables: dict) -> INode:
         return self.next_node
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+
+from nodes.node.node_base import NodeBase
+from nodes.model_registry import model_registry
+from retrieval import get_index
+from utils import metrics
+from utils.log import log_payload
+
+logger = logging.getLogger(__name__)
+
+
+class Retrieval(NodeBase):
+    """Retrieval node, the documents of an embedding index most similar to
+    a query, see `retrieval.VectorIndex` and `vulcan.py index` building it
+
+        - Retrieval:
+            index: indexes/docs
+            query: $input
+            top_k: 4
+            min_score: 0.2        # optional
+            filter:               # optional, metadata field -> value or list
+              lang: en            # of values, values may be $variables
+              tenant: $tenant
+            embedding_model_id: amazon.titan-embed-text-v1  # optional,
+            model_kwargs: {}      # defaults to the model of the index
+            template: "{text}"    # optional, format of each document
+            output_mappings: [context, documents]
+
+    the first output is the text of the documents, best first, for a prompt,
+    the optional second one the documents with their id, score and metadata.
+    """
+
+    node_name = "Retrieval"
+    separator = "\n\n"
+
+    def parse_node_config(self, config):
+        self.index_path = config["index"]
+        self.query = config.get("query", "$input")
+        self.top_k = config.get("top_k", 4)
+        assert self.top_k > 0, "top_k should > 0"
+        self.min_score = config.get("min_score")
+        self.filter = config.get("filter") or {}
+        self.template = config.get("template", "{text}")
+        self.model_kwargs = config.get("model_kwargs")
+        # fail at load time on a missing index
+        index = get_index(self.index_path)
+        self.embedding_model_id = config.get("embedding_model_id") or index.model_id
+        assert self.embedding_model_id, "embedding_model_id should be set"
+
+    def parse_node_output(self, config) -> list:
+        output_mappings = super().parse_node_output(config)
+        assert len(output_mappings) <= 2, "retrieval has at most 2 outputs"
+        return output_mappings
+
+    def parse_node_input(self, config) -> list:
+        input_variables = []
+        for var in [self.query] + list(self.filter.values()):
+            var_name = self._get_var_name(var)
+            if var_name:
+                input_variables.append(var_name)
+        return input_variables
+
+    def resolve_filter(self, global_variables: dict) -> dict:
+        return {
+            field: self._get_input(value, global_variables)
+            if isinstance(value, str)
+            else value
+            for field, value in self.filter.items()
+        }
+
+    def retrieve(self, global_variables: dict) -> list:
+        query = self._get_input(self.query, global_variables)
+        index = get_index(self.index_path)
+        embeddings = model_registry.get_embeddings(
+            self.embedding_model_id, self.model_kwargs
+        )
+        with metrics.retrieval_duration_seconds.time(self.index_path, "embed"):
+            vector = embeddings.embed_query(str(query))
+        with metrics.retrieval_duration_seconds.time(self.index_path, "search"):
+            rows = None
+            if self.filter:
+                rows = index.filter_rows(self.resolve_filter(global_variables))
+            scores, rows = index.search([vector], self.top_k, rows)
+
+        documents = []
+        for score, row in zip(scores[0].tolist(), rows[0].tolist()):
+            if self.min_score is not None and score < self.min_score:
+                break
+            document = index.document(row)
+            document["score"] = score
+            documents.append(document)
+        log_payload(logger, "retrieved: %s", documents)
+
+        context = self.separator.join(
+            self.template.format(rank=rank + 1, **document)
+            for rank, document in enumerate(documents)
+        )
+        return [context, documents][: len(self.output_mappings)]
+
+    def execute(self, global_variables: dict) -> list:
+        return self.retrieve(global_variables)
+
+    async def aexecute(self, global_variables: dict) -> list:
+        # embedding call and search both block, keep them off the event loop
+        return await asyncio.to_thread(self.retrieve, global_variables)
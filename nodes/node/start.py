@@ -12,6 +12,10 @@ class Start(NodeBase):
         assert output_mappings
         return {"output_mappings": output_mappings}
 
-    def execute(self, global_variables: dict, streaming_input=False):
+    def parse_node_input(self, config) -> list:
+        # request variables are copied to the outputs of the same name
+        return list(self.output_mappings)
+
+    def execute(self, global_variables: dict):
         output_mappings = self.output_mappings
         return [global_variables.get(field) for field in output_mappings]
@@ -3,6 +3,7 @@ from nodes.node.start import Start
 from nodes.node.end import End
 from nodes.node.llm import LLM
 from nodes.node.memory import Memory
+from nodes.node.retrieval import Retrieval
 from nodes.node.node_base import NodeBase
 
 
@@ -17,5 +18,7 @@ class NodeManager:
             return LLM(next, config)
         elif node_name == "Memory":
             return Memory(next, config)
+        elif node_name == "Retrieval":
+            return Retrieval(next, config)
         else:
             raise ValueError("unknown node name: " + node_name)
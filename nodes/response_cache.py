@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from utils.sqlite import SQLiteConnections
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Cache of LLM responses keyed on model_id and the fully rendered prompt
+
+    configured per LLM node through the `cache` field of the node config:
+
+        cache:
+          backend: memory | disk
+          max_size: 1024     # max # of cached responses
+          ttl: 3600          # seconds, 0 means never expire
+          path: .cache/llm_responses.sqlite  # disk backend only
+    """
+
+    # whether lookups block on I/O, `aget`/`aset` then run them on a thread
+    blocking = False
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600) -> None:
+        assert max_size > 0, "size of response cache should > 0"
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(model_id: str, prompt: str, model_kwargs: dict = None) -> str:
+        plain_str = "#".join(
+            [model_id, json.dumps(model_kwargs or {}, sort_keys=True), prompt]
+        )
+        return hashlib.sha256(plain_str.encode()).hexdigest()
+
+    def _is_expired(self, created: float, now: float) -> bool:
+        return bool(self.ttl) and now - created > self.ttl
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        raise NotImplementedError()
+
+    async def aget(self, key: str) -> Optional[str]:
+        if self.blocking:
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def aset(self, key: str, value: str) -> None:
+        if self.blocking:
+            await asyncio.to_thread(self.set, key, value)
+        else:
+            self.set(key, value)
+
+    def _get(self, key: str) -> Optional[str]:
+        raise NotImplementedError()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+    @staticmethod
+    def create(cache_config: dict):
+        backend = cache_config.get("backend", "memory")
+        max_size = cache_config.get("max_size", 1024)
+        ttl = cache_config.get("ttl", 3600)
+        if backend == "memory":
+            return MemoryResponseCache(max_size, ttl)
+        elif backend == "disk":
+            path = cache_config.get("path", os.path.join(".cache", "llm_responses.sqlite"))
+            return DiskResponseCache(path, max_size, ttl)
+        else:
+            raise ValueError(f"Invalid cache backend: {backend}")
+
+
+class MemoryResponseCache(ResponseCache):
+    """in-process LRU cache with TTL"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600) -> None:
+        super().__init__(max_size, ttl)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            created, value = item
+            if self._is_expired(created, time.time()):
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+class DiskResponseCache(ResponseCache):
+    """SQLite backed cache, shared by every worker process using the same file
+
+    the database runs in WAL mode so readers in other processes are never
+    blocked by a writer. reads never write: expired entries are just missed,
+    and the access times of hits are kept in memory and only flushed by the
+    periodic eviction, which drops expired entries then the least recently
+    accessed ones once the cache grows over `max_size`.
+    """
+
+    blocking = True
+    # check the size of cache every `evict_interval` writes
+    evict_interval = 64
+
+    def __init__(self, path: str, max_size: int = 1024, ttl: float = 3600) -> None:
+        super().__init__(max_size, ttl)
+        self.path = path
+        self._connections = SQLiteConnections(path)
+        self._writes = 0
+        # key -> last access time of hits not flushed yet
+        self._accessed = {}
+        self._lock = threading.Lock()
+        conn = self._connections.get()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        logger.info("disk response cache at: %s", path)
+
+    def _get(self, key: str) -> Optional[str]:
+        row = (
+            self._connections.get()
+            .execute("SELECT value, created FROM responses WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        value, created = row
+        now = time.time()
+        if self._is_expired(created, now):
+            return None
+        with self._lock:
+            self._accessed[key] = now
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        self._connections.get().execute(
+            "INSERT OR REPLACE INTO responses (key, value, created, accessed) "
+            "VALUES (?, ?, ?, ?)",
+            (key, value, now, now),
+        )
+        with self._lock:
+            self._accessed.pop(key, None)
+            self._writes += 1
+            evict = self._writes % self.evict_interval == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        conn = self._connections.get()
+        if accessed:
+            conn.executemany(
+                "UPDATE responses SET accessed = ? WHERE key = ? AND accessed < ?",
+                [(at, key, at) for key, at in accessed.items()],
+            )
+        if self.ttl:
+            conn.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)
+            )
+        conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,),
+        )
@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from configs.constants import (
+    session_cache_idle_ttl,
+    session_cache_max_sessions,
+    summary_fold_workers,
+)
+from dao.session import SessionDAO
+from nodes.model_registry import model_registry
+from utils import metrics
+from utils.tokens import truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class HistorySummarizer:
+    """Rolling summary of the messages of a session older than its window
+
+    configured per Memory node through the `summary` field of the node config:
+
+        summary:
+          model_id: anthropic.claude-instant-v1
+          model_kwargs: {}    # optional
+          fold_every: 4       # messages out of the window before folding them
+          max_fold: 32        # max # of messages folded at once
+          max_tokens: 256     # max length of the summary
+          prompt: ...         # optional instructions of the summarizing model
+
+    the Memory node hands over the messages that left its window and are not
+    summarized yet, the backlog. once `fold_every` of them piled up they are
+    folded, with the previous summary, into a new summary stored beside the
+    messages, on a background thread so a turn does not wait for the
+    summarizing model. until then the backlog stays in the prompt, only when
+    it reaches `max_fold` (folds fall behind or keep failing) a turn folds it
+    itself.
+    """
+
+    default_prompt = (
+        "You maintain a running summary of a conversation between a user and "
+        "an assistant. Merge the new messages into the summary so far. Keep "
+        "facts, names, decisions, preferences and open questions, drop "
+        "greetings and repetition. Answer with the updated summary only, in "
+        "at most {max_tokens} tokens."
+    )
+    # folded messages are cut to this many tokens each
+    max_message_tokens = 512
+
+    def __init__(
+        self,
+        model_id: str,
+        model_kwargs: dict = None,
+        fold_every: int = 4,
+        max_fold: int = 32,
+        max_tokens: int = 256,
+        prompt: str = None,
+    ) -> None:
+        assert model_id, "model_id of summary should be set"
+        assert fold_every > 0, "fold_every should > 0"
+        assert max_fold >= fold_every, "max_fold should >= fold_every"
+        assert max_tokens > 0, "max_tokens of summary should > 0"
+        self.model_id = model_id
+        self.model_kwargs = model_kwargs
+        self.fold_every = fold_every
+        self.max_fold = max_fold
+        self.max_tokens = max_tokens
+        self.prompt = (prompt or self.default_prompt).format(max_tokens=max_tokens)
+        self.session_dao = SessionDAO()
+        # session_id -> (fetched at, summary or None)
+        self._summaries = OrderedDict()
+        self._folding = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create(config: dict) -> "HistorySummarizer":
+        return HistorySummarizer(**config)
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """the summary of a session, cached for a while"""
+        now = time.time()
+        with self._lock:
+            entry = self._summaries.get(session_id)
+            # summaries are cached along with the history, folds of other
+            # processes are missed until the entry expires
+            cached = self.session_dao.history_cache is not None
+            if cached and entry is not None and now - entry[0] <= session_cache_idle_ttl:
+                self._summaries.move_to_end(session_id)
+                return entry[1]
+        summary = self.session_dao.get_summary(session_id)
+        self._set(session_id, summary)
+        return summary
+
+    def _set(self, session_id: str, summary: Optional[dict]):
+        with self._lock:
+            self._summaries[session_id] = (time.time(), summary)
+            self._summaries.move_to_end(session_id)
+            while len(self._summaries) > session_cache_max_sessions:
+                self._summaries.popitem(last=False)
+
+    def update(self, session_id: str, backlog: List[dict]) -> Optional[dict]:
+        """fold the `backlog` of a session, oldest first, when it is due
+        return the new summary when folded right away, None otherwise
+        """
+        if len(backlog) < self.fold_every:
+            return None
+        with self._lock:
+            if session_id in self._folding:
+                return None
+            self._folding.add(session_id)
+        if len(backlog) >= self.max_fold:
+            try:
+                return self._fold_safely(session_id, backlog)
+            finally:
+                self._done_folding(session_id)
+        get_fold_executor().submit(self._fold_in_background, session_id, backlog)
+        return None
+
+    def _fold_safely(self, session_id: str, backlog: List[dict]) -> Optional[dict]:
+        try:
+            return self.fold(session_id, backlog)
+        except Exception:
+            logger.exception("failed to summarize session `%s`", session_id)
+            return None
+
+    def _fold_in_background(self, session_id: str, backlog: List[dict]):
+        try:
+            self._fold_safely(session_id, backlog)
+        finally:
+            self._done_folding(session_id)
+
+    def _done_folding(self, session_id: str):
+        with self._lock:
+            self._folding.discard(session_id)
+
+    def fold(self, session_id: str, backlog: List[dict]) -> Optional[dict]:
+        """fold the messages of `backlog` not summarized yet into the summary
+        of the session
+        """
+        summary = self.session_dao.get_summary(session_id)
+        until = summary["until"] if summary else 0
+        older = [record for record in backlog if record["timestamp"] > until]
+        if not older:
+            self._set(session_id, summary)
+            return summary
+
+        content = self.summarize(summary["content"] if summary else "", older)
+        summary = self.session_dao.save_summary(
+            session_id, content, older[-1]["timestamp"]
+        )
+        self._set(session_id, summary)
+        logger.debug("folded %s messages of session `%s`", len(older), session_id)
+        return summary
+
+    def summarize(self, summary: str, messages: List[dict]) -> str:
+        new_messages = "\n".join(
+            "{}: {}".format(
+                message["role"],
+                truncate_tokens(str(message["content"]), self.max_message_tokens),
+            )
+            for message in messages
+        )
+        prompt = [
+            ("system", self.prompt),
+            (
+                "user",
+                f"Summary so far:\n{summary or '(empty)'}\n\nNew messages:\n{new_messages}",
+            ),
+        ]
+        with metrics.llm_duration_seconds.time(self.model_id):
+            response = model_registry.get(self.model_id, self.model_kwargs).invoke(prompt)
+        return truncate_tokens(response.content.strip(), self.max_tokens)
+
+
+_fold_executor = None
+_fold_executor_lock = threading.Lock()
+
+
+def get_fold_executor() -> ThreadPoolExecutor:
+    global _fold_executor
+    if _fold_executor is None:
+        with _fold_executor_lock:
+            if _fold_executor is None:
+                _fold_executor = ThreadPoolExecutor(
+                    summary_fold_workers, thread_name_prefix="summary-fold"
+                )
+    return _fold_executor
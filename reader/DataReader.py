@@ -1,6 +1,3 @@
-from copy import deepcopy
-
-
 class DataReader:
     def get_data(self):
         raise NotImplementedError()
@@ -16,6 +13,9 @@ class DataReader:
     
     def get_workflow_id(self):
         raise NotImplementedError()
+
+    def get_model_limits(self):
+        raise NotImplementedError()
     
     def get_version(self):
         raise NotImplementedError()
@@ -43,9 +43,12 @@ class DataReader:
         compound_key = "a.b"
         delimiter = "."
         result = {"c":1}
+
+        the returned object is shared with the reader (no copy is made), callers
+        must treat it as read-only
         """
         keys = compound_key.split(delimiter)
-        obj = deepcopy(self.data)
+        obj = self.data
         for key in keys:
             if key not in obj:
                 raise KeyError(f"Key {key} not found in {obj}")
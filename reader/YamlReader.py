@@ -25,6 +25,10 @@ class YamlReader(DataReader):
     
     def get_workflow_id(self):
         return self.get_data_by_key("workflow")
+
+    def get_model_limits(self):
+        # optional, concurrency limits per model_id
+        return self.get_data().get("model_limits") or {}
     
     def get_version(self):
         return self.get_data_by_key("version")
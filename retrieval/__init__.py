@@ -0,0 +1,2 @@
+from .index import IndexWriter, VectorIndex, get_index
+from .builder import build_index
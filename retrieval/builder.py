@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Iterator, List
+
+from nodes.model_registry import model_registry
+from retrieval.index import IndexWriter
+
+logger = logging.getLogger(__name__)
+
+
+def read_documents(
+    input: str, text_field: str = "text", id_field: str = "id"
+) -> Iterator[dict]:
+    """`{"id", "text", "metadata"}` documents of a jsonl file, records without
+    an id are identified by the hash of their text
+    """
+    with open(input, "r") as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = record.get(text_field)
+            if not isinstance(text, str) or not text:
+                logger.warning("skip line %s of %s: no `%s`", line_number, input, text_field)
+                continue
+            document_id = record.get(id_field)
+            if document_id is None:
+                document_id = hashlib.sha256(text.encode()).hexdigest()
+            yield {
+                "id": str(document_id),
+                "text": text,
+                "metadata": record.get("metadata") or {},
+            }
+
+
+def build_index(
+    index: str,
+    input: str,
+    model_id: str,
+    model_kwargs: dict = None,
+    text_field: str = "text",
+    id_field: str = "id",
+    metric: str = "cosine",
+    batch_size: int = 64,
+    rebuild: bool = False,
+    progress_interval: float = 10,
+) -> dict:
+    """embed the documents of a jsonl file and append them to an index
+
+    documents already in the index are skipped before embedding, so running
+    it again over a grown file only embeds the new documents, and an
+    interrupted build resumes from its last committed batch.
+    """
+    assert batch_size > 0, "batch_size should > 0"
+    if rebuild and os.path.exists(index):
+        shutil.rmtree(index)
+    writer = IndexWriter(index, metric=metric, model_id=model_id)
+    embeddings = model_registry.get_embeddings(model_id, model_kwargs)
+    logger.info("index %s: %s rows, adding %s", index, writer.meta["count"], input)
+
+    stats = {"read": 0, "added": 0, "skipped": 0}
+    started_at = last_report = time.monotonic()
+
+    def flush(batch: List[dict]):
+        vectors = embeddings.embed_documents([document["text"] for document in batch])
+        stats["added"] += writer.append(batch, vectors)
+
+    batch = []
+    for document in read_documents(input, text_field, id_field):
+        stats["read"] += 1
+        if not writer.is_new(document["id"]) or any(
+            document["id"] == pending["id"] for pending in batch
+        ):
+            stats["skipped"] += 1
+            continue
+        batch.append(document)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+        now = time.monotonic()
+        if now - last_report >= progress_interval:
+            logger.info("index %s: %s", index, stats)
+            last_report = now
+    if batch:
+        flush(batch)
+
+    stats["rows"] = writer.meta["count"]
+    stats["elapsed_s"] = time.monotonic() - started_at
+    return stats
@@ -0,0 +1,323 @@
+"""Memory-mapped embedding index
+
+an index is a directory of:
+
+    index.json       dim, metric, # of rows and the embedding model
+    vectors.f32      float32 matrix, one row per document, L2 normalized for
+                     the cosine metric
+    documents.jsonl  one `{"id": ..., "text": ..., "metadata": {...}}` per row
+    offsets.u64      byte offset of each row in documents.jsonl
+
+rows are only appended, and index.json is replaced last, so readers never
+see more rows than were completely written and an index can be appended to
+while it is served.
+"""
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from configs.constants import retrieval_chunk_rows, retrieval_reload_interval
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "index.json"
+VECTORS_FILE = "vectors.f32"
+DOCUMENTS_FILE = "documents.jsonl"
+OFFSETS_FILE = "offsets.u64"
+
+metrics = ("cosine", "dot")
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def read_meta(path: str) -> Optional[dict]:
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+class VectorIndex:
+    """Read-only view of an index, searched by exact top-k similarity
+
+    the matrix is memory-mapped, so it is paged in by the OS rather than
+    loaded, and shared by every worker process. it is scanned in blocks of
+    `chunk_rows` rows scored against all queries at once, keeping the best
+    `top_k` of each query, so memory stays bounded whatever the size of the
+    corpus. a metadata filter first narrows the scan to the matching rows,
+    through postings built on first use of each field.
+    """
+
+    def __init__(self, path: str, chunk_rows: int = retrieval_chunk_rows) -> None:
+        meta = read_meta(path)
+        if meta is None:
+            raise ValueError(f"no index found at {path}")
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.dim = meta["dim"]
+        self.count = meta["count"]
+        self.metric = meta["metric"]
+        self.model_id = meta.get("model_id")
+        self.documents_size = meta["documents_size"]
+        if self.count:
+            self.vectors = np.memmap(
+                os.path.join(path, VECTORS_FILE),
+                dtype=np.float32,
+                mode="r",
+                shape=(self.count, self.dim),
+            )
+            self.offsets = np.memmap(
+                os.path.join(path, OFFSETS_FILE),
+                dtype=np.uint64,
+                mode="r",
+                shape=(self.count,),
+            )
+            with open(os.path.join(path, DOCUMENTS_FILE), "rb") as f:
+                self._documents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self.offsets = np.zeros(0, dtype=np.uint64)
+            self._documents = b""
+        # field -> value -> rows
+        self._postings = {}
+        self._postings_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def document(self, row: int) -> dict:
+        start = int(self.offsets[row])
+        end = int(self.offsets[row + 1]) if row + 1 < self.count else self.documents_size
+        return json.loads(self._documents[start:end])
+
+    def documents(self) -> Iterator[dict]:
+        for row in range(self.count):
+            yield self.document(row)
+
+    def postings(self, field: str) -> dict:
+        postings = self._postings.get(field)
+        if postings is not None:
+            return postings
+        with self._postings_lock:
+            postings = self._postings.get(field)
+            if postings is None:
+                rows = {}
+                for row, document in enumerate(self.documents()):
+                    value = (document.get("metadata") or {}).get(field)
+                    if value is not None and not isinstance(value, (list, dict)):
+                        rows.setdefault(value, []).append(row)
+                postings = {
+                    value: np.array(value_rows, dtype=np.int64)
+                    for value, value_rows in rows.items()
+                }
+                self._postings[field] = postings
+        return postings
+
+    def filter_rows(self, filter: dict) -> np.ndarray:
+        """sorted rows whose metadata match every field of `filter`, a field
+        matches a value or any of a list of values
+        """
+        rows = None
+        for field, values in filter.items():
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            postings = self.postings(field)
+            matched = [postings[value] for value in values if value in postings]
+            field_rows = (
+                np.unique(np.concatenate(matched)) if matched else np.zeros(0, np.int64)
+            )
+            rows = (
+                field_rows
+                if rows is None
+                else np.intersect1d(rows, field_rows, assume_unique=True)
+            )
+        return np.arange(self.count) if rows is None else rows
+
+    def search(
+        self, queries: np.ndarray, top_k: int, rows: np.ndarray = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """(scores, rows) of the `top_k` rows most similar to each query,
+        best first, both of shape (# of queries, <= top_k)
+        `rows` restricts the search to these rows
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        assert queries.shape[1] == self.dim, f"queries should have {self.dim} dims"
+        if self.metric == "cosine":
+            queries = normalize(queries)
+        n = self.count if rows is None else len(rows)
+        top_k = min(top_k, n)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        if top_k <= 0:
+            return best_scores, best_rows
+
+        for start in range(0, n, self.chunk_rows):
+            stop = min(start + self.chunk_rows, n)
+            if rows is None:
+                block_rows = np.arange(start, stop, dtype=np.int64)
+                block = self.vectors[start:stop]
+            else:
+                block_rows = rows[start:stop]
+                block = self.vectors[block_rows]
+            scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+            candidates = np.concatenate(
+                [best_rows, np.broadcast_to(block_rows, (len(queries), len(block_rows)))],
+                axis=1,
+            )
+            if scores.shape[1] > top_k:
+                top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                candidates = np.take_along_axis(candidates, top, axis=1)
+            best_scores, best_rows = scores, candidates
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return (
+            np.take_along_axis(best_scores, order, axis=1),
+            np.take_along_axis(best_rows, order, axis=1),
+        )
+
+    def close(self):
+        if isinstance(self._documents, mmap.mmap):
+            self._documents.close()
+
+
+class IndexWriter:
+    """Appends documents and their embeddings to an index, creating it
+
+    each `append` commits by replacing index.json, rows written by an
+    interrupted append are dropped when the index is opened again. documents
+    whose id is already in the index are skipped.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dim: int = None,
+        metric: str = "cosine",
+        model_id: str = None,
+    ) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        meta = read_meta(path)
+        if meta is None:
+            assert metric in metrics, f"metric should be one of {metrics}"
+            meta = {
+                "dim": dim,
+                "count": 0,
+                "metric": metric,
+                "model_id": model_id,
+                "documents_size": 0,
+            }
+        elif model_id and meta.get("model_id") and model_id != meta["model_id"]:
+            raise ValueError(
+                f"index {path} is embedded by {meta['model_id']}, not {model_id}"
+            )
+        self.meta = meta
+        self._truncate()
+        self.ids = set()
+        if meta["count"]:
+            index = VectorIndex(path)
+            self.ids = {document["id"] for document in index.documents()}
+            index.close()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _truncate(self):
+        dim = self.meta["dim"] or 0
+        sizes = {
+            VECTORS_FILE: self.meta["count"] * dim * 4,
+            OFFSETS_FILE: self.meta["count"] * 8,
+            DOCUMENTS_FILE: self.meta["documents_size"],
+        }
+        for name, size in sizes.items():
+            with open(self._file(name), "ab") as f:
+                if f.tell() != size:
+                    logger.warning("drop uncommitted rows of %s", self._file(name))
+                    f.truncate(size)
+
+    def is_new(self, document_id: str) -> bool:
+        return document_id not in self.ids
+
+    def append(self, documents: List[dict], embeddings) -> int:
+        """append `{"id", "text", "metadata"}` documents with one embedding
+        each, return the # of rows added
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        assert len(vectors) == len(documents), "one embedding per document"
+        if not len(documents):
+            return 0
+        if self.meta["dim"] is None:
+            self.meta["dim"] = vectors.shape[1]
+        if vectors.shape[1] != self.meta["dim"]:
+            raise ValueError(
+                f"embeddings have {vectors.shape[1]} dims, index has {self.meta['dim']}"
+            )
+        keep = []
+        for i, document in enumerate(documents):
+            if self.is_new(document["id"]):
+                self.ids.add(document["id"])
+                keep.append(i)
+        if not keep:
+            return 0
+        vectors = vectors[keep]
+        if self.meta["metric"] == "cosine":
+            vectors = normalize(vectors)
+
+        offsets = []
+        offset = self.meta["documents_size"]
+        with open(self._file(DOCUMENTS_FILE), "ab") as f:
+            for i in keep:
+                line = json.dumps(documents[i], ensure_ascii=False).encode() + b"\n"
+                offsets.append(offset)
+                f.write(line)
+                offset += len(line)
+        with open(self._file(VECTORS_FILE), "ab") as f:
+            vectors.astype(np.float32).tofile(f)
+        with open(self._file(OFFSETS_FILE), "ab") as f:
+            np.asarray(offsets, dtype=np.uint64).tofile(f)
+
+        self.meta["count"] += len(keep)
+        self.meta["documents_size"] = offset
+        tmp_path = self._file(META_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self._file(META_FILE))
+        return len(keep)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(path: str) -> VectorIndex:
+    """the process wide index at `path`, reopened when rows were appended,
+    checked at most every `retrieval_reload_interval` seconds
+    """
+    now = time.monotonic()
+    entry = _indexes.get(path)
+    if entry is not None and now - entry[1] < retrieval_reload_interval:
+        return entry[0]
+    with _indexes_lock:
+        entry = _indexes.get(path)
+        if entry is not None and now - entry[1] < retrieval_reload_interval:
+            return entry[0]
+        meta = read_meta(path)
+        if entry is not None and meta is not None and meta["count"] == entry[0].count:
+            index = entry[0]
+        else:
+            # searches in flight keep the previous index alive until they end
+            index = VectorIndex(path)
+            logger.info("open index %s: %s rows of %s dims", path, index.count, index.dim)
+        _indexes[path] = (index, now)
+        return index
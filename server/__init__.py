@@ -0,0 +1 @@
+from .prefork import PreforkServer
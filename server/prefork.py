@@ -0,0 +1,214 @@
+import asyncio
+import gc
+import logging
+import os
+import select
+import signal
+import socket
+import time
+from typing import Callable, Dict, Optional
+
+import uvicorn
+from fastapi import FastAPI
+
+from utils.log import stop_logging
+
+logger = logging.getLogger(__name__)
+
+
+class PreforkServer:
+    """Serve an app from `workers` forked processes sharing one socket
+
+    the app (and the workflow plans compiled into it) is built once in the
+    parent, then `gc.freeze` moves it to the permanent generation so the
+    collectors of the workers never touch it and its pages stay shared
+    copy-on-write. each worker runs its own uvicorn server and event loop.
+
+    signals of the parent:
+        SIGHUP: rolling restart, `on_reload` is called (e.g. to pick up changed
+            workflow configs) then workers are replaced one at a time, each
+            old worker is stopped once its replacement is ready and finishes
+            its in-flight requests
+        SIGTERM / SIGINT: graceful shutdown of every worker
+    workers exiting unexpectedly are replaced.
+    """
+
+    def __init__(
+        self,
+        app: FastAPI,
+        host: str,
+        port: int,
+        workers: int,
+        on_reload: Optional[Callable[[], None]] = None,
+        ready_timeout: float = 30,
+        graceful_timeout: float = 30,
+        backlog: int = 2048,
+    ) -> None:
+        assert workers > 0, "number of workers should > 0"
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.on_reload = on_reload
+        self.ready_timeout = ready_timeout
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.sock = None
+        # pid -> read end of the pipe the worker signals readiness on
+        self.workers: Dict[int, int] = {}
+        # workers being stopped, not to be replaced once they exit
+        self.retiring = set()
+        self._reload = False
+        self._stop = False
+
+    def bind(self) -> socket.socket:
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def spawn(self) -> int:
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            code = 0
+            try:
+                self.run_worker(ready_w)
+            except BaseException:
+                logger.exception("worker %s failed", os.getpid())
+                code = 1
+            finally:
+                stop_logging()
+                os._exit(code)
+
+        os.close(ready_w)
+        self.workers[pid] = ready_r
+        logger.info("spawned worker %s", pid)
+        return pid
+
+    def run_worker(self, ready_fd: int):
+        # the parent handles these, workers only react to SIGTERM / SIGINT
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        for fd in self.workers.values():
+            os.close(fd)
+        self.workers = {}
+
+        config = uvicorn.Config(
+            self.app,
+            timeout_graceful_shutdown=self.graceful_timeout,
+            log_level="info",
+        )
+        server = uvicorn.Server(config)
+        asyncio.run(self._serve(server, ready_fd))
+
+    async def _serve(self, server: uvicorn.Server, ready_fd: int):
+        task = asyncio.create_task(server.serve(sockets=[self.sock]))
+        while not server.started and not task.done():
+            await asyncio.sleep(0.05)
+        if server.started:
+            os.write(ready_fd, b"1")
+        os.close(ready_fd)
+        await task
+
+    def wait_ready(self, pid: int) -> bool:
+        fd = self.workers.get(pid)
+        if fd is None:
+            return False
+        readable, _, _ = select.select([fd], [], [], self.ready_timeout)
+        return bool(readable) and os.read(fd, 1) == b"1"
+
+    def stop_worker(self, pid: int, sig: int = signal.SIGTERM):
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            fd = self.workers.pop(pid, None)
+            if fd is not None:
+                os.close(fd)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                logger.info("worker %s stopped", pid)
+            elif not self._stop:
+                logger.warning(
+                    "worker %s exited unexpectedly (%s), respawn",
+                    pid,
+                    os.waitstatus_to_exitcode(status),
+                )
+                self.spawn()
+
+    def rolling_restart(self):
+        logger.info("rolling restart of %s workers", len(self.workers))
+        if self.on_reload is not None:
+            try:
+                self.on_reload()
+            except Exception:
+                logger.exception("reload before restarting workers failed")
+        gc.freeze()
+        for pid in [pid for pid in self.workers if pid not in self.retiring]:
+            new_pid = self.spawn()
+            if not self.wait_ready(new_pid):
+                logger.error("worker %s not ready, keep worker %s", new_pid, pid)
+                self.stop_worker(new_pid, signal.SIGKILL)
+                continue
+            self.stop_worker(pid)
+
+    def shutdown(self):
+        logger.info("stopping %s workers", len(self.workers))
+        for pid in list(self.workers):
+            self.stop_worker(pid)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            logger.warning("kill worker %s", pid)
+            self.stop_worker(pid, signal.SIGKILL)
+        while self.workers:
+            self.reap()
+            time.sleep(0.05)
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stop = True
+
+    def run(self):
+        self.sock = self.bind()
+        logger.info(
+            "serving on %s:%s with %s workers", self.host, self.port, self.num_workers
+        )
+        # everything loaded so far is shared by the workers, keep it out of gc
+        gc.collect()
+        gc.freeze()
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        for _ in range(self.num_workers):
+            self.spawn()
+
+        while not self._stop:
+            self.reap()
+            if self._reload:
+                self._reload = False
+                self.rolling_restart()
+            time.sleep(0.1)
+        self.shutdown()
+        self.sock.close()
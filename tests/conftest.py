@@ -0,0 +1,4 @@
+import os
+
+# tests never talk to cosmos, set before `configs.constants` is imported
+os.environ.setdefault("VULCAN_SESSION_STORE", "memory")
@@ -0,0 +1,177 @@
+import asyncio
+import gc
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from benchmarks.fakes import install_fake_models
+from endpoints import Endpoint
+from endpoints.admission import ConcurrencyLimiter, Rejected, admit
+from endpoints.models import TextRequest
+from workflow.workflow import Workflow
+
+payload = {"input": "hi", "config": {}, "kwargs": {"timestamp": "1"}}
+
+
+def build_workflow():
+    install_fake_models(latency_ms=0, tokens_per_sec=100000, n_tokens=4)
+    config = [
+        {"Start": {"output_mappings": ["input"]}},
+        {
+            "LLM": {
+                "prompts": [{"prompt": "{input}", "role": "user"}],
+                "model_id": "admission",
+                "output_mappings": ["llm_output"],
+            }
+        },
+        {"End": {"final_output": "$llm_output"}},
+    ]
+    return Workflow(config, "admission").build()
+
+
+def client_of(*endpoints: Endpoint) -> TestClient:
+    app = FastAPI()
+    for endpoint in endpoints:
+        app.router.routes.append(endpoint.route())
+    return TestClient(app)
+
+
+def test_waiters_are_served_first_come_first_served():
+    async def run():
+        limiter = ConcurrencyLimiter("queue-order", max_concurrency=1, max_queue=2)
+        await limiter.acquire()
+        served = []
+
+        async def wait(name: str):
+            await limiter.acquire()
+            served.append(name)
+
+        waiters = [asyncio.create_task(wait(name)) for name in ("a", "b")]
+        await asyncio.sleep(0)
+        assert limiter.active == 1 and len(limiter._waiters) == 2
+
+        # the slot is handed over, the count of holders stays the same
+        limiter.release()
+        await waiters[0]
+        assert served == ["a"] and limiter.active == 1
+        limiter.release()
+        await waiters[1]
+        assert served == ["a", "b"] and limiter.active == 1
+        limiter.release()
+        assert limiter.active == 0
+
+    asyncio.run(run())
+
+
+def test_full_queue_sheds_with_429():
+    async def run():
+        limiter = ConcurrencyLimiter(
+            "queue-full", max_concurrency=1, max_queue=1, retry_after=7
+        )
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        with pytest.raises(Rejected) as rejected:
+            await limiter.acquire()
+        assert rejected.value.status_code == 429
+        assert rejected.value.to_http().headers == {"Retry-After": "7"}
+        waiter.cancel()
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_sheds_with_503():
+    async def run():
+        limiter = ConcurrencyLimiter(
+            "queue-timeout", max_concurrency=1, max_queue=1, queue_timeout_ms=20
+        )
+        await limiter.acquire()
+        with pytest.raises(Rejected) as rejected:
+            await limiter.acquire()
+        assert rejected.value.status_code == 503
+        # the timed out waiter left the queue
+        assert not limiter._waiters and limiter.active == 1
+
+    asyncio.run(run())
+
+
+def test_admit_takes_every_slot_or_none():
+    async def run():
+        free = ConcurrencyLimiter("admit-free", max_concurrency=1)
+        full = ConcurrencyLimiter("admit-full", max_concurrency=1)
+        await full.acquire()
+
+        with pytest.raises(Rejected):
+            await admit([free, full])
+        assert free.active == 0
+
+        full.release()
+        permit = await admit([free, full])
+        assert free.active == full.active == 1
+        permit.release()
+        permit.release()
+        assert free.active == full.active == 0
+
+    asyncio.run(run())
+
+
+def test_endpoint_sheds_requests_over_its_limit():
+    wfi = build_workflow()
+    sync = Endpoint.create(
+        {
+            "path": "/admission/invoke",
+            "type": "sync",
+            "limits": {"max_concurrency": 1, "retry_after": 3},
+        },
+        wfi,
+    )
+    stream = Endpoint.create(
+        {
+            "path": "/admission/stream",
+            "type": "stream",
+            "limits": {"max_concurrency": 1, "max_queue": 1, "queue_timeout_ms": 20},
+        },
+        wfi,
+    )
+    client = client_of(sync, stream)
+
+    assert sync.limiter.try_acquire()
+    response = client.post("/admission/invoke", json=payload)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    sync.limiter.release()
+    assert client.post("/admission/invoke", json=payload).status_code == 200
+    assert sync.limiter.active == 0
+
+    assert stream.limiter.try_acquire()
+    response = client.post("/admission/stream", json=payload)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    stream.limiter.release()
+    response = client.post("/admission/stream", json=payload)
+    assert response.status_code == 200
+    assert stream.limiter.active == 0
+
+
+def test_stream_dropped_before_its_first_frame_releases_its_slot():
+    endpoint = Endpoint.create(
+        {"path": "/admission/dropped", "type": "stream", "limits": {"max_concurrency": 1}},
+        build_workflow(),
+    )
+
+    async def receive():
+        # the client stays connected
+        await asyncio.Event().wait()
+
+    async def run():
+        request = Request({"type": "http", "headers": [], "state": {}}, receive)
+        response = await endpoint.handle(TextRequest(**payload), request)
+        assert endpoint.limiter.active == 1
+        # e.g. the server failed sending the headers, the body never starts
+        del response
+        gc.collect()
+        assert endpoint.limiter.active == 0
+
+    asyncio.run(run())
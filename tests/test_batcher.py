@@ -0,0 +1,46 @@
+import asyncio
+import threading
+
+from nodes.batcher import ModelBatcher
+
+
+class SlowModel:
+    """echoes prompts once released, so callers can be cancelled mid-batch"""
+
+    def __init__(self) -> None:
+        self.release = threading.Event()
+
+    def batch(self, prompts, config=None, return_exceptions=False):
+        self.release.wait(5)
+        return [f"echo {prompt}" for prompt in prompts]
+
+
+def test_cancelled_caller_does_not_block_the_rest_of_its_batch():
+    model = SlowModel()
+    batcher = ModelBatcher(model, max_batch_size=2, max_wait_ms=200)
+
+    async def run():
+        cancelled = asyncio.ensure_future(batcher.ainvoke("a"))
+        other = asyncio.ensure_future(batcher.ainvoke("b"))
+        await asyncio.sleep(0.3)
+        cancelled.cancel()
+        model.release.set()
+        return await asyncio.wait_for(other, 2)
+
+    assert asyncio.run(run()) == "echo b"
+
+
+def test_caller_cancelled_before_dispatch_is_skipped():
+    model = SlowModel()
+    model.release.set()
+    batcher = ModelBatcher(model, max_batch_size=8, max_wait_ms=200)
+
+    async def run():
+        cancelled = asyncio.ensure_future(batcher.ainvoke("a"))
+        other = asyncio.ensure_future(batcher.ainvoke("b"))
+        await asyncio.sleep(0.05)
+        cancelled.cancel()
+        return await asyncio.wait_for(other, 2)
+
+    assert asyncio.run(run()) == "echo b"
+    assert batcher.requests == 1
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import time
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from benchmarks.fakes import install_fake_models
+from endpoints import Endpoint
+from endpoints.models import TextRequest
+from utils.deadline import Cancelled, Deadline
+from workflow.workflow import Workflow
+
+payload = {"input": "hi", "config": {}, "kwargs": {"timestamp": "1"}}
+
+
+def build_workflow(model_id: str, latency_ms: float, tokens_per_sec: float = 100000):
+    install_fake_models(latency_ms=latency_ms, tokens_per_sec=tokens_per_sec, n_tokens=40)
+    config = [
+        {"Start": {"output_mappings": ["input"]}},
+        {
+            "LLM": {
+                "prompts": [{"prompt": "{input}", "role": "user"}],
+                "model_id": model_id,
+                "output_mappings": ["llm_output"],
+            }
+        },
+        {"End": {"final_output": "$llm_output"}},
+    ]
+    return Workflow(config, model_id).build()
+
+
+def client_of(endpoint: Endpoint) -> TestClient:
+    app = FastAPI()
+    app.router.routes.append(endpoint.route())
+    return TestClient(app)
+
+
+def test_deadline():
+    assert Deadline.after(None).remaining() is None
+    Deadline().check()
+
+    deadline = Deadline.after(10, start=time.monotonic() - 11)
+    assert deadline.expired() and deadline.remaining() == 0
+    with pytest.raises(Cancelled) as cancelled:
+        deadline.check()
+    assert cancelled.value.reason == "deadline"
+
+    # the first reason sticks
+    deadline = Deadline.after(10)
+    deadline.cancel("disconnect")
+    deadline.cancel("deadline")
+    with pytest.raises(Cancelled, match="disconnect"):
+        deadline.check()
+
+
+def test_sync_run_stops_at_the_deadline_between_nodes():
+    wfi = build_workflow("deadline-sync", latency_ms=100)
+
+    with pytest.raises(Cancelled, match="deadline"):
+        wfi.execute(dict(payload), Deadline.after(0.05))
+
+
+def test_disconnect_cancels_the_run_with_499():
+    endpoint = Endpoint.create(
+        {"path": "/cancel/disconnect", "type": "sync"},
+        build_workflow("disconnect", latency_ms=5000),
+    )
+
+    async def receive():
+        await asyncio.sleep(0.05)
+        return {"type": "http.disconnect"}
+
+    async def run():
+        request = Request({"type": "http", "headers": [], "state": {}}, receive)
+        return await endpoint.handle(TextRequest(**payload), request)
+
+    started = time.perf_counter()
+    response = asyncio.run(run())
+    assert response.status_code == 499
+    # the model call was cancelled, not awaited
+    assert time.perf_counter() - started < 1
+
+
+def test_deadline_fails_the_request_with_504():
+    endpoint = Endpoint.create(
+        {"path": "/cancel/deadline", "type": "sync", "timeout_ms": 60000},
+        build_workflow("deadline-invoke", latency_ms=5000),
+    )
+    client = client_of(endpoint)
+
+    started = time.perf_counter()
+    # the shortest of the endpoint, request and header timeouts applies
+    response = client.post(
+        "/cancel/deadline", json=payload, headers={"X-Request-Timeout-Ms": "50"}
+    )
+    assert response.status_code == 504
+    assert response.json()["detail"] == "deadline exceeded"
+    assert time.perf_counter() - started < 1
+
+    response = client.post(
+        "/cancel/deadline", json=payload, headers={"X-Request-Timeout-Ms": "soon"}
+    )
+    assert response.status_code == 400
+
+
+def test_stream_ends_with_an_error_frame_at_the_deadline():
+    # 40 tokens at 20 per second, far longer than the deadline
+    endpoint = Endpoint.create(
+        {"path": "/cancel/stream", "type": "stream", "timeout_ms": 300},
+        build_workflow("deadline-stream", latency_ms=0, tokens_per_sec=20),
+    )
+
+    started = time.perf_counter()
+    response = client_of(endpoint).post("/cancel/stream", json=payload)
+    frames = [json.loads(line) for line in response.text.splitlines() if line]
+
+    assert response.status_code == 200
+    assert time.perf_counter() - started < 1
+    assert frames[-1] == {"type": "error", "error": "deadline exceeded", "is_stream": True}
+    # chunks streamed before the deadline were sent, the final frame never was
+    assert len(frames) > 1
+    assert not any(frame.get("done") for frame in frames)
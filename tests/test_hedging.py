@@ -0,0 +1,268 @@
+import asyncio
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from endpoints.admission import configure_limiter, model_limiter_name
+from nodes import hedging
+from nodes.hedging import HedgePolicy
+
+
+class Throttled(Exception):
+    def __init__(self) -> None:
+        super().__init__("An error occurred (ThrottlingException) when calling InvokeModel")
+
+
+class FakeModels:
+    """models answering after a fixed latency, or failing, recording calls"""
+
+    def __init__(self, latencies: dict, errors: dict = None) -> None:
+        self.latencies = latencies
+        self.errors = errors or {}
+        self.calls = []
+
+    def invoke(self, model_id: str) -> str:
+        self.calls.append(model_id)
+        time.sleep(self.latencies.get(model_id, 0))
+        if model_id in self.errors:
+            raise self.errors[model_id]
+        return f"answer of {model_id}"
+
+    async def ainvoke(self, model_id: str) -> str:
+        self.calls.append(model_id)
+        await asyncio.sleep(self.latencies.get(model_id, 0))
+        if model_id in self.errors:
+            raise self.errors[model_id]
+        return f"answer of {model_id}"
+
+
+def limit(model_id: str, max_concurrency: int = 1):
+    return configure_limiter(
+        model_limiter_name(model_id), {"max_concurrency": max_concurrency}
+    )
+
+
+policy = HedgePolicy(default_delay_ms=20, min_delay_ms=1)
+
+
+def test_no_hedge_at_a_model_without_a_free_slot():
+    limiter = limit("limited-busy")
+    assert limiter.try_acquire()
+    models = FakeModels({"slow-1": 0.1})
+
+    model_id, result = hedging.call(["slow-1", "limited-busy"], models.invoke, policy)
+
+    assert (model_id, result) == ("slow-1", "answer of slow-1")
+    assert models.calls == ["slow-1"]
+    limiter.release()
+
+
+def test_hedge_holds_a_slot_until_done():
+    limiter = limit("limited-free")
+    models = FakeModels({"slow-2": 0.3, "limited-free": 0})
+
+    model_id, _ = hedging.call(["slow-2", "limited-free"], models.invoke, policy)
+
+    assert model_id == "limited-free"
+    # released by the callback of the attempt, right after its result
+    deadline = time.monotonic() + 1
+    while limiter.active and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert limiter.active == 0
+
+
+def test_fallback_skips_models_at_their_limit():
+    limiter = limit("limited-fallback")
+    assert limiter.try_acquire()
+    models = FakeModels({}, errors={"throttled-1": Throttled()})
+
+    model_id, _ = asyncio.run(
+        hedging.acall(
+            ["throttled-1", "limited-fallback", "free-1"], models.ainvoke, None
+        )
+    )
+
+    assert model_id == "free-1"
+    assert models.calls == ["throttled-1", "free-1"]
+    limiter.release()
+
+
+def test_all_fallbacks_at_their_limit_raise_the_last_error():
+    limiter = limit("limited-last")
+    assert limiter.try_acquire()
+    models = FakeModels({}, errors={"throttled-2": Throttled()})
+
+    with pytest.raises(Throttled):
+        hedging.call(["throttled-2", "limited-last"], models.invoke)
+    limiter.release()
+
+
+class ClientError(Exception):
+    """botocore style error, the code is in `response`"""
+
+    def __init__(self, code: str) -> None:
+        super().__init__(f"{code} when calling InvokeModel")
+        self.response = {"Error": {"Code": code}}
+
+
+def test_is_failover_error():
+    assert hedging.is_failover_error(ClientError("ThrottlingException"))
+    assert not hedging.is_failover_error(ClientError("ValidationException"))
+    # langchain re-raises bedrock errors as ValueError
+    try:
+        try:
+            raise ClientError("ServiceUnavailableException")
+        except ClientError as e:
+            raise ValueError("Error raised by bedrock service") from e
+    except ValueError as e:
+        assert hedging.is_failover_error(e)
+    assert hedging.is_failover_error(ValueError("ModelTimeoutException: try later"))
+    assert not hedging.is_failover_error(ValueError("malformed prompt"))
+
+    # a cycle in the chain of causes ends the walk
+    first, second = ValueError("a"), ValueError("b")
+    first.__cause__, second.__cause__ = second, first
+    assert not hedging.is_failover_error(first)
+
+
+def test_latency_percentile():
+    stats = hedging.ModelLatencyStats(window=4)
+    assert stats.percentile("ttft", 95) is None
+    for seconds in [5, 1, 2, 3, 4]:
+        stats.observe("ttft", seconds)
+
+    # the oldest sample fell out of the window
+    assert stats.count("ttft") == 4
+    assert stats.percentile("ttft", 0) == 1
+    assert stats.percentile("ttft", 100) == 4
+    assert stats.percentile("ttft", 50) == 3
+
+
+def test_hedge_delay_follows_the_latency_of_the_model():
+    policy = HedgePolicy(
+        percentile=50,
+        min_samples=3,
+        default_delay_ms=500,
+        min_delay_ms=100,
+        max_delay_ms=1000,
+    )
+    stats = hedging.get_model_stats("delay-model")
+    stats.observe("latency", 0.2)
+    stats.observe("latency", 0.3)
+    # too few samples, the default delay
+    assert policy.delay("delay-model", "latency") == 0.5
+
+    stats.observe("latency", 0.4)
+    assert policy.delay("delay-model", "latency") == 0.3
+    # clamped to [min_delay, max_delay]
+    for _ in range(10):
+        stats.observe("ttft", 5)
+    assert policy.delay("delay-model", "ttft") == 1
+    for _ in range(10):
+        stats.observe("latency", 0.01)
+    assert policy.delay("delay-model", "latency") == 0.1
+
+
+def new_future(model_id: str) -> Future:
+    return Future()
+
+
+def test_attempts_without_policy_never_hedge():
+    attempts = hedging._Attempts(["a", "b"], None, "latency")
+    attempts.launch(new_future)
+    assert attempts.hedge_delay() is None
+
+
+def test_attempts_hedge_until_max_attempts():
+    policy = HedgePolicy(default_delay_ms=1000, min_samples=10**6, max_attempts=2)
+    attempts = hedging._Attempts(["hedge-a", "hedge-b", "hedge-c"], policy, "latency")
+    attempts.launch(new_future)
+
+    delay = attempts.hedge_delay()
+    assert 0.9 < delay <= 1
+    attempts.hedge(new_future)
+    assert [model_id for model_id, _ in attempts.in_flight.values()] == [
+        "hedge-a",
+        "hedge-b",
+    ]
+    # two attempts in flight already
+    assert attempts.hedge_delay() is None
+
+
+def test_attempts_finish():
+    attempts = hedging._Attempts(["finish-a", "finish-b", "finish-c"], None, "latency")
+    attempts.launch(new_future)
+    first = next(iter(attempts.in_flight))
+
+    # a failover error launches the next model right away
+    first.set_exception(ClientError("ThrottlingException"))
+    assert attempts.finish(first, new_future) is None
+    second = next(iter(attempts.in_flight))
+    assert attempts.in_flight[second][0] == "finish-b"
+
+    second.set_result("answer")
+    assert attempts.finish(second, new_future) == "finish-b"
+    assert hedging.get_model_stats("finish-b").count("latency") == 1
+
+
+def test_attempts_raise_other_errors_once_no_attempt_is_left():
+    policy = HedgePolicy(default_delay_ms=0, min_delay_ms=0)
+    attempts = hedging._Attempts(["error-a", "error-b"], policy, "latency")
+    attempts.launch(new_future)
+    attempts.hedge(new_future)
+    first, second = list(attempts.in_flight)
+
+    first.set_exception(ClientError("ValidationException"))
+    # the hedge may still answer
+    assert attempts.finish(first, new_future) is None
+    second.set_exception(ClientError("ValidationException"))
+    with pytest.raises(ClientError):
+        attempts.finish(second, new_future)
+
+
+def test_call_hedges_a_slow_model():
+    models = FakeModels({"call-slow": 0.5, "call-fast": 0})
+
+    model_id, result = hedging.call(["call-slow", "call-fast"], models.invoke, policy)
+
+    assert (model_id, result) == ("call-fast", "answer of call-fast")
+    assert models.calls == ["call-slow", "call-fast"]
+
+
+def test_acall_cancels_the_losers():
+    models = FakeModels({"acall-slow": 5, "acall-fast": 0})
+
+    async def run():
+        started = time.perf_counter()
+        model_id, _ = await hedging.acall(
+            ["acall-slow", "acall-fast"], models.ainvoke, policy
+        )
+        return model_id, time.perf_counter() - started
+
+    model_id, elapsed = asyncio.run(run())
+    assert model_id == "acall-fast"
+    assert elapsed < 1
+
+
+def test_open_stream_keeps_the_first_stream_producing_a_chunk():
+    closed = []
+
+    def open(model_id: str):
+        try:
+            time.sleep({"stream-slow": 0.3}.get(model_id, 0))
+            for i in range(3):
+                yield f"{model_id} {i}"
+        finally:
+            closed.append(model_id)
+
+    model_id, stream = hedging.open_stream(["stream-slow", "stream-fast"], open, policy)
+    chunks = list(stream)
+
+    assert model_id == "stream-fast"
+    assert chunks == ["stream-fast 0", "stream-fast 1", "stream-fast 2"]
+    # the loser is closed once it produced its first chunk
+    deadline = time.monotonic() + 2
+    while len(closed) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(closed) == ["stream-fast", "stream-slow"]
@@ -0,0 +1,56 @@
+import logging
+import queue
+
+from utils.log import SnapshotQueueHandler, Truncated
+
+
+class Rendered(Truncated):
+    """counts the renderings of a payload"""
+
+    __slots__ = ("count",)
+
+    def __init__(self, value) -> None:
+        super().__init__(value)
+        self.count = 0
+
+    def __str__(self) -> str:
+        self.count += 1
+        return super().__str__()
+
+
+def test_payloads_are_snapshotted_but_rendered_by_the_listener():
+    records = queue.SimpleQueue()
+    handler = SnapshotQueueHandler(records)
+    payload = {"input": "hi"}
+    record = logging.LogRecord(
+        "test", logging.DEBUG, __file__, 1, "payload: %s", (Truncated(payload),), None
+    )
+
+    handler.emit(record)
+    # the request goes on updating its variables
+    payload["final_output"] = "hello"
+
+    queued = records.get_nowait()
+    assert queued.getMessage() == 'payload: {"input": "hi"}'
+
+
+def test_prepare_does_not_render_the_message():
+    handler = SnapshotQueueHandler(queue.SimpleQueue())
+    value = Rendered({"input": "hi"})
+    record = logging.LogRecord("test", logging.DEBUG, __file__, 1, "%s", (value,), None)
+
+    handler.prepare(record)
+
+    assert value.count == 0
+
+
+def test_other_arguments_are_rendered_right_away():
+    handler = SnapshotQueueHandler(queue.SimpleQueue())
+    node = type("Node", (), {"__str__": lambda self: "llm"})()
+    record = logging.LogRecord(
+        "test", logging.INFO, __file__, 1, "%s took %dms", (node, 3), None
+    )
+
+    handler.prepare(record)
+
+    assert record.msg == "llm took 3ms" and record.args is None
@@ -0,0 +1,40 @@
+import time
+
+from benchmarks.fakes import install_fake_models
+from dao.session import SessionDAO
+from nodes.node.memory import Memory
+
+
+def test_summary_mode_keeps_every_message_in_the_prompt_or_the_summary():
+    install_fake_models(latency_ms=0, tokens_per_sec=100000, n_tokens=8)
+    dao = SessionDAO()
+    memory = Memory(
+        None,
+        {
+            "mode": "summary",
+            "n": 6,
+            "budget": 120,
+            "summary": {"model_id": "m", "fold_every": 4, "max_fold": 8},
+        },
+    )
+    for turn in range(24):
+        question = f"question {turn} " + "word " * turn
+        dao.save_session_message("s-memory", question, "user", None)
+        dao.save_session_message("s-memory", f"answer {turn}", "ai", "")
+        history = memory.execute({"session_id": "s-memory"})[0]
+        # let a fold started by this turn land, folded messages may then be
+        # in both the prompt and the summary, never in neither
+        while memory.summarizer._folding:
+            time.sleep(0.001)
+
+        summary = dao.get_summary("s-memory")
+        until = summary["until"] if summary else 0
+        unsummarized = [
+            record["content"]
+            for record in dao.query_latest_records("s-memory", 1000)
+            if record["timestamp"] > until
+        ]
+        prompt = [m["content"] for m in history if m["role"] != "system"]
+        assert prompt[len(prompt) - len(unsummarized) :] == unsummarized
+
+    assert dao.get_summary("s-memory") is not None
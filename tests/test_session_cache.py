@@ -0,0 +1,32 @@
+from dao.session import SessionDAO, SessionHistoryCache
+
+
+def message(content: str) -> dict:
+    return {"content": content, "role": "user", "timestamp": 0}
+
+
+def test_load_racing_with_an_append_is_dropped():
+    cache = SessionHistoryCache(window=4)
+    cache.load("s", [message("old")], 4, cache.start_load("s"))
+
+    version = cache.start_load("s")
+    stale = [message("old")]
+    # a message saved while the store was being read
+    cache.append("s", message("new"))
+    cache.load("s", stale, 4, version)
+
+    assert [m["content"] for m in cache.get("s", 4)] == ["old", "new"]
+
+
+def test_window_grows_to_the_largest_n_asked_for():
+    dao = SessionDAO(write_behind=False)
+    cache = dao.history_cache
+    n = cache.window + 8
+    for i in range(n + 10):
+        dao.save_session_message("s-window", f"m{i}", "user", None)
+
+    assert len(dao.get_latest_n_messages("s-window", n)) == n
+    misses = cache.misses
+    latest = dao.get_latest_n_messages("s-window", n)
+    assert cache.misses == misses
+    assert latest[-1]["content"] == f"m{n + 9}"
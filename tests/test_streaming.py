@@ -0,0 +1,52 @@
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from benchmarks.fakes import install_fake_models
+from endpoints import Endpoint
+from workflow.loader import WorkflowLoader
+
+WORKFLOW = """
+version: 0
+workflow: "end after an unstreamed variable"
+endpoints:
+  - path: /unstreamed/stream
+    type: stream
+components:
+  - Start:
+      output_mappings: [input]
+  - LLM:
+      prompts:
+        - prompt: "{input}"
+          role: user
+      model_id: first
+      output_mappings: [llm_output]
+  - LLM:
+      prompts:
+        - prompt: "{llm_output}"
+          role: user
+      model_id: second
+      output_mappings: [draft]
+  - End:
+      final_output: $llm_output
+"""
+
+
+def test_end_passes_through_a_variable_that_is_not_streamed(tmp_path):
+    install_fake_models(latency_ms=0, tokens_per_sec=10000, n_tokens=4)
+    path = tmp_path / "workflow.yml"
+    path.write_text(WORKFLOW)
+    (plan,) = WorkflowLoader([str(path)]).load()
+    app = FastAPI()
+    for endpoint_config in plan.endpoint_configs:
+        app.router.routes.append(Endpoint.create(endpoint_config, plan.wfi).route())
+
+    payload = {"input": "hi", "config": {}, "kwargs": {"timestamp": "1"}}
+    response = TestClient(app).post("/unstreamed/stream", json=payload)
+    frames = [json.loads(line) for line in response.text.splitlines() if line]
+
+    assert response.status_code == 200
+    final = frames[-1]
+    assert final["done"]
+    assert final["content"] == final["additional_kwargs"]["llm_output"]
@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import pytest
+
+from benchmarks.fakes import install_fake_models
+from workflow.workflow import Workflow
+from workflow.workflow_instance import TreeWorkflowInstance
+
+
+def llm(prompt: str, model_id: str, output: str) -> dict:
+    return {
+        "LLM": {
+            "prompts": [{"prompt": prompt, "role": "user"}],
+            "model_id": model_id,
+            "output_mappings": [output],
+        }
+    }
+
+
+def fan_out(model_id: str) -> dict:
+    # listed out of order on purpose, the order follows the variables
+    return {
+        "end": {"End": {"final_output": "$llm_output"}},
+        "answer": llm("{facts} {style} {input}", model_id, "llm_output"),
+        "facts": llm("facts of {input}", model_id, "facts"),
+        "style": llm("style of {input}", model_id, "style"),
+        "start": {"Start": {"output_mappings": ["input"]}},
+    }
+
+
+def build(config: dict) -> TreeWorkflowInstance:
+    wfi = Workflow(config, "tree").build()
+    assert isinstance(wfi, TreeWorkflowInstance)
+    return wfi
+
+
+def request(text: str = "hi") -> dict:
+    return {"input": text, "config": {}, "kwargs": {"timestamp": "1"}}
+
+
+def test_nodes_run_after_the_nodes_they_read_from():
+    wfi = build(fan_out("tree-order"))
+
+    assert wfi.dependencies == {
+        "end": {"answer"},
+        "answer": {"facts", "style", "start"},
+        "facts": {"start"},
+        "style": {"start"},
+        "start": set(),
+    }
+    position = {node_id: i for i, node_id in enumerate(wfi.order)}
+    for node_id, deps in wfi.dependencies.items():
+        assert all(position[dep] < position[node_id] for dep in deps)
+    assert wfi.streamer_id == "answer"
+
+
+def test_cycle_is_rejected():
+    config = {
+        "first": llm("{second}", "tree-cycle", "first"),
+        "second": llm("{first}", "tree-cycle", "second"),
+    }
+    with pytest.raises(ValueError, match="cycle"):
+        build(config)
+
+
+def test_undefined_variable_is_rejected():
+    config = fan_out("tree-undefined")
+    config["facts"] = llm("facts of {question}", "tree-undefined", "facts")
+    with pytest.raises(ValueError, match="undefined variable `question`"):
+        build(config)
+
+
+def test_variable_produced_twice_is_rejected():
+    config = fan_out("tree-twice")
+    config["style"] = llm("style of {input}", "tree-twice", "facts")
+    with pytest.raises(ValueError, match="produced by both"):
+        build(config)
+
+
+def test_branches_run_concurrently():
+    install_fake_models(latency_ms=200, tokens_per_sec=100000, n_tokens=4)
+    wfi = build(fan_out("tree-parallel"))
+
+    started = time.perf_counter()
+    output = wfi.execute(request())
+    elapsed = time.perf_counter() - started
+
+    # facts and style run side by side, then answer: 2 model calls, not 3
+    assert 0.4 <= elapsed < 0.55
+    assert output["final_output"] == output["llm_output"]
+
+    async def run():
+        started = time.perf_counter()
+        await wfi.aexecute(request())
+        return time.perf_counter() - started
+
+    assert 0.4 <= asyncio.run(run()) < 0.55
+
+
+def test_sync_async_and_stream_runs_agree():
+    install_fake_models(latency_ms=0, tokens_per_sec=100000, n_tokens=4)
+    wfi = build(fan_out("tree-paths"))
+
+    output = wfi.execute(request())
+    aoutput = asyncio.run(wfi.aexecute(request()))
+    frames = list(wfi.execute_as_stream(request()))
+
+    async def astream():
+        return [dict(frame) async for frame in wfi.aexecute_as_stream(request())]
+
+    aframes = asyncio.run(astream())
+
+    expected = output["llm_output"]
+    assert expected and output["final_output"] == expected
+    assert aoutput["final_output"] == expected
+    # the final frame carries the whole answer, the others its chunks, streamed
+    # answers are joined as they are, invoked ones are stripped
+    assert frames[-1]["final_output"].strip() == expected
+    assert aframes[-1]["final_output"].strip() == expected
+    assert len(frames) > 1 and len(aframes) > 1
+
+
+def test_failing_branch_fails_the_run():
+    install_fake_models(latency_ms=0, tokens_per_sec=100000, n_tokens=4)
+    wfi = build(fan_out("tree-failing"))
+
+    def fail(global_variables: dict) -> list:
+        raise RuntimeError("branch failed")
+
+    wfi.nodes["style"].execute = fail
+    with pytest.raises(RuntimeError, match="branch failed"):
+        wfi.execute(request())
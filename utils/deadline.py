@@ -0,0 +1,55 @@
+"""Deadlines and cancellation of workflow runs
+
+a `Deadline` travels with the execution context of a run. async runs are
+cancelled through their task, `check` is the cooperative counterpart for
+code running in threads or sync generators, called between nodes and
+between streamed chunks.
+"""
+import time
+from typing import Optional
+
+
+class Cancelled(Exception):
+    """a run stopped before completion, `reason` is `deadline` or `disconnect`"""
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(f"run cancelled: {reason}")
+        self.reason = reason
+
+
+class Deadline:
+    __slots__ = ("expires_at", "reason")
+
+    def __init__(self, expires_at: Optional[float] = None) -> None:
+        # `time.monotonic` based, None for no deadline
+        self.expires_at = expires_at
+        self.reason = None
+
+    @staticmethod
+    def after(timeout: Optional[float], start: Optional[float] = None) -> "Deadline":
+        """deadline `timeout` seconds after `start` (now by default)"""
+        if not timeout:
+            return Deadline()
+        start = time.monotonic() if start is None else start
+        return Deadline(start + timeout)
+
+    def remaining(self) -> Optional[float]:
+        """seconds left, None without a deadline"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def cancel(self, reason: str) -> None:
+        """stop the run at its next `check`"""
+        if self.reason is None:
+            self.reason = reason
+
+    def check(self) -> None:
+        if self.reason is None and self.expired():
+            self.reason = "deadline"
+        if self.reason is not None:
+            raise Cancelled(self.reason)
+
@@ -0,0 +1,208 @@
+"""Logging setup and helpers for the hot path
+
+modules log through `logging.getLogger(__name__)`, so levels can be set per
+subsystem (`workflow`, `nodes.node.llm`, `dao`, ...) with `log_levels`.
+request payloads (inputs, prompts, responses, global variables) are logged
+with `log_payload`: at DEBUG, sampled by `log_payload_sample_rate`, rendered
+lazily and truncated to `log_payload_max_chars`.
+`setup_logging` routes every record through a queue, formatting and writing
+happen on a listener thread instead of the thread serving the request.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import numbers
+import os
+import queue
+import random
+import sys
+
+from configs.constants import (
+    log_level,
+    log_levels,
+    log_async,
+    log_payload_sample_rate,
+    log_payload_max_chars,
+)
+
+log_format = "%(asctime)s - %(filename)s[%(lineno)d] - %(levelname)s - %(message)s"
+
+# marks the records of `log_payload`, e.g. to route them to their own handler
+_payload_extra = {"payload": True}
+
+
+class Truncated:
+    """log argument rendered (containers as json) only when the record is
+    formatted, and cut to `limit` characters
+    """
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int = log_payload_max_chars) -> None:
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        value = self.value
+        if isinstance(value, (dict, list, tuple)):
+            try:
+                text = json.dumps(value, ensure_ascii=False, default=str)
+            except (TypeError, ValueError):
+                text = repr(value)
+        else:
+            text = str(value)
+        if self.limit and len(text) > self.limit:
+            return f"{text[: self.limit]}...<{len(text) - self.limit} chars truncated>"
+        return text
+
+
+def log_payload(logger: logging.Logger, msg: str, *values, level: int = logging.DEBUG):
+    """log request payloads `values` into `%s` placeholders of `msg`"""
+    if not logger.isEnabledFor(level):
+        return
+    if log_payload_sample_rate < 1 and random.random() >= log_payload_sample_rate:
+        return
+    logger.log(
+        level,
+        msg,
+        *[Truncated(value) for value in values],
+        extra=_payload_extra,
+        stacklevel=2,
+    )
+
+
+# log arguments safe to format later as they are
+_immutable_args = (str, bytes, numbers.Number, type(None), tuple, frozenset)
+
+
+def _snapshot(value):
+    """copy of a log argument the request may still mutate, containers are
+    copied shallowly, None when the argument can not be copied
+    """
+    if isinstance(value, Truncated):
+        snapshot = _snapshot(value.value)
+        if snapshot is None and value.value is not None:
+            return None
+        return Truncated(snapshot, value.limit)
+    if isinstance(value, _immutable_args):
+        return value
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, (list, set)):
+        return type(value)(value)
+    return None
+
+
+class SnapshotQueueHandler(logging.handlers.QueueHandler):
+    """snapshots the arguments on the caller thread, the arguments may be
+    mutated by the request once the record is queued, rendering them (e.g.
+    the json of `log_payload`) and the rest of the formatting are left to
+    the listener. records with other arguments are rendered right away.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        args = record.args
+        if args:
+            items = args.items() if isinstance(args, dict) else enumerate(args)
+            snapshots = {}
+            for key, value in items:
+                snapshot = _snapshot(value)
+                if snapshot is None and value is not None:
+                    record.msg = record.getMessage()
+                    record.args = None
+                    break
+                snapshots[key] = snapshot
+            else:
+                record.args = (
+                    snapshots if isinstance(args, dict) else tuple(snapshots.values())
+                )
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+_configured = False
+
+
+def parse_levels(levels: str) -> dict:
+    """parse `<logger>=<level>,...`"""
+    parsed = {}
+    for item in levels.split(","):
+        if not item.strip():
+            continue
+        name, _, level = item.partition("=")
+        assert level, f"invalid log level setting: {item}"
+        parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def setup_logging(
+    level: str = log_level, levels: str = log_levels, use_queue: bool = log_async
+):
+    """configure the root logger, called once at startup"""
+    global _listener, _configured
+    _configured = True
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(log_format))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.setLevel(level)
+    if use_queue:
+        records = queue.SimpleQueue()
+        root.addHandler(SnapshotQueueHandler(records))
+        _listener = logging.handlers.QueueListener(
+            records, handler, respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(stop_logging)
+    else:
+        root.addHandler(handler)
+
+    for name, name_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(name_level)
+
+
+def ensure_logging():
+    """`setup_logging` unless it already ran, for apps started by an external
+    server
+    """
+    if not _configured:
+        setup_logging()
+
+
+def stop_logging():
+    """flush records still queued, called on shutdown"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _pause_listener():
+    """drain the queue before forking, records queued at fork time would
+    otherwise be written by both processes
+    """
+    if _listener is not None:
+        _listener.stop()
+
+
+def _resume_listener():
+    # the listener thread does not survive a fork, start a new one
+    global _listener
+    if _listener is not None:
+        _listener = logging.handlers.QueueListener(
+            _listener.queue, *_listener.handlers, respect_handler_level=True
+        )
+        _listener.start()
+
+
+os.register_at_fork(
+    before=_pause_listener,
+    after_in_parent=_resume_listener,
+    after_in_child=_resume_listener,
+)
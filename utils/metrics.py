@@ -0,0 +1,324 @@
+"""Process wide latency histograms, counters and gauges, exported in the
+Prometheus text format
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence
+
+# seconds, from cache hits to long generations
+latency_buckets = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+rate_buckets = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+batch_size_buckets = (1, 2, 4, 8, 16, 32, 64)
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Histogram of observations per combination of label values
+
+    observations are bucketed on the fly, so memory is bounded by the number
+    of label combinations and not by the number of observations.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = latency_buckets,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket (+Inf last), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues) -> None:
+        assert len(labelvalues) == len(self.labelnames)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0]
+                self._series[labelvalues] = series
+            series[0][idx] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def _format_labels(self, labelvalues: tuple, extra: str = "") -> str:
+        labels = [
+            '{}="{}"'.format(name, _escape(str(value)))
+            for name, value in zip(self.labelnames, labelvalues)
+        ]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def collect(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = [
+                (labelvalues, list(counts), total)
+                for labelvalues, (counts, total) in self._series.items()
+            ]
+        for labelvalues, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = self._format_labels(labelvalues, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = self._format_labels(labelvalues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter per combination of label values"""
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        assert len(labelvalues) == len(self.labelnames)
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            labels = [
+                '{}="{}"'.format(name, _escape(str(label)))
+                for name, label in zip(self.labelnames, labelvalues)
+            ]
+            labels = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Gauge:
+    """Current value per combination of label values
+
+    values are set, or read at collection time from the function given to
+    `set_function`, for values another object already keeps (queue depths)
+    """
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+
+    def set(self, value: float, *labelvalues) -> None:
+        assert len(labelvalues) == len(self.labelnames)
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def set_function(self, function: Callable[[], Dict[tuple, float]]) -> None:
+        """`function` returns the value of each combination of label values"""
+        self._function = function
+
+    def collect(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+        ]
+        if self._function is not None:
+            values = list(self._function().items())
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        for labelvalues, value in values:
+            labels = [
+                '{}="{}"'.format(name, _escape(str(label)))
+                for name, label in zip(self.labelnames, labelvalues)
+            ]
+            labels = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def histogram(
+    name: str,
+    documentation: str,
+    labelnames: Sequence[str] = (),
+    buckets: Sequence[float] = latency_buckets,
+) -> Histogram:
+    """create a histogram exported by `render`"""
+    metric = Histogram(name, documentation, labelnames, buckets)
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    """create a counter exported by `render`"""
+    metric = Counter(name, documentation, labelnames)
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    """create a gauge exported by `render`"""
+    metric = Gauge(name, documentation, labelnames)
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    """all registered metrics in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+request_queue_seconds = histogram(
+    "vulcan_request_queue_seconds",
+    "time between a request being received and its workflow starting",
+    ("path",),
+)
+request_duration_seconds = histogram(
+    "vulcan_request_duration_seconds",
+    "time to serve a request, until the last frame for streams",
+    ("path",),
+)
+node_duration_seconds = histogram(
+    "vulcan_node_duration_seconds",
+    "wall time of a node, streamer nodes are timed until their last chunk",
+    ("workflow", "node", "type"),
+)
+llm_duration_seconds = histogram(
+    "vulcan_llm_duration_seconds",
+    "time of a non streamed model invocation",
+    ("model",),
+)
+llm_time_to_first_token_seconds = histogram(
+    "vulcan_llm_time_to_first_token_seconds",
+    "time between a streamed model invocation and its first chunk",
+    ("model",),
+)
+llm_tokens_per_second = histogram(
+    "vulcan_llm_tokens_per_second",
+    "streamed chunks per second after the first one, a chunk is about a token",
+    ("model",),
+    rate_buckets,
+)
+session_store_seconds = histogram(
+    "vulcan_session_store_seconds",
+    "latency of session store reads and writes",
+    ("store", "operation"),
+)
+retrieval_duration_seconds = histogram(
+    "vulcan_retrieval_duration_seconds",
+    "time to embed a retrieval query and to search the index",
+    ("index", "stage"),
+)
+session_write_queue_depth = gauge(
+    "vulcan_session_write_queue_depth",
+    "session messages waiting in the write-behind queue",
+)
+session_cache_requests_total = counter(
+    "vulcan_session_cache_requests_total",
+    "lookups of the in-process session history cache, by result hit or miss",
+    ("result",),
+)
+session_cache_sessions = gauge(
+    "vulcan_session_cache_sessions",
+    "sessions held by the in-process session history cache",
+)
+model_clients_total = counter(
+    "vulcan_model_clients_total",
+    "model clients of the registry, by event created, reused or evicted",
+    ("event",),
+)
+llm_batch_size = histogram(
+    "vulcan_llm_batch_size",
+    "invocations dispatched together by the batcher of a model",
+    ("model",),
+    batch_size_buckets,
+)
+llm_batch_queue_depth = gauge(
+    "vulcan_llm_batch_queue_depth",
+    "invocations waiting to be collected by the batcher of a model",
+    ("model",),
+)
+admission_wait_seconds = histogram(
+    "vulcan_admission_wait_seconds",
+    "time requests waited in the queue of a concurrency limiter",
+    ("limiter",),
+)
+admission_rejected_total = counter(
+    "vulcan_admission_rejected_total",
+    "requests shed by a concurrency limiter, queue full or queue timeout",
+    ("limiter", "reason"),
+)
+requests_cancelled_total = counter(
+    "vulcan_requests_cancelled_total",
+    "requests stopped before completion, by client disconnect or deadline",
+    ("path", "reason"),
+)
+llm_hedged_total = counter(
+    "vulcan_llm_hedged_total",
+    "backup requests fired because the model had not answered in time",
+    ("model",),
+)
+llm_failover_total = counter(
+    "vulcan_llm_failover_total",
+    "calls of the model failing over to the next model, throttled or unavailable",
+    ("model",),
+)
+llm_attempts_skipped_total = counter(
+    "vulcan_llm_attempts_skipped_total",
+    "hedged or fallback calls not made because the model was at its model_limits",
+    ("model",),
+)
+llm_fallback_won_total = counter(
+    "vulcan_llm_fallback_won_total",
+    "hedged or failed over calls answered by this model rather than the first one",
+    ("model",),
+)
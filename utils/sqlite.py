@@ -0,0 +1,33 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteConnections:
+    """Per-thread connections to one sqlite database in WAL mode
+
+    sqlite connections can not be shared between threads, nor processes, each
+    thread of each process opens its own on first use. WAL lets readers in
+    other processes go on while one of them writes.
+    """
+
+    def __init__(self, path: str, timeout: float = 5, row_factory=None) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.row_factory = row_factory
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
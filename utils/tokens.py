@@ -0,0 +1,61 @@
+"""Token counts of prompt messages
+
+counted with tiktoken when it is installed, otherwise estimated from words
+and characters. counts only need to be close enough to budget prompts, the
+exact tokenizer of a model is not known here.
+"""
+import re
+from functools import lru_cache
+
+from configs.constants import token_count_cache_size
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# role markers and separators added around each message by chat templates
+message_overhead = 4
+
+_word_pattern = re.compile(r"\w+|[^\w\s]")
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+
+@lru_cache(maxsize=token_count_cache_size)
+def count_tokens(text: str) -> int:
+    """tokens of `text`, cached as the same history messages are counted on
+    every turn of a session
+    """
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_get_encoding().encode(text, disallowed_special=()))
+    # a word or punctuation mark is at least a token, long words are split
+    # in about 4 characters per token
+    return max(len(_word_pattern.findall(text)), (len(text) + 3) // 4)
+
+
+def count_message_tokens(message: dict) -> int:
+    return count_tokens(message["content"]) + message_overhead
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """`text` cut to about `max_tokens` tokens, at a word boundary"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if tiktoken is not None:
+        encoding = _get_encoding()
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    end = 0
+    for i, match in enumerate(_word_pattern.finditer(text)):
+        if i >= max_tokens or match.end() > 4 * max_tokens:
+            break
+        end = match.end()
+    return text[:end]
@@ -0,0 +1,75 @@
+"""Optional OpenTelemetry spans of workflow runs
+
+spans are only recorded when `tracing_enabled` is set and `opentelemetry-api`
+is installed, exporters are configured by the OpenTelemetry SDK as usual.
+otherwise every span is a shared no-op.
+parents are passed explicitly instead of through the current context, since
+runs hop between threads, tasks and generators.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+
+from configs.constants import tracing_enabled
+
+logger = logging.getLogger(__name__)
+
+
+class NoopSpan:
+    def set_attribute(self, key, value) -> None:
+        pass
+
+    def record_exception(self, exception) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+noop_span = NoopSpan()
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """return the process wide tracer, None when tracing is disabled"""
+    global _tracer
+    if not tracing_enabled:
+        return None
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                try:
+                    from opentelemetry import trace
+                except ImportError:
+                    logger.warning("tracing enabled but opentelemetry is not installed")
+                    _tracer = False
+                else:
+                    _tracer = trace.get_tracer("vulcan")
+    return _tracer or None
+
+
+def start_span(name: str, parent=None, **attributes):
+    """start a span, child of `parent` if given, the caller ends it"""
+    tracer = get_tracer()
+    if tracer is None:
+        return noop_span
+    from opentelemetry import trace
+
+    context = None
+    if parent is not None and parent is not noop_span:
+        context = trace.set_span_in_context(parent)
+    return tracer.start_span(name, context=context, attributes=attributes)
+
+
+@contextmanager
+def span(name: str, parent=None, **attributes):
+    current = start_span(name, parent, **attributes)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_exception(e)
+        raise
+    finally:
+        current.end()
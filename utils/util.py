@@ -14,3 +14,14 @@ def get_session_id(client_ip: str, session_timestamp: str):
 def get_message_id(session_id: str, content: str):
     plain_str = f"{session_id}#{content}#{str(time.time())}"
     return "msg-" + _get_md5(plain_str)
+
+
+def get_request_payload(record: dict, index: int = 0) -> dict:
+    """build a `TextRequest` payload from a jsonl record
+    records may be requests themselves (`input`, `config`, `kwargs`) or
+    backlog style entries whose `body`/`title` is used as input
+    """
+    input = record.get("input") or record.get("body") or record.get("title") or ""
+    kwargs = dict(record.get("kwargs") or {})
+    kwargs.setdefault("timestamp", str(record.get("request_id", index)))
+    return {"input": input, "config": record.get("config") or {}, "kwargs": kwargs}
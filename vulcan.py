@@ -1,84 +1,247 @@
 import argparse
-import os
+import asyncio
+import json
 import logging
+import os
+from contextlib import asynccontextmanager
 from typing import List
 
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
 
-from reader.ReaderFactory import get_reader
-from reader.DataReader import DataReader
-from workflow import Workflow, WorkflowInstance
-from endpoints import Endpoint
+from configs.constants import workflow_watch_interval
+from workflow.loader import WorkflowLoader, WorkflowPlan
+from endpoints import Endpoint, bind_metrics
+from endpoints.admission import configure_model_limits
+from dao.session import close_session_writer, disable_session_history_cache
+from server import PreforkServer
+from batch import BatchRunner
+from retrieval import build_index
+from utils.log import ensure_logging, setup_logging
 
-logging.basicConfig(
-    format="%(asctime)s - %(filename)s[%(lineno)d] - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
+logger = logging.getLogger(__name__)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=8000)
     parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--workers", type=int, default=1)
     parser.add_argument("--configs", nargs="*", type=str, default="")
     parser.add_argument("--config_type", type=str, choices=["yaml"], default="yaml")
+    # seconds between checks of workflow configs for changes, 0 disables
+    parser.add_argument("--watch_interval", type=float, default=workflow_watch_interval)
+
+    commands = parser.add_subparsers(dest="command")
+    # `vulcan.py batch --config <workflow> --input <jsonl> --output <jsonl>`
+    batch = commands.add_parser("batch", help="run a workflow over a jsonl file")
+    batch.add_argument("--config", type=str, required=True)
+    batch.add_argument("--input", type=str, required=True)
+    batch.add_argument("--output", type=str, required=True)
+    batch.add_argument("--mode", type=str, choices=BatchRunner.modes, default="thread")
+    batch.add_argument("--concurrency", type=int, default=8)
+    batch.add_argument("--resume", action="store_true")
+    batch.add_argument("--start_line", type=int, default=0)
+    batch.add_argument("--limit", type=int, default=0)
+    batch.add_argument("--timeout_ms", type=float, default=0)
+    batch.add_argument("--checkpoint_every", type=int, default=100)
+    batch.add_argument("--progress_interval", type=float, default=10)
+    # `vulcan.py index --index <dir> --input <jsonl> --model_id <embedding model>`
+    index = commands.add_parser(
+        "index", help="build or append to the embedding index of a Retrieval node"
+    )
+    index.add_argument("--index", type=str, required=True)
+    index.add_argument("--input", type=str, required=True)
+    index.add_argument("--model_id", type=str, required=True)
+    index.add_argument("--model_kwargs", type=json.loads, default=None)
+    index.add_argument("--text_field", type=str, default="text")
+    index.add_argument("--id_field", type=str, default="id")
+    index.add_argument("--metric", type=str, choices=["cosine", "dot"], default="cosine")
+    index.add_argument("--batch_size", type=int, default=64)
+    index.add_argument("--rebuild", action="store_true")
+    index.add_argument("--progress_interval", type=float, default=10)
     return parser.parse_args()
 
 
-def read_configs(configs: str, config_type: str) -> List:
-    if not configs:
-        # todo(zbairong) get all config file recursively
-        files = list(filter(lambda x: x.endswith("yml"), os.listdir("workflows")))
-        configs = [os.path.join("workflows", file) for file in files]
-
-    logging.info(f"found workflow configs: {configs}")
-    reader = get_reader(config_type)
-    readers = []
-    for config in configs:
-        config_reader = reader(config)
-        readers.append(config_reader)
-
-    return readers
-
-
-def create_workflow_instance(config: DataReader):
-    workflow_config = config.get_workflow()
-    workflow = Workflow(workflow_config, config.get_workflow_id())
-    workflow_instance = workflow.build()
-    return workflow_instance
-
-
-def create_endpoints(
-    app: FastAPI, wfi_list: List[WorkflowInstance], config_list: List[DataReader]
-):
-    assert len(wfi_list) == len(config_list)
-    for config, wfi in zip(config_list, wfi_list):
-        endpoint_configs = config.get_endpoints()
-        for endpoint_config in endpoint_configs:
-            logging.info(f"bind endpoint {endpoint_config.get("path")} to workflow {wfi.workflow.id}")
-            endpoint = Endpoint.create(endpoint_config, wfi)
-            endpoint.bind(app)
-            
-
-
-def main(args):
-    configs = read_configs(args.configs, args.config_type)
-    wfi_list = []
-    for config in configs:
-        logging.info(f"create workflow instance for {config}")
+def create_routes(plan: WorkflowPlan) -> List[APIRoute]:
+    routes = []
+    configure_model_limits(plan.config.get_model_limits())
+    for endpoint_config in plan.endpoint_configs:
+        logger.info(
+            "bind endpoint %s to workflow %s",
+            endpoint_config.get("path"),
+            plan.wfi.workflow.id,
+        )
+        routes.append(Endpoint.create(endpoint_config, plan.wfi).route())
+    return routes
+
+
+def create_endpoints(app: FastAPI, plans: List[WorkflowPlan]):
+    bind_metrics(app)
+    app.state.plan_routes = {}
+    for plan in plans:
+        routes = create_routes(plan)
+        app.router.routes.extend(routes)
+        app.state.plan_routes[plan.path] = routes
+
+
+def swap_routes(app: FastAPI, old_routes: List[APIRoute], new_routes: List[APIRoute]):
+    """replace the routes of a plan in place, routes keep their position so
+    precedence between workflows binding the same path is unchanged. requests
+    already dispatched keep running on the old route and workflow instance
+    """
+    routes = app.router.routes
+    new_by_path = {route.path: route for route in new_routes}
+    for old in old_routes:
+        idx = next((i for i, route in enumerate(routes) if route is old), None)
+        if idx is None:
+            continue
+        new = new_by_path.pop(old.path, None)
+        if new is None:
+            del routes[idx]
+        else:
+            routes[idx] = new
+    routes.extend(route for route in new_routes if route.path in new_by_path)
+    app.openapi_schema = None
+
+
+async def reload_workflows(app: FastAPI):
+    """recompile changed workflow configs and swap their routes in"""
+    loader: WorkflowLoader = app.state.loader
+    # parsing and compiling happen off the event loop, swapping on it
+    changed, removed = await asyncio.to_thread(loader.scan)
+    plan_routes = app.state.plan_routes
+    for old, plan in changed:
+        logger.info("reload workflow config %s", plan.path)
         try:
-            wfi = create_workflow_instance(config)
-            wfi_list.append(wfi)
+            new_routes = create_routes(plan)
         except Exception:
-            logging.error(f"create workflow instance for {config} failed")
+            logger.exception("bind endpoints of %s failed", plan.path)
+            continue
+        swap_routes(app, plan_routes.get(plan.path, []), new_routes)
+        plan_routes[plan.path] = new_routes
+    for plan in removed:
+        logger.info("unload workflow config %s", plan.path)
+        swap_routes(app, plan_routes.pop(plan.path, []), [])
+
+
+async def watch_workflows(app: FastAPI, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reload_workflows(app)
+        except Exception:
+            logger.exception("reload workflow configs failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    watcher = None
+    if app.state.watch_interval > 0:
+        watcher = asyncio.create_task(
+            watch_workflows(app, app.state.watch_interval)
+        )
+    yield
+    if watcher is not None:
+        watcher.cancel()
+    # persist session messages still queued by the write-behind writer
+    close_session_writer()
+
+
+def create_app(
+    configs: List[str],
+    config_type: str,
+    watch_interval: float = workflow_watch_interval,
+) -> FastAPI:
+    loader = WorkflowLoader(configs, config_type)
+    plans = loader.load()
+
+    app = FastAPI(title="Vulcan", version="2024/01/21", description="", lifespan=lifespan)
+    app.state.loader = loader
+    app.state.watch_interval = watch_interval
+    create_endpoints(app, plans)
+    return app
+
+
+def app_factory() -> FastAPI:
+    """app factory for running under an external server, e.g.
+    `uvicorn vulcan:app_factory --factory`, configured by `VULCAN_CONFIGS`
+    (space separated config files, all of `workflows/` by default) and
+    `VULCAN_CONFIG_TYPE`. with several server processes (`--workers`) set
+    `VULCAN_SESSION_CACHE=false`, unless sessions are sticky to a process
+    """
+    ensure_logging()
+    configs = os.environ.get("VULCAN_CONFIGS", "").split()
+    config_type = os.environ.get("VULCAN_CONFIG_TYPE", "yaml")
+    return create_app(configs, config_type)
+
+
+def run_batch(args):
+    runner = BatchRunner(
+        args.config,
+        args.input,
+        args.output,
+        config_type=args.config_type,
+        mode=args.mode,
+        concurrency=args.concurrency,
+        resume=args.resume,
+        start_line=args.start_line,
+        limit=args.limit,
+        timeout_ms=args.timeout_ms,
+        checkpoint_every=args.checkpoint_every,
+        progress_interval=args.progress_interval,
+    )
+    try:
+        logger.info("batch done: %s", runner.run())
+    finally:
+        close_session_writer()
+
+
+def run_index(args):
+    stats = build_index(
+        args.index,
+        args.input,
+        args.model_id,
+        model_kwargs=args.model_kwargs,
+        text_field=args.text_field,
+        id_field=args.id_field,
+        metric=args.metric,
+        batch_size=args.batch_size,
+        rebuild=args.rebuild,
+        progress_interval=args.progress_interval,
+    )
+    logger.info("index done: %s", stats)
+
 
-    app = FastAPI(title="Vulcan", version="2024/01/21", description="")
-    create_endpoints(app, wfi_list, configs)
-    uvicorn.run(app, host=args.host, port=args.port)
+def main(args):
+    if args.command == "batch":
+        run_batch(args)
+        return
+    if args.command == "index":
+        run_index(args)
+        return
+    if args.workers > 1:
+        # turns of a session land on any worker, a cache per worker would
+        # serve history missing the turns served by the others
+        disable_session_history_cache()
+    app = create_app(args.configs, args.config_type, args.watch_interval)
+    if args.workers > 1:
+        # workflows are compiled once here, before forking the workers
+        server = PreforkServer(
+            app,
+            args.host,
+            args.port,
+            args.workers,
+            on_reload=lambda: asyncio.run(reload_workflows(app)),
+        )
+        server.run()
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
 
 
 if __name__ == "__main__":
+    setup_logging()
     args = parse_args()
-    logging.info(f"args: {args}")
+    logger.info("args: %s", args)
     main(args)
@@ -1,2 +1,6 @@
-from .workflow_instance import WorkflowInstance, SequentialWorkflowInstance
+from .workflow_instance import (
+    WorkflowInstance,
+    SequentialWorkflowInstance,
+    TreeWorkflowInstance,
+)
 from .workflow import Workflow, WorkflowType
\ No newline at end of file
@@ -0,0 +1,58 @@
+from utils.deadline import Deadline
+
+
+class ExecutionContext:
+    """Execution frame of a single workflow run
+
+    every call to `execute`/`execute_as_stream` of a workflow instance works on
+    its own context, so concurrent requests served by the same (shared)
+    workflow instance never see each other's variables.
+    """
+
+    def __init__(
+        self,
+        workflow_id: str,
+        input: dict,
+        deadline: Deadline = None,
+    ) -> None:
+        self.workflow_id = workflow_id
+        self.deadline = deadline if deadline is not None else Deadline()
+        self.global_variables = dict(input)
+        # chunks of streamed variables, joined once by `finish_stream`
+        self.stream_buffers = {}
+        # span of the run, parent of the node spans
+        self.span = None
+
+    def update_global_variables(self, variable_names: list, outputs: list):
+        """update output from node into global variables
+
+        Args:
+            variable_names (list): list of variable name to be updated in global vars
+            outputs (list): value of variables
+        """
+        assert len(variable_names) == len(outputs)
+        for var_name, output in zip(variable_names, outputs):
+            self.global_variables[var_name] = output
+
+    def update_stream(self, deltas: dict):
+        """update the deltas of one streamed chunk into global variables
+        the segment of each variable is updated to `<var_name>#seg` (segments of
+        previous chunks are dropped) and appended to the chunk buffer of
+        `<var_name>`, which is only assembled by `finish_stream`, keeping the
+        accumulation linear
+
+        Args:
+            deltas (dict): new segment of each streamed variable in this chunk
+        """
+        for var_name in self.stream_buffers:
+            self.global_variables.pop("#".join([var_name, "seg"]), None)
+        for var_name, delta in deltas.items():
+            self.global_variables["#".join([var_name, "seg"])] = delta
+            self.stream_buffers.setdefault(var_name, []).append(delta)
+
+    def finish_stream(self):
+        """assemble streamed variables and drop their last segments"""
+        for var_name, chunks in self.stream_buffers.items():
+            self.global_variables[var_name] = "".join(chunks)
+            self.global_variables.pop("#".join([var_name, "seg"]), None)
+        self.stream_buffers = {}
@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import os
+from typing import Dict, List, NamedTuple, Tuple
+
+from reader.ReaderFactory import get_reader
+from reader.DataReader import DataReader
+from workflow.workflow import Workflow
+from workflow.workflow_instance import WorkflowInstance
+
+logger = logging.getLogger(__name__)
+
+config_extensions = {"yaml": (".yml", ".yaml")}
+
+
+class WorkflowPlan(NamedTuple):
+    """A workflow config file compiled into a workflow instance
+
+    plans are never updated, a changed file compiles into a new plan that
+    replaces the old one, requests already running keep the old one.
+    """
+
+    path: str
+    # (mtime_ns, size) of the file, a change triggers a digest check
+    stat: Tuple[int, int]
+    digest: str
+    config: DataReader
+    wfi: WorkflowInstance
+
+    @property
+    def endpoint_configs(self) -> List[dict]:
+        return self.config.get_endpoints()
+
+
+def compile_plan(config: DataReader) -> WorkflowInstance:
+    workflow = Workflow(config.get_workflow(), config.get_workflow_id())
+    return workflow.build()
+
+
+class WorkflowLoader:
+    """Discovers workflow config files and compiles them into plans
+
+    configs are either the given files or every config file under `root`,
+    searched recursively. `scan` only re-reads files whose mtime or size
+    changed, and only recompiles them when their content did.
+    """
+
+    def __init__(
+        self, configs: List[str] = None, config_type: str = "yaml", root: str = "workflows"
+    ) -> None:
+        self.configs = list(configs or [])
+        self.config_type = config_type
+        self.root = root
+        self.reader = get_reader(config_type)
+        self.plans: Dict[str, WorkflowPlan] = {}
+        # stat of configs failing to compile, retried once they change
+        self.failed: Dict[str, Tuple[int, int]] = {}
+
+    def discover(self) -> List[str]:
+        if self.configs:
+            return [path for path in self.configs if os.path.isfile(path)]
+        extensions = config_extensions[self.config_type]
+        paths = []
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                if file.endswith(extensions):
+                    paths.append(os.path.join(directory, file))
+        return sorted(paths)
+
+    @staticmethod
+    def get_stat(path: str) -> Tuple[int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def get_digest(path: str) -> str:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def compile(self, path: str, stat: Tuple[int, int], digest: str) -> WorkflowPlan:
+        config = self.reader(path)
+        logger.info("create workflow instance for %s", path)
+        return WorkflowPlan(path, stat, digest, config, compile_plan(config))
+
+    def load(self) -> List[WorkflowPlan]:
+        """compile every config, configs failing to compile are skipped"""
+        paths = self.discover()
+        logger.info("found workflow configs: %s", paths)
+        for path in paths:
+            stat = None
+            try:
+                stat = self.get_stat(path)
+                self.plans[path] = self.compile(path, stat, self.get_digest(path))
+            except Exception:
+                logger.exception("create workflow instance for %s failed", path)
+                self.failed[path] = stat
+        return list(self.plans.values())
+
+    def scan(self) -> Tuple[list, List[WorkflowPlan]]:
+        """return the (old plan or None, new plan) of changed or new configs,
+        and the plans of deleted configs. compile errors keep the old plan
+        """
+        paths = self.discover()
+        changed = []
+        for path in paths:
+            old = self.plans.get(path)
+            stat = None
+            try:
+                stat = self.get_stat(path)
+                if old is not None and old.stat == stat:
+                    continue
+                if old is None and self.failed.get(path) == stat:
+                    continue
+                digest = self.get_digest(path)
+                if old is not None and old.digest == digest:
+                    # touched but not modified, no need to recompile
+                    self.plans[path] = old._replace(stat=stat)
+                    continue
+                plan = self.compile(path, stat, digest)
+            except Exception:
+                logger.exception("reload workflow config %s failed", path)
+                if old is None:
+                    self.failed[path] = stat
+                else:
+                    # keep serving the old plan, retry once the file changes again
+                    self.plans[path] = old._replace(stat=stat)
+                continue
+            self.failed.pop(path, None)
+            self.plans[path] = plan
+            changed.append((old, plan))
+
+        existing = set(paths)
+        removed = [
+            self.plans.pop(path) for path in list(self.plans) if path not in existing
+        ]
+        return changed, removed
@@ -2,6 +2,8 @@ from typing import Union
 from enum import Enum, unique, auto
 import logging
 
+logger = logging.getLogger(__name__)
+
 
 @unique
 class WorkflowType(Enum):
@@ -13,7 +15,7 @@ class Workflow:
     def __init__(self, workflow_config: Union[list, dict], id: str = None) -> None:
         self._load_workflow_config(workflow_config)
         self.id = id
-        logging.info("initialize workflow with config: %s" % self.workflow_config)
+        logger.info("initialize workflow with config: %s", self.workflow_config)
 
     def _load_workflow_config(self, workflow_config: Union[list, dict]):
         self.workflow_config = workflow_config
@@ -32,5 +34,9 @@ class Workflow:
             from workflow.workflow_instance import SequentialWorkflowInstance
 
             return SequentialWorkflowInstance(self)
+        elif self.workflow_type == WorkflowType.TREE:
+            from workflow.workflow_instance import TreeWorkflowInstance
+
+            return TreeWorkflowInstance(self)
         else:
             raise ValueError()
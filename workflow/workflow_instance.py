@@ -1,11 +1,24 @@
+import asyncio
 import logging
-import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import AsyncGenerator, Generator
 
+from configs.constants import tree_workflow_workers
 from workflow.workflow import Workflow
+from workflow.context import ExecutionContext
 from nodes.node_manager import NodeManager
 from nodes.node.node_base import NodeBase
 from dao.session import SessionDAO
 from utils.util import get_session_id
+from utils.deadline import Deadline
+from utils import metrics, tracing
+from utils.log import log_payload
+
+logger = logging.getLogger(__name__)
 
 
 class IWorkflowInstance:
@@ -17,131 +30,658 @@ class IWorkflowInstance:
 
 
 class WorkflowInstance(IWorkflowInstance):
+    """A loaded workflow, shared by every request bound to it
+
+    the instance itself only holds the (read-only) nodes of the workflow,
+    all per-request state lives in an `ExecutionContext` created by
+    `create_context` for each run.
+    """
+
+    # variables provided by the request itself rather than by a node
+    request_variables = ("input", "config", "kwargs", "session_id")
+
     def __init__(self, workflow: Workflow):
-        self.global_variables = {}
         self.workflow = workflow
         self.load_nodes()
+        self.check_variables()
+        self.model_ids = sorted(
+            {model_id for node in self._ordered_nodes() for model_id in node.model_ids()}
+        )
         self.session_dao = SessionDAO()
 
-    def update_global_variables(
-        self, variable_names: list, outputs: list, is_streaming_output=False
-    ):
-        """update output from node into global variables
-        if output is from a streamer node, the output segment will be updated to `<node_name>#seg`
-        and will be append to `<node_name>`
-
-        Args:
-            variable_names (list): list of variable name to be updated in global vars
-            outputs (list): value of variables
-            is_streaming_output (bool, optional): Defaults to False.
+    def _ordered_nodes(self) -> list:
+        """nodes in an order running every producer before its readers"""
+        raise NotImplementedError()
+
+    def check_variables(self):
+        """reading a variable no node (nor the request) defines before is an
+        error, producing one nothing reads is reported
         """
-        assert len(variable_names) == len(outputs)
-        for var_name, output in zip(variable_names, outputs):
-            if is_streaming_output:
-                seg_var_name = "#".join([var_name, "seg"])
-                self.global_variables[seg_var_name] = output
-                self.global_variables[var_name] = (
-                    self.global_variables.get(var_name, "") + output
-                )
-            else:
-                self.global_variables[var_name] = output
+        nodes = self._ordered_nodes()
+        defined = set(self.request_variables)
+        read = set()
+        for node in nodes:
+            optional = set(node.optional_inputs())
+            for var_name in node.input_variables:
+                if var_name not in defined and var_name not in optional:
+                    raise ValueError(
+                        f"node `{node.node_id}` of workflow `{self.workflow.id}` "
+                        f"reads undefined variable `{var_name}`"
+                    )
+                read.add(var_name)
+            defined.update(node.output_mappings or [])
+
+        for node in nodes:
+            for var_name in node.output_mappings or []:
+                if var_name not in read and var_name != "final_output":
+                    logger.warning(
+                        "variable `%s` of node `%s` in workflow `%s` is never read",
+                        var_name,
+                        node.node_id,
+                        self.workflow.id,
+                    )
+
+    def create_context(self, input: dict, deadline: Deadline = None) -> ExecutionContext:
+        context = ExecutionContext(self.workflow.id, input, deadline)
+        session_id = get_session_id("", input["kwargs"].get("timestamp"))
+        context.global_variables["session_id"] = session_id
+        return context
+
+    def session_messages(self, context: ExecutionContext) -> list:
+        global_variables = context.global_variables
+        session_id = global_variables["session_id"]
+        return [
+            self.session_dao.new_message(
+                session_id,
+                global_variables["input"],
+                "user",
+                None,
+            ),
+            self.session_dao.new_message(
+                session_id,
+                global_variables["final_output"],
+                "ai",
+                # todo, enable source
+                "",
+            ),
+        ]
+
+    def save_session(self, context: ExecutionContext):
+        session_id = context.global_variables["session_id"]
+        self.session_dao.save_messages(session_id, self.session_messages(context))
+
+    async def asave_session(self, context: ExecutionContext):
+        session_id = context.global_variables["session_id"]
+        messages = self.session_dao.enqueue_messages(
+            session_id, self.session_messages(context)
+        )
+        if messages:
+            # no write-behind or its queue is full, the store write blocks
+            await asyncio.to_thread(self.session_dao.save_messages, session_id, messages)
+
+    def _log_node_output(self, node: NodeBase, outputs: list):
+        output_mappings = node.output_mappings
+        logger.debug("node: `%s` update value to: %s", node.node_id, output_mappings)
+        assert len(output_mappings) == len(outputs)
+
+    @contextmanager
+    def run_span(self, context: ExecutionContext):
+        with tracing.span(
+            f"workflow {self.workflow.id}",
+            workflow=self.workflow.id,
+            session_id=context.global_variables["session_id"],
+        ) as span:
+            context.span = span
+            yield span
+
+    @contextmanager
+    def node_span(self, node: NodeBase, context: ExecutionContext):
+        """time a node into `vulcan_node_duration_seconds` and trace it"""
+        start = time.perf_counter()
+        try:
+            with tracing.span(
+                f"node {node.node_id}",
+                parent=context.span,
+                workflow=self.workflow.id,
+                node=node.node_id,
+                type=node.node_name,
+            ):
+                yield
+        finally:
+            metrics.node_duration_seconds.observe(
+                time.perf_counter() - start,
+                self.workflow.id,
+                node.node_id,
+                node.node_name,
+            )
+
+    def execute_node(self, node: NodeBase, context: ExecutionContext):
+        context.deadline.check()
+        with self.node_span(node, context):
+            outputs = node.execute(context.global_variables)
+        self._log_node_output(node, outputs)
+        context.update_global_variables(node.output_mappings, outputs)
+
+    async def aexecute_node(self, node: NodeBase, context: ExecutionContext):
+        context.deadline.check()
+        with self.node_span(node, context):
+            outputs = await node.aexecute(context.global_variables)
+        self._log_node_output(node, outputs)
+        context.update_global_variables(node.output_mappings, outputs)
+
+    def _split_at_streamer(self) -> tuple:
+        """return (nodes before streamer, streamer node, nodes after streamer)
+        nodes before streamer are run by `_execute`/`_aexecute`
+        """
+        raise NotImplementedError()
 
-    def execute(input: dict):
+    def _execute(self, nodes, context: ExecutionContext):
         raise NotImplementedError()
 
-    def execute_as_stream(input: dict):
+    async def _aexecute(self, nodes, context: ExecutionContext):
         raise NotImplementedError()
 
+    def _stream_downstream(
+        self, nodes: list, deltas: dict, context: ExecutionContext
+    ) -> dict:
+        """propagate the deltas of one streamed chunk through downstream nodes
+        pass-through nodes forward their input deltas, delta nodes get the new
+        segments of their inputs, other nodes wait for the end of the stream
+        """
+        for node in nodes:
+            if node.stream_passthrough:
+                for output_var, input_var in zip(
+                    node.output_mappings, node.passthrough_inputs()
+                ):
+                    if input_var in deltas:
+                        deltas[output_var] = deltas[input_var]
+            elif node.accepts_deltas:
+                node_deltas = {
+                    var_name: deltas[var_name]
+                    for var_name in node.input_variables
+                    if var_name in deltas
+                }
+                if node_deltas:
+                    outputs = node.execute_delta(context.global_variables, node_deltas)
+                    if outputs is not None:
+                        deltas.update(zip(node.output_mappings, outputs))
+        context.update_stream(deltas)
+        return deltas
+
+    @staticmethod
+    def _nodes_to_finish(nodes: list, context: ExecutionContext) -> list:
+        """downstream nodes to run once the stream finished, outputs of
+        pass-through nodes are already assembled from their deltas, unless
+        none of their inputs was streamed
+        """
+        streamed = set(context.stream_buffers)
+        return [
+            node
+            for node in nodes
+            if not node.stream_passthrough
+            or not any(var in streamed for var in node.passthrough_inputs())
+        ]
+
+    def _finish_downstream(self, nodes: list, context: ExecutionContext):
+        """run downstream nodes with the full streamed values"""
+        nodes = self._nodes_to_finish(nodes, context)
+        context.finish_stream()
+        for node in nodes:
+            self.execute_node(node, context)
+
+    async def _afinish_downstream(self, nodes: list, context: ExecutionContext):
+        nodes = self._nodes_to_finish(nodes, context)
+        context.finish_stream()
+        for node in nodes:
+            await self.aexecute_node(node, context)
+
+    @staticmethod
+    def _should_emit(nodes: list, deltas: dict) -> bool:
+        """emit a frame once `final_output` changes, or on every chunk when the
+        streamer is not followed by the node producing `final_output`
+        """
+        if "final_output" in deltas:
+            return True
+        return not any(
+            "final_output" in (node.output_mappings or []) for node in nodes
+        )
+
+    @staticmethod
+    def _merge_outputs(pending: list) -> list:
+        return ["".join(outputs) for outputs in zip(*pending)]
+
+    def coalesce(
+        self, stream: Generator, coalesce_ms: float = 0, coalesce_bytes: int = 0
+    ) -> Generator:
+        """merge consecutive streamer outputs until `coalesce_ms` has passed
+        since the last emitted one or `coalesce_bytes` are pending
+        """
+        if not coalesce_ms and not coalesce_bytes:
+            yield from stream
+            return
+
+        pending, pending_bytes = [], 0
+        last_emit = time.monotonic()
+        for outputs in stream:
+            pending.append(outputs)
+            pending_bytes += sum(len(output.encode()) for output in outputs)
+            now = time.monotonic()
+            if (coalesce_bytes and pending_bytes >= coalesce_bytes) or (
+                coalesce_ms and (now - last_emit) * 1000 >= coalesce_ms
+            ):
+                yield self._merge_outputs(pending)
+                pending, pending_bytes, last_emit = [], 0, now
+        if pending:
+            yield self._merge_outputs(pending)
+
+    async def acoalesce(
+        self, stream: AsyncGenerator, coalesce_ms: float = 0, coalesce_bytes: int = 0
+    ) -> AsyncGenerator:
+        """async version of `coalesce`"""
+        if not coalesce_ms and not coalesce_bytes:
+            async for outputs in stream:
+                yield outputs
+            return
+
+        pending, pending_bytes = [], 0
+        last_emit = time.monotonic()
+        async for outputs in stream:
+            pending.append(outputs)
+            pending_bytes += sum(len(output.encode()) for output in outputs)
+            now = time.monotonic()
+            if (coalesce_bytes and pending_bytes >= coalesce_bytes) or (
+                coalesce_ms and (now - last_emit) * 1000 >= coalesce_ms
+            ):
+                yield self._merge_outputs(pending)
+                pending, pending_bytes, last_emit = [], 0, now
+        if pending:
+            yield self._merge_outputs(pending)
+
+    def execute(self, input: dict, deadline: Deadline = None) -> dict:
+        raise NotImplementedError()
+
+    def execute_as_stream(
+        self,
+        input: dict,
+        coalesce_ms: float = 0,
+        coalesce_bytes: int = 0,
+        deadline: Deadline = None,
+    ) -> Generator:
+        nodes_before_streamer, streamer_node, nodes_after_streamer = (
+            self._split_at_streamer()
+        )
+
+        # obtain global variables before streamer node
+        context = self.create_context(input, deadline)
+        with self.run_span(context):
+            self._execute(nodes_before_streamer, context)
+
+            context.deadline.check()
+            with self.node_span(streamer_node, context):
+                node_stream = streamer_node.execute_as_stream(context.global_variables)
+                stream = self.coalesce(node_stream, coalesce_ms, coalesce_bytes)
+                try:
+                    for streamer_output_list in stream:
+                        context.deadline.check()
+                        deltas = self._stream_downstream(
+                            nodes_after_streamer,
+                            dict(zip(streamer_node.output_mappings, streamer_output_list)),
+                            context,
+                        )
+                        if self._should_emit(nodes_after_streamer, deltas):
+                            yield context.global_variables
+                finally:
+                    # stops the model stream right away when the run is cancelled
+                    stream.close()
+                    node_stream.close()
+
+            # settle the final values of downstream nodes before persisting
+            self._finish_downstream(nodes_after_streamer, context)
+            self.save_session(context)
+        # final frame, streamed segments are dropped from it
+        yield context.global_variables
+
+    async def aexecute(self, input: dict, deadline: Deadline = None) -> dict:
+        raise NotImplementedError()
+
+    async def aexecute_as_stream(
+        self,
+        input: dict,
+        coalesce_ms: float = 0,
+        coalesce_bytes: int = 0,
+        deadline: Deadline = None,
+    ) -> AsyncGenerator:
+        nodes_before_streamer, streamer_node, nodes_after_streamer = (
+            self._split_at_streamer()
+        )
+
+        context = self.create_context(input, deadline)
+        with self.run_span(context):
+            await self._aexecute(nodes_before_streamer, context)
+
+            context.deadline.check()
+            with self.node_span(streamer_node, context):
+                node_stream = streamer_node.aexecute_as_stream(context.global_variables)
+                stream = self.acoalesce(node_stream, coalesce_ms, coalesce_bytes)
+                try:
+                    async for streamer_output_list in stream:
+                        context.deadline.check()
+                        deltas = self._stream_downstream(
+                            nodes_after_streamer,
+                            dict(zip(streamer_node.output_mappings, streamer_output_list)),
+                            context,
+                        )
+                        if self._should_emit(nodes_after_streamer, deltas):
+                            yield context.global_variables
+                finally:
+                    await stream.aclose()
+                    await node_stream.aclose()
+
+            await self._afinish_downstream(nodes_after_streamer, context)
+            await self.asave_session(context)
+        yield context.global_variables
+
 
 class SequentialWorkflowInstance(WorkflowInstance):
     def __init__(self, workflow: Workflow):
         super().__init__(workflow)
 
     def load_nodes(self):
-        logging.info(
-            "load node for workflow config: %s" % self.workflow.workflow_config
-        )
+        logger.info("load node for workflow config: %s", self.workflow.workflow_config)
         self.streamer_idx = None
         self.nodes = []
         for i, node_config in enumerate(self.workflow.workflow_config):
             assert len(node_config) == 1
-            node_name, config = node_config.popitem()
+            node_name, config = next(iter(node_config.items()))
             node = NodeManager.get_node(node_name, None, config)
+            node.node_id = str(i)
             self.nodes.append(node)
             # connect each node
             if len(self.nodes) > 1:
                 self.nodes[-2].next_node = self.nodes[-1]
 
             if node.as_streamer:
-                logging.info(f"found streamer node: {node.node_name}, index: {i}")
+                logger.info("found streamer node: %s, index: %s", node.node_name, i)
                 self.streamer_idx = i
 
-    def execute_node(
-        self, node: NodeBase, global_variables: dict, streaming_input: bool = False
-    ):
-        outputs = node.execute(global_variables, streaming_input=streaming_input)
-        output_mappings = node.output_mappings
-        logging.info(
-            f"node: `{node.node_name}` update value to: {json.dumps(output_mappings)}"
-        )
-
-        assert len(output_mappings) == len(outputs)
-        self.update_global_variables(output_mappings, outputs)
+    def _ordered_nodes(self) -> list:
+        return self.nodes
 
-    def _execute(self, nodes: list, streaming_input: bool = False):
+    def _execute(self, nodes: list, context: ExecutionContext):
         for node in nodes:
-            self.execute_node(
-                node, self.global_variables, streaming_input=streaming_input
-            )
-            logging.info(
-                f"node: `{node.node_name}` updated global_var: {self.global_variables}"
+            self.execute_node(node, context)
+            log_payload(
+                logger,
+                "node: `%s` updated global_var: %s",
+                node.node_id,
+                context.global_variables,
             )
-        return self.global_variables
+        return context.global_variables
 
-    def execute(self, input: dict) -> dict:
-        logging.info(f"execute workflow `{self.workflow.id}`, input: {input}")
-        self.global_variables.update(input)
-        session_id = get_session_id("", input["kwargs"].get("timestamp"))
-        self.global_variables.update({"session_id": session_id})
-        self._execute(self.nodes)
-        self.session_dao.save_session_message(
-            session_id,
-            self.global_variables["input"],
-            "user",
-            None,
-        )
-        self.session_dao.save_session_message(
-            session_id,
-            self.global_variables["final_output"],
-            "ai",
-            # todo, enable source
-            "",
-        )
-        return self.global_variables
+    async def _aexecute(self, nodes: list, context: ExecutionContext):
+        for node in nodes:
+            await self.aexecute_node(node, context)
+            log_payload(
+                logger,
+                "node: `%s` updated global_var: %s",
+                node.node_id,
+                context.global_variables,
+            )
+        return context.global_variables
 
-    def execute_as_stream(self, input: dict):
+    def _split_at_streamer(self):
         if self.streamer_idx is None:
             raise RuntimeError("streamer node not found")
 
         nodes_before_streamer = self.nodes[: self.streamer_idx]
         nodes_after_streamer = self.nodes[self.streamer_idx + 1 :]
         streamer_node = self.nodes[self.streamer_idx]
+        return nodes_before_streamer, streamer_node, nodes_after_streamer
 
-        # obtain global variables before streamer node
-        self.global_variables.update(input)
-        self._execute(nodes_before_streamer)
-
-        for streamer_output_list in streamer_node.execute_as_stream(
-            self.global_variables
-        ):
-            self.update_global_variables(
-                streamer_node.output_mappings,
-                streamer_output_list,
-                is_streaming_output=True,
-            )
-            self._execute(nodes_after_streamer, streaming_input=True)
-            yield self.global_variables
+    def execute(self, input: dict, deadline: Deadline = None) -> dict:
+        log_payload(logger, "execute workflow `%s`, input: %s", self.workflow.id, input)
+        context = self.create_context(input, deadline)
+        with self.run_span(context):
+            self._execute(self.nodes, context)
+            self.save_session(context)
+        return context.global_variables
 
+    async def aexecute(self, input: dict, deadline: Deadline = None) -> dict:
+        log_payload(
+            logger, "async execute workflow `%s`, input: %s", self.workflow.id, input
+        )
+        context = self.create_context(input, deadline)
+        with self.run_span(context):
+            await self._aexecute(self.nodes, context)
+            await self.asave_session(context)
+        return context.global_variables
 
 class TreeWorkflowInstance(WorkflowInstance):
-    pass
+    """Workflow instance executing its nodes as a DAG
+
+    the workflow config is a dict of `<node_id>: {<NodeName>: <config>}`, the
+    edges are inferred from the variables each node reads (`$var` references,
+    prompt placeholders, ...) and the `output_mappings` producing them.
+    nodes whose dependencies are met run concurrently, so the latency of a run
+    is its critical path instead of the sum of all nodes.
+    """
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        return get_node_executor()
+
+    def load_nodes(self):
+        logger.info("load node for workflow config: %s", self.workflow.workflow_config)
+        self.nodes = {}
+        for node_id, node_config in self.workflow.workflow_config.items():
+            assert len(node_config) == 1
+            node_name, config = next(iter(node_config.items()))
+            node = NodeManager.get_node(node_name, None, config)
+            node.node_id = node_id
+            self.nodes[node_id] = node
+
+        producers = {}
+        for node_id, node in self.nodes.items():
+            for var_name in node.output_mappings or []:
+                if var_name in producers:
+                    raise ValueError(
+                        f"variable `{var_name}` is produced by both "
+                        f"`{producers[var_name]}` and `{node_id}`"
+                    )
+                producers[var_name] = node_id
+
+        self.dependencies = {}
+        for node_id, node in self.nodes.items():
+            deps = set()
+            for var_name in node.input_variables:
+                # variables produced by no node are checked by `check_variables`
+                producer = producers.get(var_name)
+                if producer is not None and producer != node_id:
+                    deps.add(producer)
+            self.dependencies[node_id] = deps
+
+        self.order = self._topological_sort()
+        self.dependents = {node_id: set() for node_id in self.nodes}
+        for node_id, deps in self.dependencies.items():
+            for dep in deps:
+                self.dependents[dep].add(node_id)
+        logger.info("workflow `%s` dependencies: %s", self.workflow.id, self.dependencies)
+
+        self.streamer_id = self._find_streamer(producers)
+        if self.streamer_id is not None:
+            logger.info("found streamer node: %s", self.streamer_id)
+
+    def _ordered_nodes(self) -> list:
+        return [self.nodes[node_id] for node_id in self.order]
+
+    def _topological_sort(self) -> list:
+        in_degree = {node_id: len(deps) for node_id, deps in self.dependencies.items()}
+        ready = [node_id for node_id, degree in in_degree.items() if degree == 0]
+        order = []
+        while ready:
+            node_id = ready.pop(0)
+            order.append(node_id)
+            for other_id, deps in self.dependencies.items():
+                if node_id in deps:
+                    in_degree[other_id] -= 1
+                    if in_degree[other_id] == 0:
+                        ready.append(other_id)
+        if len(order) != len(self.nodes):
+            cyclic = [node_id for node_id in self.nodes if node_id not in order]
+            raise ValueError(f"workflow contains a cycle between nodes: {cyclic}")
+        return order
+
+    def _ancestors(self, node_id: str) -> set:
+        ancestors = set()
+        pending = list(self.dependencies[node_id])
+        while pending:
+            dep = pending.pop()
+            if dep not in ancestors:
+                ancestors.add(dep)
+                pending.extend(self.dependencies[dep])
+        return ancestors
+
+    def _descendants(self, node_id: str) -> set:
+        descendants = set()
+        pending = list(self.dependents[node_id])
+        while pending:
+            dependent = pending.pop()
+            if dependent not in descendants:
+                descendants.add(dependent)
+                pending.extend(self.dependents[dependent])
+        return descendants
+
+    def _find_streamer(self, producers: dict):
+        """the streamer is the last streamer node `final_output` depends on"""
+        end_id = producers.get("final_output")
+        if end_id is None:
+            return None
+        candidates = self._ancestors(end_id)
+        streamers = [
+            node_id
+            for node_id in self.order
+            if node_id in candidates and self.nodes[node_id].as_streamer
+        ]
+        return streamers[-1] if streamers else None
+
+    def _split_at_streamer(self):
+        if self.streamer_id is None:
+            raise RuntimeError("streamer node not found")
+        descendants = self._descendants(self.streamer_id)
+        nodes_before_streamer = [
+            node_id
+            for node_id in self.order
+            if node_id != self.streamer_id and node_id not in descendants
+        ]
+        nodes_after_streamer = [
+            self.nodes[node_id] for node_id in self.order if node_id in descendants
+        ]
+        return nodes_before_streamer, self.nodes[self.streamer_id], nodes_after_streamer
+
+    def _execute(self, node_ids: list, context: ExecutionContext):
+        """run nodes in a thread pool, each one as soon as its dependencies are done"""
+        scheduled = set(node_ids)
+        remaining = {
+            node_id: self.dependencies[node_id] & scheduled for node_id in node_ids
+        }
+        running = {}
+        try:
+            while remaining or running:
+                for node_id in [n for n, deps in remaining.items() if not deps]:
+                    del remaining[node_id]
+                    future = self.executor.submit(
+                        self._execute_node_snapshot, self.nodes[node_id], context
+                    )
+                    running[future] = node_id
+
+                done, _ = wait(
+                    running,
+                    timeout=context.deadline.remaining(),
+                    return_when=FIRST_COMPLETED,
+                )
+                context.deadline.check()
+                for future in done:
+                    node_id = running.pop(future)
+                    node = self.nodes[node_id]
+                    outputs = future.result()
+                    self._log_node_output(node, outputs)
+                    context.update_global_variables(node.output_mappings, outputs)
+                    for deps in remaining.values():
+                        deps.discard(node_id)
+        except BaseException:
+            # nodes already running finish in the background, unstarted ones are dropped
+            for future in running:
+                future.cancel()
+            raise
+        return context.global_variables
+
+    def _execute_node_snapshot(self, node: NodeBase, context: ExecutionContext):
+        context.deadline.check()
+        # sibling nodes update the context concurrently, run on a copy of it
+        with self.node_span(node, context):
+            return node.execute(context.global_variables.copy())
+
+    async def _aexecute(self, node_ids: list, context: ExecutionContext):
+        """run nodes as asyncio tasks, each one awaiting its own dependencies"""
+        tasks = {}
+
+        async def run(node_id):
+            deps = [tasks[dep] for dep in self.dependencies[node_id] if dep in tasks]
+            if deps:
+                await asyncio.gather(*deps)
+            await self.aexecute_node(self.nodes[node_id], context)
+
+        for node_id in node_ids:
+            tasks[node_id] = asyncio.ensure_future(run(node_id))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return context.global_variables
+
+    def execute(self, input: dict, deadline: Deadline = None) -> dict:
+        log_payload(logger, "execute workflow `%s`, input: %s", self.workflow.id, input)
+        context = self.create_context(input, deadline)
+        with self.run_span(context):
+            self._execute(self.order, context)
+            self.save_session(context)
+        return context.global_variables
+
+    async def aexecute(self, input: dict, deadline: Deadline = None) -> dict:
+        log_payload(
+            logger, "async execute workflow `%s`, input: %s", self.workflow.id, input
+        )
+        context = self.create_context(input, deadline)
+        with self.run_span(context):
+            await self._aexecute(self.order, context)
+            await self.asave_session(context)
+        return context.global_variables
+
+
+_node_executor = None
+_node_executor_lock = threading.Lock()
+
+
+def get_node_executor() -> ThreadPoolExecutor:
+    """thread pool running the nodes of every tree workflow of the process,
+    shared so reloaded workflows leave no idle pool behind
+    """
+    global _node_executor
+    if _node_executor is None:
+        with _node_executor_lock:
+            if _node_executor is None:
+                _node_executor = ThreadPoolExecutor(
+                    max_workers=tree_workflow_workers, thread_name_prefix="workflow-node"
+                )
+    return _node_executor
+
+
+def _reset_node_executor():
+    # threads of the pool do not survive a fork, children start their own
+    global _node_executor
+    _node_executor = None
+
+
+os.register_at_fork(after_in_child=_reset_node_executor)